@@ -19,7 +19,7 @@ import sys
 import os
 import os.path
 import time
-import re
+import select
 import string
 import binascii
 import logging as log
@@ -38,15 +38,21 @@ from picotui.dialogs import *
 from scratchabit import utils
 from scratchabit import help
 from scratchabit import saveload
+from scratchabit import project
+from scratchabit import listing
 from scratchabit import actions
 from scratchabit import uiprefs
+from scratchabit.background import ANALYSIS, LOCK
 
 
 HEIGHT = 21
+# How often to update screen while analysis runs in background, s
+REFRESH_INTERVAL = 0.5
 
 MENU_PREFS = 2000
 MENU_PLUGIN = 2001
 MENU_ADD_TO_FUNC = 2002
+MENU_EXPORT_TEXT = 2003
 
 
 class AppClass:
@@ -123,6 +129,10 @@ class DisasmViewer(editor.EditorExt):
         except Exception as ex:
             self.show_exception(ex)
             return None
+        finally:
+            # All changes made by a command form one undo group
+            if self.model.AS.journal is not None:
+                self.model.AS.journal.end_group()
 
 
     def goto_addr(self, to_addr, col=None, from_addr=None):
@@ -151,7 +161,7 @@ class DisasmViewer(editor.EditorExt):
         # Otherwise, re-render model around needed address, and redraw screen
         t = time.time()
         model = engine.render_partial_around(to_addr, 0, HEIGHT * 2)
-        self.show_status("Rendering time: %fs" % (time.time() - t))
+        self.show_status("Rendering time: %fs, %s" % (time.time() - t, engine.ADDRESS_SPACE.render_cache.stats()))
         if not model:
             self.show_status("Unknown address: 0x%x" % to_addr)
             return
@@ -179,7 +189,7 @@ class DisasmViewer(editor.EditorExt):
         addr, subno = self.cur_addr_subno()
         t = time.time()
         model = engine.render_partial_around(addr, subno, HEIGHT * 2)
-        self.show_status("Rendering time: %fs" % (time.time() - t))
+        self.show_status("Rendering time: %fs, %s" % (time.time() - t, engine.ADDRESS_SPACE.render_cache.stats()))
         self.set_model(model)
         if stay_on_real:
             self.cur_line = model.target_addr_lineno_real
@@ -241,8 +251,34 @@ class DisasmViewer(editor.EditorExt):
                 return i
         return -1
 
-    def analyze_status(self, cnt):
-        self.show_status("Analyzing (%d insts so far)" % cnt)
+    def start_analysis(self):
+        ANALYSIS.start()
+        self.show_status("Analyzing in background (Ctrl+C to cancel)")
+
+    def require_no_analysis(self):
+        if ANALYSIS.running:
+            self.show_status("Analysis is running, wait for it or cancel (Ctrl+C)")
+            return False
+        return True
+
+    # Called periodically while analysis runs in background, and once
+    # after it finished. Screen is updated only if anything visible
+    # changed.
+    def update_analysis(self):
+        addr, subno = self.cur_addr_subno()
+        model = engine.render_partial_around(addr, subno, HEIGHT * 2)
+        if model and [(l.ea, l.render()) for l in model.lines()] != [(l.ea, l.render()) for l in self.model.lines()]:
+            self.update_model()
+        if ANALYSIS.running:
+            self.show_status("Analyzing in background (%d insts so far, Ctrl+C to cancel)" % ANALYSIS.cnt)
+        else:
+            ANALYSIS.finished = False
+            if ANALYSIS.error:
+                self.show_status("Analysis failed: %s" % ANALYSIS.error)
+            elif ANALYSIS.cancelled:
+                self.show_status("Analysis cancelled (%d insts)" % ANALYSIS.cnt)
+            else:
+                self.show_status("Analysis finished")
 
     def expect_flags(self, fl, allowed_flags):
         if fl not in allowed_flags:
@@ -262,9 +298,10 @@ class DisasmViewer(editor.EditorExt):
         import traceback
         v.set_lines([
             "Exception occured processing the command. Press Esc to continue.",
-            "Recommended action is saving database, quitting and comparing",
-            "database files with backup copies for possibility of data loss",
-            "or corruption. The exception was also logged to scratchabit.log.",
+            "Changes made by the command up to the exception can be undone",
+            "with Ctrl+z. Unsaved changes are kept in the project journal",
+            "and restored on next start in case of a crash. The exception",
+            "was also logged to scratchabit.log.",
             "Please report way to reproduce it to",
             "https://github.com/pfalcon/ScratchABit/issues",
             "",
@@ -399,22 +436,18 @@ class DisasmViewer(editor.EditorExt):
             self.goto_addr(self.model.AS.max_addr(), from_addr=line.ea)
         elif key == b"c":
             addr = self.cur_addr()
-            self.show_status("Analyzing at %x" % addr)
             engine.add_entrypoint(addr, False)
-            engine.analyze(self.analyze_status)
-            self.update_model()
+            self.start_analysis()
 
         elif key == b"F":
             addr = self.cur_addr()
             fl = self.model.AS.get_flags(addr, 0xff)
             if not self.require_non_func(fl):
                 return
-            self.show_status("Retracing as a function...")
             self.model.AS.make_label("fun_", addr)
             engine.add_entrypoint(addr, True)
-            engine.analyze(self.analyze_status)
             self.update_model()
-            self.show_status("Retraced as a function")
+            self.start_analysis()
 
         elif key == MENU_ADD_TO_FUNC:
             addr = self.cur_addr()
@@ -536,9 +569,30 @@ class DisasmViewer(editor.EditorExt):
             self.redraw()
         elif key == b"S":
             self.show_status("Saving...")
-            saveload.save_state(project_dir)
-            self.model.AS.changed = False
-            self.show_status("Saved.")
+            t = time.time()
+            cnt = saveload.save_state(project_dir)
+            self.show_status("Saved %d files in %fs." % (cnt, time.time() - t))
+        elif key == b"\x03":  # Ctrl+C
+            if ANALYSIS.cancel():
+                self.show_status("Cancelling analysis...")
+            else:
+                self.show_status("No analysis running")
+        elif key == b"\x1a":  # Ctrl+Z
+            if not self.require_no_analysis():
+                return
+            if self.model.AS.undo():
+                self.update_model()
+                self.show_status("Undone")
+            else:
+                self.show_status("Nothing to undo")
+        elif key == b"\x19":  # Ctrl+Y
+            if not self.require_no_analysis():
+                return
+            if self.model.AS.redo():
+                self.update_model()
+                self.show_status("Redone")
+            else:
+                self.show_status("Nothing to redo")
         elif key == b"\x11":  # ^Q
             class IssueList(WListBox):
                 def render_line(self, l):
@@ -576,7 +630,7 @@ class DisasmViewer(editor.EditorExt):
         elif key == b"W":
             out_fname = "out.lst"
             with open(out_fname, "w") as f:
-                engine.render_partial(actions.TextSaveModel(f, self), 0, 0, 10000000)
+                listing.write_listing(f, self)
             self.show_status("Disassembly listing written: " + out_fname)
         elif key == b"\x17":  # Ctrl+W
             outfile = actions.write_func_by_addr(APP, self.cur_addr(), feedback_obj=self)
@@ -584,60 +638,39 @@ class DisasmViewer(editor.EditorExt):
                 self.show_status("Wrote file: %s" % outfile)
         elif key == b"\x15":  # Ctrl+U
             # Next undefined
+            AS = self.model.AS
             addr = self.cur_addr()
-            flags = self.model.AS.get_flags(addr)
-            if flags == self.model.AS.UNK:
+            flags = AS.get_flags(addr)
+            if flags == AS.UNK:
                 # If already on undefined, skip the current stride of them,
                 # as they indeed go in batches.
-                while True:
-                    flags = self.model.AS.get_flags(addr)
-                    if flags != self.model.AS.UNK:
-                        break
-                    addr = self.model.AS.next_addr(addr)
-                    if addr is None:
-                        break
+                addr = AS.find_next_not(addr, 0x7f, AS.UNK)
 
             if addr is not None:
-                while True:
-                    flags = self.model.AS.get_flags(addr)
-                    if flags == self.model.AS.UNK:
-                        self.goto_addr(addr, from_addr=self.cur_addr())
-                        break
-                    addr = self.model.AS.next_addr(addr)
-                    if addr is None:
-                        break
+                addr = AS.find_next_flag(addr, 0x7f, AS.UNK)
 
             if addr is None:
                 self.show_status("There're no further undefined strides")
+            else:
+                self.goto_addr(addr, from_addr=self.cur_addr())
 
         elif key == b"\x06":  # Ctrl+F
             # Next non-function
+            AS = self.model.AS
             addr = self.cur_addr()
-            flags = self.model.AS.get_flags(addr, 0xff)
-            if flags == self.model.AS.CODE:
+            flags = AS.get_flags(addr, 0xff)
+            if flags == AS.CODE:
                 # If already on non-func code, skip the current stride of it,
                 # as it indeed go in batches.
-                while True:
-                    flags = self.model.AS.get_flags(addr, 0xff)
-                    self.show_status("fl=%x" % flags)
-                    if flags not in (self.model.AS.CODE, self.model.AS.CODE_CONT):
-                        break
-                    addr = self.model.AS.next_addr(addr)
-                    if addr is None:
-                        break
+                addr = AS.find_next_not(addr, 0xff, (AS.CODE, AS.CODE_CONT))
 
             if addr is not None:
-                while True:
-                    flags = self.model.AS.get_flags(addr, 0xff)
-                    if flags == self.model.AS.CODE:
-                        self.goto_addr(addr, from_addr=self.cur_addr())
-                        break
-                    addr = self.model.AS.next_addr(addr)
-                    if addr is None:
-                        break
+                addr = AS.find_next_flag(addr, 0xff, AS.CODE)
 
             if addr is None:
                 self.show_status("There're no further non-function code strides")
+            else:
+                self.goto_addr(addr, from_addr=self.cur_addr())
 
         elif key in (b"/", b"?"):  # "/" and Shift+"/"
 
@@ -692,7 +725,18 @@ class DisasmViewer(editor.EditorExt):
         elif key == MENU_PREFS:
             uiprefs.handle(APP)
 
+        elif key == MENU_EXPORT_TEXT:
+            res = DTextEntry(30, project_dir + ".text", title="Export project as text to:").result()
+            self.redraw()
+            if res:
+                self.show_status("Exporting...")
+                saveload.export_state(res, saveload.FORMAT_TEXT)
+                self.show_status("Exported.")
+
         elif key == MENU_PLUGIN:
+            # Plugins may run analysis themselves
+            if not self.require_no_analysis():
+                return
             res = DTextEntry(30, "", title="Plugin module name:").result()
             self.redraw()
             if res:
@@ -710,140 +754,8 @@ ACTION_MAP = {
 }
 
 
-CPU_PLUGIN = None
-ENTRYPOINTS = []
 APP.show_bytes = 4
 
-def filter_config_line(l):
-    l = re.sub(r"#.*$", "", l)
-    l = l.strip()
-    return l
-
-def load_symbols(fname):
-    with open(fname) as f:
-        for l in f:
-            l = filter_config_line(l)
-            if not l:
-                continue
-            m = re.search(r"\b([A-Za-z_$.][A-Za-z0-9_$.]*)\s*=\s*((0x)?[0-9A-Fa-f]+)", l)
-            if m:
-                #print(m.groups())
-                ENTRYPOINTS.append((m.group(1), int(m.group(2), 0)))
-            else:
-                print("Warning: cannot parse entrypoint info from: %r" % l)
-
-
-# Allow undescores to separate digit groups
-def str2int(s):
-    return int(s.replace("_", ""), 0)
-
-
-def parse_range(arg):
-    # name start(len)
-    # name start-end
-    if "(" in arg:
-        m = re.match(r"(.+?)\s*\(\s*(.+?)\s*\)", arg)
-        start = str2int(m.group(1))
-        end = start + str2int(m.group(2)) - 1
-    else:
-        m = re.match(r"(.+)\s*-\s*(.+)", arg)
-        start = str2int(m.group(1))
-        end = str2int(m.group(2))
-    return start, end
-
-
-def parse_entrypoints(f):
-    for l in f:
-        l = filter_config_line(l)
-        if not l:
-            continue
-        if l[0] == "[":
-            return l
-        m = re.match(r'load "(.+?)"', l)
-        if m:
-            load_symbols(m.group(1))
-        else:
-            label, addr = [v.strip() for v in l.split("=")]
-            ENTRYPOINTS.append((label, int(addr, 0)))
-    return ""
-
-def parse_subareas(f):
-    subareas = []
-    for l in f:
-        l = filter_config_line(l)
-        if not l:
-            continue
-        if l[0] == "[":
-            return l
-
-        args = l.split()
-        assert len(args) == 2
-        start, end = parse_range(args[1])
-        engine.ADDRESS_SPACE.add_subarea(start, end, args[0])
-    engine.ADDRESS_SPACE.finish_subareas()
-    return ""
-
-
-def load_target_file(loader, fname):
-    entry = loader.load(engine.ADDRESS_SPACE, fname)
-    log.info("Loaded %s, entrypoint: %s", fname, hex(entry) if entry is not None else None)
-    if entry is not None:
-        ENTRYPOINTS.append(("_ENTRY_", entry))
-
-
-def parse_disasm_def(fname):
-    global CPU_PLUGIN
-    with open(fname) as f:
-        for l in f:
-            l = filter_config_line(l)
-            if not l:
-                continue
-            #print(l)
-            while True:
-                if not l:
-                    #return
-                    break
-                if l[0] == "[":
-                    section = l[1:-1]
-                    print("Processing section: %s" % section)
-                    if section == "entrypoints":
-                        l = parse_entrypoints(f)
-                    elif section == "subareas":
-                        l = parse_subareas(f)
-                    else:
-                        assert 0, "Unknown section: " + section
-                else:
-                    break
-
-            if not l:
-                break
-
-            if l.startswith("load"):
-                args = l.split()
-                if args[2][0] in string.digits:
-                    addr = int(args[2], 0)
-                    print("Loading %s @0x%x" % (args[1], addr))
-                    engine.ADDRESS_SPACE.load_content(open(args[1], "rb"), addr)
-                else:
-                    print("Loading %s (%s plugin)" % (args[1], args[2]))
-                    loader = __import__(args[2])
-                    load_target_file(loader, args[1])
-            elif l.startswith("cpu "):
-                args = l.split()
-                CPU_PLUGIN = __import__(args[1])
-                print("Loading CPU plugin %s" % (args[1]))
-            elif l.startswith("show bytes "):
-                args = l.split()
-                APP.show_bytes = int(args[2])
-            elif l.startswith("area "):
-                args = l.split()
-                assert len(args) == 4
-                start, end = parse_range(args[2])
-                a = engine.ADDRESS_SPACE.add_area(start, end, {"name": args[1], "access": args[3].upper()})
-                print("Adding area: %s" % engine.str_area(a))
-            else:
-                assert 0, "Unknown directive: " + l
-
 
 class MainScreen:
 
@@ -852,7 +764,8 @@ class MainScreen:
         self.e = DisasmViewer(1, 2, self.screen_size[0] - 2, self.screen_size[1] - 4)
 
         menu_file = WMenuBox([
-            ("Save (Shift+s)", b"S"), ("Write disasm (Shift+w)", b"W"),
+            ("Save (Shift+s)", b"S"), ("Export as text...", MENU_EXPORT_TEXT),
+            ("Write disasm (Shift+w)", b"W"),
             ("Write function (Ctrl+w)", b"\x17"),
             ("Quit (q)", b"q")
         ])
@@ -883,41 +796,58 @@ class MainScreen:
         self.menu_bar.permanent = True
 
     def redraw(self, allow_cursor=True):
-        self.menu_bar.redraw()
-        self.e.attr_color(C_B_WHITE, C_BLUE)
-        self.e.draw_box(0, 1, self.screen_size[0], self.screen_size[1] - 2)
-        self.e.attr_reset()
-        self.e.redraw()
-        if allow_cursor:
-            self.e.cursor(True)
+        # May be called on terminal resize, at any time
+        with LOCK:
+            self.menu_bar.redraw()
+            self.e.attr_color(C_B_WHITE, C_BLUE)
+            self.e.draw_box(0, 1, self.screen_size[0], self.screen_size[1] - 2)
+            self.e.attr_reset()
+            self.e.redraw()
+            if allow_cursor:
+                self.e.cursor(True)
+
+    # While analysis runs in background, wait for input with a timeout,
+    # to show its progress.
+    def wait_input(self):
+        while ANALYSIS.running:
+            if select.select([0], [], [], REFRESH_INTERVAL)[0]:
+                return
+            with LOCK:
+                self.e.update_analysis()
+        if ANALYSIS.finished:
+            with LOCK:
+                self.e.update_analysis()
 
     def loop(self):
         while 1:
+            self.wait_input()
             key = self.e.get_input()
-            if isinstance(key, list):
-                x, y = key
-                if self.menu_bar.inside(x, y):
-                    self.menu_bar.focus = True
-
-            if self.menu_bar.focus:
-                res = self.menu_bar.handle_input(key)
-                if res == ACTION_CANCEL:
-                    self.menu_bar.focus = False
-                elif res is not None and res is not True:
-
-                    res = self.e.handle_input(res)
-                    if res is not None and res is not True:
-                        return res
-            else:
-                if key == KEY_F9:
-                    self.menu_bar.focus = True
-                    self.menu_bar.redraw()
-                    continue
-
-                res = self.e.handle_input(key)
+            # Analysis is paused while a command (including dialogs it
+            # shows) is processed
+            with LOCK:
+                res = self.handle_key(key)
+            if res is not None and res is not True:
+                return res
+
+    def handle_key(self, key):
+        if isinstance(key, list):
+            x, y = key
+            if self.menu_bar.inside(x, y):
+                self.menu_bar.focus = True
+
+        if self.menu_bar.focus:
+            res = self.menu_bar.handle_input(key)
+            if res == ACTION_CANCEL:
+                self.menu_bar.focus = False
+            elif res is not None and res is not True:
+                return self.e.handle_input(res)
+        else:
+            if key == KEY_F9:
+                self.menu_bar.focus = True
+                self.menu_bar.redraw()
+                return
 
-                if res is not None and res is not True:
-                    return res
+            return self.e.handle_input(key)
 
 
 def call_script(script):
@@ -933,41 +863,29 @@ if __name__ == "__main__":
     argp.add_argument("file", help="Input file (binary or disassembly .def)")
     argp.add_argument("--script", action="append", help="Run script from file after loading environment")
     argp.add_argument("--save", action="store_true", help="Save after --script and quit; don't show UI")
+    argp.add_argument("--journal-fsync", choices=("never", "group", "batch"), default="group",
+        help="When to fsync change journal: never, after each command (default), or after each write")
+    argp.add_argument("--lazy", action="store_true", help="Load project areas on first access")
+    argp.add_argument("--prefetch", action="store_true", help="With --lazy, parse project files in background")
+    argp.add_argument("--jobs", type=int, default=1, help="Number of worker processes to use for loading project and initial analysis")
+    argp.add_argument("--load-timings", action="store_true", help="Print per-area project load times")
+    argp.add_argument("--convert-bin", action="store_true", help="Convert text project to binary format")
+    argp.add_argument("--sqlite", action="store_true", help="Store project properties in SQLite database (converts existing project)")
+    argp.add_argument("--no-journal", action="store_true", help="Don't keep change journal (disables undo and crash recovery)")
     args = argp.parse_args()
 
-    # Plugin dirs are relative to the dir where scratchabit.py resides.
-    # sys.path[0] below provide absolute path of this dir, resolved for
-    # symlinks.
-    plugin_dirs = ["plugins", "plugins/cpu", "plugins/loader"]
-    for d in plugin_dirs:
-        sys.path.append(os.path.join(sys.path[0], d))
+    # sys.path[0] provides absolute path of the dir where scratchabit.py
+    # resides, resolved for symlinks.
+    project.add_plugin_dirs(sys.path[0])
     log.basicConfig(filename="scratchabit.log", format='%(asctime)s %(message)s', level=log.DEBUG)
     log.info("Started")
 
-    if args.file.endswith(".def"):
-        parse_disasm_def(args.file)
-        project_name = args.file.rsplit(".", 1)[0]
-    else:
-        import default_plugins
-        for loader_id in default_plugins.loaders:
-            loader = __import__(loader_id)
-            arch_id = loader.detect(args.file)
-            if arch_id:
-                break
-        if not arch_id:
-            print("Error: file '%s' not recognized by default loaders" % args.file)
-            sys.exit(1)
-        if arch_id not in default_plugins.cpus:
-            print("Error: no plugin for CPU '%s' as detected for file '%s'" % (arch_id, args.file))
-            sys.exit(1)
-        load_target_file(loader, args.file)
-        CPU_PLUGIN = __import__(default_plugins.cpus[arch_id])
-        project_name = args.file
-
-    p = CPU_PLUGIN.PROCESSOR_ENTRY()
-    if hasattr(p, "config"):
-        p.config()
-    engine.set_processor(p)
+    try:
+        project_name = project.load_target(args.file)
+        p = project.init_processor()
+    except project.ProjectError as e:
+        print("Error: %s" % e)
+        sys.exit(1)
     if hasattr(p, "help_text"):
         help.set_cpu_help(p.help_text)
     APP.cpu_plugin = p
@@ -976,23 +894,29 @@ if __name__ == "__main__":
     engine.ADDRESS_SPACE.is_loading = True
 
     # Calc various offset based on show_bytes value
-    APP.set_show_bytes(APP.show_bytes)
+    APP.set_show_bytes(project.SHOW_BYTES)
 
     # Strip suffix if any from def filename
-    project_dir = project_name + ".scratchabit"
+    project_dir = project.project_dir(project_name)
 
-    if saveload.save_exists(project_dir):
-        saveload.load_state(project_dir)
-    else:
-        for label, addr in ENTRYPOINTS:
-            if engine.ADDRESS_SPACE.is_exec(addr):
-                engine.add_entrypoint(addr)
-            engine.ADDRESS_SPACE.make_unique_label(addr, label)
-        def _progress(cnt):
-            sys.stdout.write("Performing initial analysis... %d\r" % cnt)
-        engine.analyze(_progress)
+    def _progress(cnt):
+        sys.stdout.write("Performing initial analysis... %d\r" % cnt)
+    if not project.load_or_analyze(project_dir, _progress, lazy=args.lazy, prefetch_areas=args.prefetch,
+                                   jobs=args.jobs, timings=args.load_timings):
         print()
 
+    if args.convert_bin and saveload.project_format(project_dir) == saveload.FORMAT_TEXT:
+        print("Converting project to binary format...")
+        saveload.convert_to_bin(project_dir)
+
+    if args.sqlite and not saveload.uses_db():
+        print("Converting project to SQLite store...")
+        saveload.convert_to_db(project_dir)
+
+    journal_replayed = 0
+    if not args.no_journal:
+        journal_replayed = saveload.open_journal(project_dir, args.journal_fsync)
+
     #engine.print_address_map()
 
     if args.script:
@@ -1008,8 +932,8 @@ if __name__ == "__main__":
         print(addr_stack)
         show_addr = addr_stack.pop()
     else:
-        if ENTRYPOINTS:
-            show_addr = ENTRYPOINTS[0][1]
+        if project.ENTRYPOINTS:
+            show_addr = project.ENTRYPOINTS[0][1]
         else:
             show_addr = engine.ADDRESS_SPACE.min_addr()
 
@@ -1021,7 +945,8 @@ if __name__ == "__main__":
     #sys.exit()
 
     engine.ADDRESS_SPACE.is_loading = False
-    engine.ADDRESS_SPACE.changed = False
+    # Changes replayed from journal aren't saved yet
+    engine.ADDRESS_SPACE.changed = journal_replayed > 0
     Screen.init_tty()
     try:
         Screen.cls()
@@ -1040,9 +965,11 @@ if __name__ == "__main__":
         log.exception("Unhandled exception")
         raise
     finally:
+        ANALYSIS.stop()
         Screen.goto(0, main_screen.screen_size[1])
         Screen.cursor(True)
         Screen.disable_mouse()
         Screen.deinit_tty()
         Screen.wr("\n\n")
         saveload.save_session(project_dir, main_screen.e)
+        saveload.close_journal()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+# Benchmark of AddressSpace per-byte access cost depending on the number
+# of memory areas. Access cost should stay (roughly) the same regardless
+# of area count.
+#
+# Usage: python3 bench/addr2area.py [num_accesses]
+#
+import sys
+import os
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from scratchabit import engine
+
+
+AREA_SIZE = 0x100
+AREA_COUNTS = (1, 10, 100, 1000, 10000)
+
+
+def make_aspace(num_areas):
+    aspace = engine.AddressSpace()
+    # Add areas in non-sorted order, leaving gaps between them
+    starts = [0x10000 + i * AREA_SIZE * 2 for i in range(num_areas)]
+    random.shuffle(starts)
+    for start in starts:
+        aspace.add_area(start, start + AREA_SIZE - 1, {"name": "a%x" % start, "access": "RWX"})
+    return aspace
+
+
+def time_accesses(aspace, addrs):
+    get_byte = aspace.get_byte
+    t = time.perf_counter()
+    for addr in addrs:
+        get_byte(addr)
+    return time.perf_counter() - t
+
+
+def run(num_accesses=200000):
+    res = {}
+    for num_areas in AREA_COUNTS:
+        aspace = make_aspace(num_areas)
+        areas = aspace.get_areas()
+        # Sequential access within an area
+        seq_addrs = [areas[0][engine.START] + i % AREA_SIZE for i in range(num_accesses)]
+        # Alternating access between 2 areas (e.g. code and its literal pool)
+        alt_areas = (areas[0], areas[-1])
+        alt_addrs = [alt_areas[i & 1][engine.START] + i % AREA_SIZE for i in range(num_accesses)]
+        # Random access across all areas
+        rnd_addrs = [random.choice(areas)[engine.START] + random.randrange(AREA_SIZE) for i in range(num_accesses)]
+
+        res[num_areas] = {}
+        for name, addrs in (("seq", seq_addrs), ("alt", alt_addrs), ("random", rnd_addrs)):
+            res[num_areas][name] = time_accesses(aspace, addrs) / num_accesses * 1e9
+    return res
+
+
+def main():
+    num_accesses = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    res = run(num_accesses)
+    print("Per-byte get_byte() cost, ns")
+    print("%8s %10s %10s %10s" % ("areas", "seq", "alt", "random"))
+    for num_areas, r in sorted(res.items()):
+        print("%8d %10.1f %10.1f %10.1f" % (num_areas, r["seq"], r["alt"], r["random"]))
+
+
+if __name__ == "__main__":
+    main()
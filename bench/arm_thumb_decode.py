@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+#
+# Benchmark of ARM Thumb instruction matching (ArmProcessor._find_instr())
+# over a corpus of random halfwords, compared with linear matching over
+# the whole instruction table, and of full decoding (engine.iter_insns())
+# with per-instruction ana() vs batch ana_range(). Also checks that
+# results are the same.
+#
+# Usage: python3 bench/arm_thumb_decode.py [num_insns]
+#
+import sys
+import os
+import io
+import gc
+import time
+import random
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, "plugins/cpu"))
+
+import idaapi
+from scratchabit import engine
+import arm_thumb
+
+
+ADDR = 0x10000
+
+
+# Matching as done before dispatch tables were introduced
+def find_instr_linear(p):
+    op = p._pull_op_byte()
+    op |= p._pull_op_byte() << 8
+    for instr in p.short_insts:
+        if instr.match(op):
+            return instr, op
+    op |= p._pull_op_byte() << 16
+    op |= p._pull_op_byte() << 24
+    for instr in p.long_insts:
+        if instr.match(op):
+            return instr, op
+    return None, op
+
+
+def setup(num_insns):
+    aspace = engine.AddressSpace()
+    engine.ADDRESS_SPACE = aspace
+    idaapi.set_address_space(aspace)
+    # Extra halfword so the last instruction may be 32-bit
+    data = bytes(random.getrandbits(8) for i in range(num_insns * 2 + 2))
+    aspace.add_area(ADDR, ADDR + len(data) - 1, {"name": "code", "access": "RX"})
+    aspace.load_content(io.BytesIO(data), ADDR)
+    p = arm_thumb.PROCESSOR_ENTRY()
+    engine.set_processor(p)
+    return p
+
+
+def run_matcher(p, find, addrs):
+    res = []
+    cmd = p.cmd
+    t = time.perf_counter()
+    for ea in addrs:
+        cmd.ea = ea
+        cmd.size = 0
+        res.append(find()[0])
+    return time.perf_counter() - t, res
+
+
+def op_fields(op):
+    return tuple(sorted((k, v) for k, v in vars(op).items() if k != "n"))
+
+
+# Decode all instructions, in runs of up to 64 bytes, as rendering does
+def run_decode(p, batch, num_insns, repeat=5):
+    ana_range = p.ana_range
+    if not batch:
+        p.ana_range = None
+    best = None
+    for i in range(repeat):
+        engine.ADDRESS_SPACE.insn_cache.clear()
+        res = []
+        # As timeit does, to not depend on objects left by previous runs
+        gc.collect()
+        gc.disable()
+        t = time.perf_counter()
+        for start in range(ADDR, ADDR + num_insns * 2, 64):
+            res.extend(engine.iter_insns(start, start + 64))
+        t = time.perf_counter() - t
+        gc.enable()
+        if best is None or t < best:
+            best = t
+    p.ana_range = ana_range
+    res = [(i.ea, i.size, i.itype, [op_fields(op) for op in i._operands]) for i in res]
+    return best, res
+
+
+def run(num_insns=100000):
+    p = setup(num_insns)
+    p.cmd = engine.Instruction(ADDR)
+    addrs = range(ADDR, ADDR + num_insns * 2, 2)
+    linear_t, linear_res = run_matcher(p, lambda: find_instr_linear(p), addrs)
+    # First pass fills memo of short instructions
+    cold_t, res = run_matcher(p, p._find_instr, addrs)
+    warm_t, res2 = run_matcher(p, p._find_instr, addrs)
+    assert res == linear_res, "dispatch table matching differs from linear"
+    assert res2 == linear_res
+    matched = sum(1 for i in res if i is not None)
+
+    ana_t, ana_res = run_decode(p, False, num_insns)
+    batch_t, batch_res = run_decode(p, True, num_insns)
+    assert ana_res == batch_res, "ana_range() results differ from ana()"
+    return {
+        "matched": matched,
+        "linear": linear_t / num_insns * 1e9,
+        "dispatch_cold": cold_t / num_insns * 1e9,
+        "dispatch_warm": warm_t / num_insns * 1e9,
+        "decoded": len(ana_res),
+        "ana": ana_t / len(ana_res) * 1e9,
+        "ana_range": batch_t / len(ana_res) * 1e9,
+    }
+
+
+def main():
+    num_insns = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(1)
+    res = run(num_insns)
+    print("Per-instruction _find_instr() cost for %d random halfwords (%d matched), ns" % (num_insns, res["matched"]))
+    print("%10s %15s %15s" % ("linear", "dispatch cold", "dispatch warm"))
+    print("%10.1f %15.1f %15.1f" % (res["linear"], res["dispatch_cold"], res["dispatch_warm"]))
+    print("Results match linear matching")
+    print()
+    print("Per-instruction iter_insns() cost for %d decoded instructions, ns" % res["decoded"])
+    print("%10s %15s" % ("ana", "ana_range"))
+    print("%10.1f %15.1f" % (res["ana"], res["ana_range"]))
+    print("Results match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# Benchmark of RangeSet insert-heavy workloads, similar to what
+# Function.add_insn() does during analysis. Per-operation cost should
+# stay (roughly) the same regardless of the number of disjoint ranges.
+#
+# Usage: python3 bench/rangeset.py [num_insns]
+#
+import sys
+import os
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rangeset import RangeSet
+
+
+# Number of instructions per disjoint range (i.e. between gaps)
+RUN_LENGTHS = (1, 4, 32)
+INSN_SIZE = 4
+
+
+def make_insns(num_insns, run_len):
+    insns = []
+    addr = 0
+    for i in range(num_insns):
+        insns.append((addr, addr + INSN_SIZE))
+        addr += INSN_SIZE
+        if (i + 1) % run_len == 0:
+            # Gap, e.g. literal pool or code of another function
+            addr += INSN_SIZE
+    return insns
+
+
+def time_adds(insns):
+    r = RangeSet()
+    t = time.perf_counter()
+    for insn in insns:
+        r.add(insn)
+    return time.perf_counter() - t, r
+
+
+def time_lookups(r, addrs):
+    t = time.perf_counter()
+    for addr in addrs:
+        addr in r
+    return time.perf_counter() - t
+
+
+def run(num_insns=100000):
+    res = {}
+    for run_len in RUN_LENGTHS:
+        insns = make_insns(num_insns, run_len)
+        # Linear flow
+        seq_t, r = time_adds(insns)
+        # Branchy flow, instructions discovered in random order
+        shuffled = insns[:]
+        random.shuffle(shuffled)
+        rnd_t, r2 = time_adds(shuffled)
+        assert r.to_list() == r2.to_list()
+        end = insns[-1][1]
+        addrs = [random.randrange(end) for i in range(num_insns)]
+        lookup_t = time_lookups(r, addrs)
+        res[run_len] = {
+            "ranges": len(r),
+            "seq": seq_t / num_insns * 1e9,
+            "random": rnd_t / num_insns * 1e9,
+            "lookup": lookup_t / num_insns * 1e9,
+        }
+    return res
+
+
+def main():
+    num_insns = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    res = run(num_insns)
+    print("Per-operation RangeSet cost for %d instructions, ns" % num_insns)
+    print("%8s %8s %10s %10s %10s" % ("run_len", "ranges", "seq add", "rnd add", "lookup"))
+    for run_len, r in sorted(res.items()):
+        print("%8d %8d %10.1f %10.1f %10.1f" % (run_len, r["ranges"], r["seq"], r["random"], r["lookup"]))
+
+
+if __name__ == "__main__":
+    main()
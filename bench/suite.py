@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+#
+# Benchmark suite for engine hot paths, with JSON output, to track
+# performance across commits.
+#
+# For each CPU plugin, a synthetic binary of the given size is generated
+# (a chain of functions calling each other, with some branches inside),
+# and the following is measured on it: analysis throughput, latency of
+# rendering a screenful of listing around random addresses, text search
+# (rendering lines and matching them), saving and loading the project,
+# lookup_func() and get_label_list(). Loading of example-elf and analysis
+# of example.bin are measured too. Benchmarks for which a plugin or its
+# dependencies aren't available are reported as skipped.
+#
+# Usage: python3 bench/suite.py [--size 1M] [--cpu arm_thumb] [-o res.json]
+#
+# Results (and meta info, like the git commit) are written to stdout,
+# progress messages to stderr.
+#
+import sys
+import os
+import io
+import time
+import json
+import random
+import shutil
+import struct
+import tempfile
+import platform
+import argparse
+import contextlib
+import subprocess
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BASE_DIR)
+
+import idaapi
+from scratchabit import engine
+from scratchabit import saveload
+from scratchabit import project
+
+
+CPUS = ("arm_thumb", "x86_64_pymsasid")
+SEED = 1
+# Average number of body instructions per synthetic function
+FUNC_INSNS = 24
+# Number of random addresses for per-call latency benchmarks
+NUM_LOOKUPS = 10000
+NUM_RENDERS = 200
+# Number of lines rendered for text search
+SEARCH_LINES = 100000
+SEARCH_STR = "no such text"
+
+
+# Synthetic code generators. Each returns (code, load_addr, entry). Code
+# is a chain of functions, each calling the next one, so the whole binary
+# is reachable from the entry.
+
+def gen_arm_thumb(size, rnd):
+    base = 0x10000
+    body_ops = (
+        (0x1800, 9),   # add/sub reg
+        (0x2000, 11),  # mov/cmp imm
+        (0x4000, 10),  # ALU reg
+        (0x6000, 11),  # str imm
+        (0x6800, 11),  # ldr imm
+        (0x9800, 11),  # ldr sp-rel
+    )
+    out = bytearray()
+    # Leave space for the largest function
+    limit = size - (FUNC_INSNS * 2 + 8) * 2
+    while len(out) < limit:
+        insns = [0xb510]  # push {r4, lr}
+        for i in range(rnd.randrange(FUNC_INSNS // 2, FUNC_INSNS * 3 // 2)):
+            op, bits = rnd.choice(body_ops)
+            insns.append(op | rnd.getrandbits(bits))
+        # cmp r0, #0; bne over the next instruction
+        insns += [0x2800, 0xd100, 0x3001]
+        out += struct.pack("<%dH" % len(insns), *insns)
+        if len(out) + 6 < limit:
+            # bl next function (which starts after pop below, i.e. at
+            # pc + 2, offset is encoded in halfwords)
+            out += struct.pack("<HH", 0xf000, 0xf800 | 1)
+        out += struct.pack("<H", 0xbd10)  # pop {r4, pc}
+    out += bytes(size - len(out))
+    return bytes(out), base, base
+
+
+def gen_x86_64(size, rnd):
+    base = 0x400000
+    body_ops = (
+        b"\x48\x01\xd8",          # add rax, rbx
+        b"\x48\x89\xc3",          # mov rbx, rax
+        b"\x31\xc9",              # xor ecx, ecx
+        b"\x48\x83\xc0\x01",      # add rax, 1
+        b"\x48\x8b\x45\xf8",      # mov rax, [rbp-8]
+        b"\x48\x89\x45\xf0",      # mov [rbp-16], rax
+        b"\x90",                  # nop
+    )
+    out = bytearray()
+    limit = size - (FUNC_INSNS * 2 + 8) * 4
+    while len(out) < limit:
+        out += b"\x55\x48\x89\xe5"  # push rbp; mov rbp, rsp
+        for i in range(rnd.randrange(FUNC_INSNS // 2, FUNC_INSNS * 3 // 2)):
+            out += rnd.choice(body_ops)
+        # cmp rax, 0; jne over the next instruction
+        out += b"\x48\x83\xf8\x00\x75\x02\x31\xc9"
+        if len(out) + 7 < limit:
+            # call next function (which starts after pop/ret below)
+            out += b"\xe8" + struct.pack("<i", 2)
+        out += b"\x5d\xc3"  # pop rbp; ret
+    out += bytes(size - len(out))
+    return bytes(out), base, base
+
+
+GENERATORS = {
+    "arm_thumb": gen_arm_thumb,
+    "x86_64_pymsasid": gen_x86_64,
+}
+
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+
+def parse_size(s):
+    mult = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}.get(s[-1:].upper())
+    if mult:
+        return int(s[:-1]) * mult
+    return int(s, 0)
+
+
+def new_aspace():
+    aspace = engine.AddressSpace()
+    engine.ADDRESS_SPACE = aspace
+    idaapi.set_address_space(aspace)
+    return aspace
+
+
+def setup(cpu, code, addr):
+    aspace = new_aspace()
+    aspace.add_area(addr, addr + len(code) - 1, {"name": "code", "access": "RX"})
+    aspace.load_content(io.BytesIO(code), addr)
+    p = __import__(cpu).PROCESSOR_ENTRY()
+    if hasattr(p, "config"):
+        p.config()
+    engine.set_processor(p)
+    return aspace
+
+
+def count_insns(aspace):
+    is_code = bytes(1 if fl & aspace.CODE else 0 for fl in range(256))
+    return sum(bytes(a.flags).translate(is_code).count(1) for a in aspace.get_areas())
+
+
+def pending_analysis():
+    return engine.analisys_stack_calls or engine.analisys_stack_branches or engine.analisys_stack_returns
+
+
+def run_analyze(entry):
+    t = time.perf_counter()
+    engine.add_entrypoint(entry)
+    engine.ADDRESS_SPACE.make_unique_label(entry, "_ENTRY_")
+    # analyze() processes a limited number of instructions per call
+    engine.analyze()
+    while pending_analysis():
+        engine.analyze()
+    return time.perf_counter() - t
+
+
+def per_call(func, args):
+    t = time.perf_counter()
+    for a in args:
+        func(a)
+    return (time.perf_counter() - t) / len(args)
+
+
+class SearchModel(engine.Model):
+
+    class Found(Exception):
+        pass
+
+    def __init__(self, substr):
+        super().__init__()
+        self.search = substr
+        self.cnt = 0
+
+    # Same as TextSearchModel in ScratchABit.py
+    def add_line(self, addr, line):
+        super().add_line(addr, line)
+        if line.render().find(self.search) != -1:
+            raise self.Found(addr)
+        self.cnt += 1
+        self._lines = []
+        self._addr2line = {}
+
+
+def bench_cpu(cpu, size, rnd):
+    res = {"size": size}
+    code, addr, entry = GENERATORS[cpu](size, rnd)
+    aspace = setup(cpu, code, addr)
+    end = addr + len(code)
+
+    dt = run_analyze(entry)
+    insns = count_insns(aspace)
+    res["analyze"] = {
+        "time": dt,
+        "insns": insns,
+        "functions": len(aspace.get_func_list()),
+        "insns_per_sec": insns / dt,
+    }
+    log("%s: analyzed %d insns in %.2fs" % (cpu, insns, dt))
+
+    # Rendering starts at a unit start, as when going to an address in UI
+    addrs = [aspace.adjust_addr_reverse(rnd.randrange(addr, end)) for i in range(NUM_RENDERS)]
+    res["render_partial_around"] = {
+        "calls": NUM_RENDERS,
+        "ms_per_call": per_call(lambda a: engine.render_partial_around(a, 0, 50), addrs) * 1e3,
+    }
+
+    model = SearchModel(SEARCH_STR)
+    t = time.perf_counter()
+    engine.render_from(model, addr, SEARCH_LINES)
+    dt = time.perf_counter() - t
+    res["text_search"] = {"lines": model.cnt, "time": dt, "lines_per_sec": model.cnt / dt}
+
+    addrs = [rnd.randrange(addr, end) for i in range(NUM_LOOKUPS)]
+    res["lookup_func"] = {
+        "calls": NUM_LOOKUPS,
+        "us_per_call": per_call(aspace.lookup_func, addrs) * 1e6,
+    }
+
+    t = time.perf_counter()
+    labels = aspace.get_label_list()
+    res["get_label_list"] = {"labels": len(labels), "time": time.perf_counter() - t}
+
+    proj_dir = tempfile.mkdtemp(prefix="sab-bench-")
+    try:
+        t = time.perf_counter()
+        saveload.save_state(proj_dir)
+        save_t = time.perf_counter() - t
+        disk = sum(os.path.getsize(os.path.join(proj_dir, f)) for f in os.listdir(proj_dir))
+        aspace = setup(cpu, code, addr)
+        t = time.perf_counter()
+        saveload.load_state(proj_dir)
+        load_t = time.perf_counter() - t
+        res["save_state"] = {"time": save_t, "bytes": disk}
+        res["load_state"] = {"time": load_t}
+        assert count_insns(aspace) == insns
+    finally:
+        shutil.rmtree(proj_dir)
+    return res
+
+
+def bench_elf_load(fname, repeat=5):
+    import elf
+    times = []
+    for i in range(repeat):
+        aspace = new_aspace()
+        t = time.perf_counter()
+        elf.load(aspace, fname)
+        times.append(time.perf_counter() - t)
+    return {"file": os.path.basename(fname), "time": min(times)}
+
+
+def bench_example_bin():
+    code = open(os.path.join(BASE_DIR, "example.bin"), "rb").read()
+    # Same as example.def
+    code += bytes(0x1000 - len(code))
+    setup("x86_64_pymsasid", code, 0x600000)
+    dt = run_analyze(0x600000)
+    insns = count_insns(engine.ADDRESS_SPACE)
+    return {"time": dt, "insns": insns}
+
+
+def run_bench(results, name, func, *args):
+    log("Running %s" % name)
+    try:
+        results[name] = func(*args)
+    except ImportError as e:
+        results[name] = {"skipped": "%s: %s" % (type(e).__name__, e)}
+        log("Skipped %s: %s" % (name, e))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BASE_DIR,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    argp = argparse.ArgumentParser(description="ScratchABit engine benchmark suite")
+    argp.add_argument("--size", default="1M", help="Size of synthetic binaries, e.g. 512K, 64M (default: 1M)")
+    argp.add_argument("--cpu", action="append", help="CPU plugin to benchmark (default: %s)" % ", ".join(CPUS))
+    argp.add_argument("--seed", type=int, default=SEED, help="Random seed")
+    argp.add_argument("--no-fixtures", action="store_true", help="Don't benchmark example-elf/example.bin")
+    argp.add_argument("-o", "--output", help="Write results to file instead of stdout")
+    args = argp.parse_args()
+
+    project.add_plugin_dirs(BASE_DIR)
+    size = parse_size(args.size)
+    res = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "size": size,
+            "seed": args.seed,
+        },
+        "cpus": {},
+    }
+
+    with contextlib.redirect_stdout(sys.stderr):
+        for cpu in args.cpu or CPUS:
+            run_bench(res["cpus"], cpu, bench_cpu, cpu, size, random.Random(args.seed))
+        if not args.no_fixtures:
+            run_bench(res, "elf_load", bench_elf_load, os.path.join(BASE_DIR, "example-elf"))
+            run_bench(res, "example_bin", bench_example_bin)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(res, f, indent=1)
+            f.write("\n")
+    else:
+        json.dump(res, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
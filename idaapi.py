@@ -45,6 +45,20 @@ o_phrase = "o_phrase"
 o_displ = "o_displ"
 o_idpspec0 = "o_idpspec0"
 
+# ScratchABit extension: op_t fields, by operand type, stored in compact
+# operand records (see processor_t.ana_range()). Plugins which define
+# their own operand types should add them here.
+OP_RECORD_FIELDS = {
+    o_void: (),
+    o_imm: ("value",),
+    o_reg: ("reg",),
+    o_mem: ("addr",),
+    o_near: ("addr",),
+    o_phrase: ("reg",),
+    o_displ: ("reg", "addr"),
+    o_idpspec0: ("specval",),
+}
+
 class BADADDR: pass
 
 # Processor flags
@@ -162,6 +176,23 @@ class processor_t:
     def __init__(self):
         self.cmd = cmd
 
+    # ScratchABit extension: a processor may optionally implement
+    # ana_range(start, end) method, to decode a run of consecutive
+    # instructions in one call. It returns a list of records for
+    # instructions starting at start and before end, ending before the
+    # first invalid instruction (or one crossing memory area end), and may
+    # end early, e.g. after an instruction which doesn't pass control to
+    # the next one. Each record is a tuple (size, itype, ops, attrs),
+    # where ops is a tuple of operand records as returned by
+    # op_record(), and attrs is None or a dict of additional attributes
+    # to set on cmd. Decoding an instruction from its record should be
+    # equivalent to calling ana() for it.
+
+
+# Return compact record of operand: (type, field values...)
+def op_record(op):
+    return (op.type,) + tuple(getattr(op, f) for f in OP_RECORD_FIELDS[op.type])
+
 
 #
 # Instruction rendition API ("out()" in IDA-speak)
@@ -301,6 +332,13 @@ def get_full_byte(ea):
 def get_full_val(ea, val_sz):
     return ADDRESS_SPACE.get_data(ea, val_sz)
 
+# Extension: return memory area containing ea (or None), for plugins which
+# want to access its contents (area.bytes) directly, without per-byte
+# address lookups. Contents of area are at area.start..area.end inclusive.
+def get_area(ea):
+    off, area = ADDRESS_SPACE.addr2area(ea)
+    return area
+
 def ua_add_cref(opoff, ea, flags):
     ADDRESS_SPACE.analisys_stack_push(ea, flags)
     if flags == fl_JN:
@@ -37,3 +37,23 @@ def GetSegmentAttr(ea, attr):
 # Make filler
 def MakeAlign(ea, cnt, align):
     engine.ADDRESS_SPACE.make_filler(ea, cnt)
+
+
+SEARCH_DOWN = 1
+
+def _find_next(ea, flag, mask, value):
+    assert flag & SEARCH_DOWN, "Only SEARCH_DOWN is supported"
+    ea = engine.ADDRESS_SPACE.next_addr(ea)
+    if ea is not None:
+        ea = engine.ADDRESS_SPACE.find_next_flag(ea, mask, value)
+    if ea is None:
+        return idaapi.BADADDR
+    return ea
+
+# Find next undefined byte
+def FindUnexplored(ea, flag):
+    return _find_next(ea, flag, 0x7f, engine.AddressSpace.UNK)
+
+# Find next instruction
+def FindCode(ea, flag):
+    return _find_next(ea, flag, 0x7f, engine.AddressSpace.CODE)
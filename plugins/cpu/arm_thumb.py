@@ -19,6 +19,7 @@
 from idaapi import *
 
 o_reglist = 'o_reglist'
+OP_RECORD_FIELDS[o_reglist] = ("reglist",)
 
 # If set to 1, use "sp" register name for "a1"
 SPECIAL_NAMES = 1
@@ -318,6 +319,10 @@ class ArmProcessor(processor_t):
         processor_t.__init__(self)
         self._init_instructions()
         self._init_registers()
+        # Used to parse operands in ana_range()
+        self._scratch_cmd = insn_t()
+        # Map from opcode to record (see ana_range())
+        self.record_memo = {}
     
     def _add_instruction(self, instr):
         self.instrs_list.append(instr)
@@ -329,6 +334,7 @@ class ArmProcessor(processor_t):
 
         for o in self.ops:
             instr = Instr(*o)
+            instr.relative = isinstance(instr.fmt, tuple) and any(op.type == Operand.REL for op in instr.fmt)
             self._add_instruction(instr)
             if instr.size == 2:
                 self.short_insts.append(instr)
@@ -347,6 +353,35 @@ class ArmProcessor(processor_t):
             self.instrs_ids[instr.name] = i
             instr.id = i
 
+        self.short_dispatch = self._make_dispatch(self.short_insts)
+        self.long_dispatch = self._make_dispatch(self.long_insts)
+        # Map from halfword to matching short instruction (or None)
+        self.short_memo = {}
+
+    # Instructions are dispatched by these opcode bits (for 32-bit
+    # instructions, of the first halfword), each dispatch table entry
+    # being a list of instructions which may match an opcode with given
+    # value of these bits, in the original order (the first match wins).
+    DISPATCH_SHIFT = 4
+    DISPATCH_BITS = 12
+    DISPATCH_MASK = (1 << DISPATCH_BITS) - 1
+
+    def _make_dispatch(self, instrs):
+        key_mask = self.DISPATCH_MASK
+        table = [[] for i in range(key_mask + 1)]
+        for instr in instrs:
+            fixed = (instr.mask >> self.DISPATCH_SHIFT) & key_mask
+            val = (instr.opcode >> self.DISPATCH_SHIFT) & fixed
+            free = ~fixed & key_mask
+            # Iterate over all values of non-fixed bits
+            sub = free
+            while True:
+                table[val | sub].append(instr)
+                if not sub:
+                    break
+                sub = (sub - 1) & free
+        return table
+
     def _init_registers(self):
         self.regNames = ["r%d" % d for d in range(16)]
         if SPECIAL_NAMES > 0:
@@ -363,22 +398,37 @@ class ArmProcessor(processor_t):
         self.cmd.size += 1
         return byte
 
+    def _match_short(self, op):
+        try:
+            return self.short_memo[op]
+        except KeyError:
+            pass
+        instr = None
+        for i in self.short_dispatch[op >> self.DISPATCH_SHIFT]:
+            if i.match(op):
+                instr = i
+                break
+        self.short_memo[op] = instr
+        return instr
+
+    def _match_long(self, op):
+        for instr in self.long_dispatch[(op >> self.DISPATCH_SHIFT) & self.DISPATCH_MASK]:
+            if instr.match(op):
+                return instr
+        return None
+
     def _find_instr(self):
         op = self._pull_op_byte()
         op |= self._pull_op_byte() << 8
-        
-        for instr in self.short_insts:
-            if instr.match(op):
-                return instr, op
+
+        instr = self._match_short(op)
+        if instr:
+            return instr, op
 
         op |= self._pull_op_byte() << 16
         op |= self._pull_op_byte() << 24
 
-        for instr in self.long_insts:
-            if instr.match(op):
-                return instr, op
-
-        return None, op
+        return self._match_long(op), op
 
     def ana(self):
         instr, op = self._find_instr()
@@ -396,6 +446,57 @@ class ArmProcessor(processor_t):
 
         return self.cmd.size
 
+    RECORD_MEMO_SIZE = 1 << 17
+
+    # Batch decoding, see processor_t. Instruction bytes are read
+    # directly from memory area, and a run ends after an instruction
+    # which stops control flow.
+    def ana_range(self, start, end):
+        recs = []
+        area = get_area(start)
+        if area is None:
+            return recs
+        data = area.bytes
+        size = area.end - area.start + 1
+        off = start - area.start
+        end = min(end, area.end + 1) - area.start
+        cmd = self._scratch_cmd
+        operands = cmd._operands
+        memo = self.record_memo
+        while off < end and off + 2 <= size:
+            op = data[off] | data[off + 1] << 8
+            instr = self._match_short(op)
+            if not instr:
+                if off + 4 > size:
+                    break
+                op |= data[off + 2] << 16 | data[off + 3] << 24
+                instr = self._match_long(op)
+                if not instr:
+                    break
+            rec = memo.get(op)
+            if rec is None:
+                cmd.ea = area.start + off
+                for o in operands:
+                    o.type = o_void
+                instr.parseOperands(operands, op, cmd)
+                ops = []
+                for o in operands:
+                    if o.type == o_void:
+                        break
+                    ops.append(op_record(o))
+                rec = (instr.size, instr.id, tuple(ops), None)
+                # Records of instructions with PC-relative operands
+                # depend on address.
+                if not instr.relative:
+                    if len(memo) >= self.RECORD_MEMO_SIZE:
+                        memo.clear()
+                    memo[op] = rec
+            recs.append(rec)
+            off += instr.size
+            if instr.flags & CF_STOP:
+                break
+        return recs
+
     def emu(self):
         features = self.cmd.get_canon_feature()
         #print('emu', features)
@@ -14,11 +14,15 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging as log
+
 from idaapi import *
 from pymsasid3 import pymsasid
 
 
-class IDAPythonSource(pymsasid.Hook):
+# Source for a decoder created per instruction: source is address of
+# the instruction, bytes are fetched one by one with get_full_byte().
+class IDAPythonByteSource(pymsasid.Hook):
 
     entry_point = 0
 
@@ -33,18 +37,121 @@ class IDAPythonSource(pymsasid.Hook):
         return b
 
 
+class IDAPythonSource(pymsasid.Hook):
+
+    # Bytes are fetched from a window on the contents of the memory
+    # area being decoded, which is switched only when decoding moves
+    # to another area.
+
+    entry_point = 0
+
+    def __init__(self, source, base_address):
+        super().__init__(source, base_address)
+        # source is X86Processor, which keeps using this object
+        source.source = self
+        self.area = None
+        self.data = None
+        self.buf = b""
+        self.start = self.end = 0
+        self.pos = 0
+
+    # Position at ea for decoding next instruction
+    def seek_ea(self, ea):
+        pos = ea - self.start
+        # Area contents may be replaced (e.g. by mmap'ed file on load)
+        if not 0 <= pos < self.end or self.area.bytes is not self.data:
+            self.set_window(ea)
+            pos = ea - self.start
+        self.pos = pos
+
+    def set_window(self, ea):
+        self.area = area = get_area(ea)
+        if area is None:
+            # hook() will fall back to get_full_byte(), which will
+            # report invalid address.
+            self.data = None
+            self.buf = b""
+            self.start = ea
+            self.end = 0
+            return
+        self.data = area.bytes
+        self.buf = memoryview(self.data)
+        self.start = area.start
+        self.end = area.end - area.start + 1
+
+    def hook(self):
+        pos = self.pos
+        self.pos = pos + 1
+        if pos < self.end:
+            return self.buf[pos]
+        # Instruction crosses area end
+        return get_full_byte(self.start + pos)
+
+
 class X86Processor(processor_t):
 
+    # Number of first instructions decoded by the reused decoder which
+    # are cross-checked against a fresh per-instruction decoder.
+    VERIFY_INSNS = 256
+
     def __init__(self, bitness):
         super().__init__()
         self.bitness = bitness
+        # Decoder is created once and reused, its IDAPythonSource hook
+        # sets self.source. This relies on pymsasid internals, so if that
+        # doesn't work out, or the reused decoder is ever caught giving
+        # different results, fall back to a decoder per instruction.
+        self.source = None
+        self.dis = None
+        self.verify = self.VERIFY_INSNS
+        try:
+            dis = pymsasid.Pymsasid(source=self, hook=IDAPythonSource)
+        except Exception as e:
+            log.warning("x86: can't reuse pymsasid decoder (%r), using decoder per instruction", e)
+        else:
+            if self.source is None:
+                log.warning("x86: pymsasid didn't create source hook, using decoder per instruction")
+            else:
+                dis.dis_mode = bitness
+                self.dis = dis
 
-    def ana(self):
-        #print("ana: %x" % self.cmd.ea)
-        dis = pymsasid.Pymsasid(source=self.cmd.ea, hook=IDAPythonSource)
+    def decode_fresh(self, ea):
+        dis = pymsasid.Pymsasid(source=ea, hook=IDAPythonByteSource)
         dis.dis_mode = self.bitness
+        return dis.decode()
+
+    def decode_reused(self, ea):
+        source = self.source
+        source.seek_ea(ea)
+        start_pos = source.pos
+        # Decoder's pc isn't used (jump targets are computed from
+        # self.cmd.ea below), keep it at 0 as for a fresh decoder.
+        self.dis.pc = 0
+        inst = self.dis.decode()
+        # Decoder must have fetched all bytes of this instruction from
+        # our source, and not e.g. reused its own buffered input.
+        if source.pos - start_pos < inst.size:
+            return None
+        if self.verify:
+            self.verify -= 1
+            if self.insn_key(self.decode_fresh(ea)) != self.insn_key(inst):
+                return None
+        return inst
+
+    @staticmethod
+    def insn_key(inst):
+        return (inst.size, inst.operator, [(op.type, str(op)) for op in inst.operand])
 
-        inst = dis.decode()
+    def ana(self):
+        #print("ana: %x" % self.cmd.ea)
+        inst = None
+        if self.dis is not None:
+            inst = self.decode_reused(self.cmd.ea)
+            if inst is None:
+                log.warning("x86: reused pymsasid decoder mis-decoded 0x%x, using decoder per instruction", self.cmd.ea)
+                self.dis = None
+        if inst is None:
+            inst = self.decode_fresh(self.cmd.ea)
         #print(inst, inst.operand)
 
         # Reset operands in a static cmd object
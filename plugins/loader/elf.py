@@ -401,10 +401,7 @@ def load_sections(aspace, elffile):
                     if size:
                         aspace.make_data_array(start, 1, size, prefix="xtensa: ")
             if flags & XTENSA_PROP_LITERAL:
-                while size:
-                    aspace.make_data(start, wordsz)
-                    start += 4
-                    size -= 4
+                aspace.make_data_units(start, wordsz, size // wordsz)
 
     load_xt_prop(elffile, symtab)
 
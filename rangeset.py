@@ -1,61 +1,111 @@
-# Supports operations only on non-overlapping, adjucent or fully contained ranges
-# i.e. unioning (10, 30) and (20, 40) may not work
+import bisect
+
+
+# Set of half-open (start, end) ranges. Overlapping or adjacent ranges
+# are coalesced on addition. Ranges are stored as parallel sorted lists
+# of starts and ends, so all operations are binary searches (plus list
+# slice updates).
 class RangeSet:
 
     def __init__(self):
-        self.r = []
-
-    @staticmethod
-    def _contained(r1, r2):
-        return r1[1] <= r2[1]
+        self.starts = []
+        self.ends = []
 
     def add(self, r):
-        last = len(self.r) - 1
-        for i, t in enumerate(self.r):
-            if r[0] == t[1]:
-                new = (t[0], r[1])
-                if i != last and new[1] == self.r[i + 1][0]:
-                    self.r[i] = (new[0], self.r[i + 1][1])
-                    del self.r[i + 1]
-                else:
-                    self.r[i] = new
-                return
-            elif r[1] == t[0]:
-                new = (r[0], t[1])
-                if i != 0 and new[0] == self.r[i - 1][1]:
-                    self.r[i] = (self.r[i - 1][0], new[1])
-                    del self.r[i - 1]
-                else:
-                    self.r[i] = new
-                return
-            elif r[0] < t[0]:
-                if i > 0:
-                    if self._contained(r, self.r[i - 1]):
-                        return
-                self.r.insert(i, r)
-                return
-        if last >= 0 and self._contained(r, self.r[-1]):
+        start, end = r
+        if start >= end:
+            return
+        starts = self.starts
+        ends = self.ends
+        # First range which ends at or after new start
+        i = bisect.bisect_left(ends, start)
+        # Past the last range which starts at or before new end
+        j = bisect.bisect_right(starts, end, i)
+        if i == j:
+            starts.insert(i, start)
+            ends.insert(i, end)
             return
-        self.r.append(r)
+        starts[i:j] = [min(start, starts[i])]
+        ends[i:j] = [max(end, ends[j - 1])]
+
+    def remove(self, r):
+        start, end = r
+        if start >= end:
+            return
+        starts = self.starts
+        ends = self.ends
+        # First range which ends after start
+        i = bisect.bisect_right(ends, start)
+        # Past the last range which starts before end
+        j = bisect.bisect_left(starts, end, i)
+        if i == j:
+            return
+        new_starts = []
+        new_ends = []
+        if starts[i] < start:
+            new_starts.append(starts[i])
+            new_ends.append(start)
+        if ends[j - 1] > end:
+            new_starts.append(end)
+            new_ends.append(ends[j - 1])
+        starts[i:j] = new_starts
+        ends[i:j] = new_ends
+
+    # Return range containing addr, or None
+    def find(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr < self.ends[i]:
+            return (self.starts[i], self.ends[i])
+        return None
+
+    def __contains__(self, addr):
+        return self.find(addr) is not None
+
+    # Check whether range r is fully contained in the set
+    def contains(self, r):
+        start, end = r
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and end <= self.ends[i]
+
+    # Return list of subranges of r not contained in the set
+    def uncovered(self, r):
+        start, end = r
+        starts = self.starts
+        ends = self.ends
+        i = bisect.bisect_right(ends, start)
+        res = []
+        while start < end:
+            if i == len(starts) or starts[i] >= end:
+                res.append((start, end))
+                break
+            if starts[i] > start:
+                res.append((start, starts[i]))
+            start = ends[i]
+            i += 1
+        return res
 
     def bounds(self):
-        if self.r:
-            return (self.r[0][0], self.r[-1][1])
+        if self.starts:
+            return (self.starts[0], self.ends[-1])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return bool(self.starts)
 
     def __str__(self):
-        return str(self.r)
+        return str(self.to_list())
 
     def str(self, render=lambda x: str(x)):
-        rlist = [(render(x[0]), render(x[1])) for x in self.r]
+        rlist = [(render(x[0]), render(x[1])) for x in self]
         return str(rlist)
 
-    # This allows to apply list(), but this creates a copy, using
-    # to_list() is more efficient.
     def __iter__(self):
-        return iter(self.r)
+        return zip(self.starts, self.ends)
 
     def to_list(self):
-        return self.r
+        return list(zip(self.starts, self.ends))
 
 
 if __name__ == "__main__":
@@ -83,8 +133,7 @@ if __name__ == "__main__":
     r = RangeSet()
     r.add((10, 30))
     r.add((20, 40))
-    #assert r.to_list() == [(10, 40)]
-    print(list(r))
+    assert r.to_list() == [(10, 40)]
 
     r = RangeSet()
     r.add((30, 40))
@@ -96,3 +145,56 @@ if __name__ == "__main__":
     r.add((10, 20))
     r.add((1, 10))
     assert r.to_list() == [(1, 20)]
+
+    # Range overlapping several existing ones
+    r = RangeSet()
+    r.add((10, 20))
+    r.add((30, 40))
+    r.add((50, 60))
+    r.add((15, 55))
+    assert r.to_list() == [(10, 60)]
+    r.add((0, 100))
+    assert r.to_list() == [(0, 100)]
+
+    # Queries
+    r = RangeSet()
+    assert not r and len(r) == 0 and r.bounds() is None
+    r.add((10, 20))
+    r.add((30, 40))
+    assert r and len(r) == 2
+    assert r.find(9) is None
+    assert r.find(10) == (10, 20)
+    assert r.find(19) == (10, 20)
+    assert r.find(20) is None
+    assert 35 in r and 25 not in r
+    assert r.contains((10, 20)) and r.contains((32, 35))
+    assert not r.contains((15, 35)) and not r.contains((5, 15))
+
+    # Removal
+    r = RangeSet()
+    r.add((10, 20))
+    r.add((30, 40))
+    r.remove((0, 5))
+    assert r.to_list() == [(10, 20), (30, 40)]
+    r.remove((20, 30))
+    assert r.to_list() == [(10, 20), (30, 40)]
+    r.remove((12, 15))
+    assert r.to_list() == [(10, 12), (15, 20), (30, 40)]
+    r.remove((18, 35))
+    assert r.to_list() == [(10, 12), (15, 18), (35, 40)]
+    r.remove((10, 12))
+    assert r.to_list() == [(15, 18), (35, 40)]
+    r.remove((0, 100))
+    assert r.to_list() == []
+
+    # Uncovered subranges
+    r = RangeSet()
+    assert r.uncovered((10, 20)) == [(10, 20)]
+    r.add((10, 20))
+    r.add((30, 40))
+    assert r.uncovered((12, 18)) == []
+    assert r.uncovered((10, 20)) == []
+    assert r.uncovered((0, 10)) == [(0, 10)]
+    assert r.uncovered((5, 15)) == [(5, 10)]
+    assert r.uncovered((15, 35)) == [(20, 30)]
+    assert r.uncovered((0, 50)) == [(0, 10), (20, 30), (40, 50)]
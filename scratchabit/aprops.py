@@ -0,0 +1,62 @@
+# Binary format of address properties files (project.aprops.*.bin).
+#
+# File starts with MAGIC, followed by batches of records. Each batch is
+# a little-endian u32 length, followed by marshal'ed list of records.
+# Records are as produced by AddressSpace.iter_prop_records():
+# (addr, label, comm, args, func, xrefs).
+
+import marshal
+import struct
+
+
+MAGIC = b"SABAPRP1"
+# Records per batch
+BATCH_SIZE = 4096
+# Fixed marshal version, for files to be portable across Python versions
+MARSHAL_VERSION = 4
+
+_len = struct.Struct("<I")
+
+
+class FormatError(Exception):
+    pass
+
+
+class Writer:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.batch = []
+        stream.write(MAGIC)
+
+    def add(self, rec):
+        self.batch.append(rec)
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def add_all(self, recs):
+        for rec in recs:
+            self.add(rec)
+
+    def flush(self):
+        if self.batch:
+            data = marshal.dumps(self.batch, MARSHAL_VERSION)
+            self.stream.write(_len.pack(len(data)) + data)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+
+
+def iter_records(stream):
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise FormatError("%s: not an address properties file" % stream.name)
+    while True:
+        l = stream.read(_len.size)
+        if not l:
+            break
+        sz, = _len.unpack(l)
+        data = stream.read(sz)
+        if len(data) != sz:
+            raise FormatError("%s: truncated" % stream.name)
+        yield from marshal.loads(data)
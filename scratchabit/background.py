@@ -0,0 +1,119 @@
+# Running analysis in a background thread, while UI stays responsive.
+#
+# Concurrency model: all access to ADDRESS_SPACE and analysis state
+# (worklists in engine) is done with LOCK held. The analysis thread holds
+# it while running engine.analyze(), except between batches of
+# instructions (engine.analyze() calls its callback each 1000 of them),
+# when it lets other threads in. The UI holds it while processing a
+# command, and releases while waiting for input. So, UI sees analysis
+# results applied by whole batches, and never in the middle of an
+# instruction, while analysis never sees half-done UI command.
+#
+# While analysis runs, UI commands may add more entrypoints (they're
+# picked up by the running analysis), but shouldn't run analysis
+# themselves. Analysis can be cancelled, in which case the function
+# being analyzed is finished with what was traced so far, and pending
+# work is dropped.
+#
+# All changes made by a background analysis run form one undo group,
+# separate from groups of UI commands executed meanwhile.
+
+import threading
+import time
+import logging as log
+
+from . import engine
+
+
+LOCK = threading.RLock()
+
+# Time to sleep between batches with LOCK released, to let UI thread
+# acquire it (threading locks aren't fair).
+YIELD_TIME = 0.001
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+class BackgroundAnalysis:
+
+    def __init__(self):
+        self.thread = None
+        # All below are accessed with LOCK held
+        self.running = False
+        self.cancelled = False
+        # Number of instructions analyzed so far
+        self.cnt = 0
+        # Set when analysis finished, until UI shows that
+        self.finished = False
+        self.error = None
+
+    # Start analysis of pending entrypoints (see engine.add_entrypoint())
+    # unless it's already running, then they will be processed by it.
+    def start(self):
+        with LOCK:
+            if self.running:
+                return False
+            self.running = True
+            self.cancelled = False
+            self.finished = False
+            self.error = None
+            self.cnt = 0
+            self.thread = threading.Thread(target=self.run, name="analysis", daemon=True)
+            self.thread.start()
+            return True
+
+    def cancel(self):
+        with LOCK:
+            if not self.running:
+                return False
+            self.cancelled = True
+            return True
+
+    # Cancel analysis and wait for the thread to finish. Should be called
+    # without LOCK held.
+    def stop(self):
+        self.cancel()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        with LOCK:
+            base = 0
+            try:
+                while engine.analisys_stack_calls or engine.analisys_stack_branches \
+                        or engine.analisys_stack_returns:
+                    engine.analyze(lambda cnt: self.batch(base + cnt))
+                    base = self.cnt
+            except AnalysisCancelled:
+                log.info("Analysis cancelled after %d instructions", self.cnt)
+                engine.stop_analysis()
+            except Exception as e:
+                log.exception("Exception in background analysis")
+                engine.stop_analysis()
+                self.error = e
+            journal = engine.ADDRESS_SPACE.journal
+            if journal is not None:
+                journal.end_group()
+            self.running = False
+            self.finished = True
+
+    # Called by engine.analyze() each batch of instructions
+    def batch(self, cnt):
+        self.cnt = cnt
+        journal = engine.ADDRESS_SPACE.journal
+        group = None
+        if journal is not None:
+            group = journal.suspend_group()
+        LOCK.release()
+        time.sleep(YIELD_TIME)
+        LOCK.acquire()
+        if journal is not None:
+            journal.resume_group(group)
+        if self.cancelled:
+            raise AnalysisCancelled
+
+
+ANALYSIS = BackgroundAnalysis()
@@ -0,0 +1,201 @@
+# ScratchABit - interactive disassembler
+#
+# Copyright (c) 2015 Paul Sokolovsky
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Headless batch mode: load a target (and its project, if saved before),
+# analyze, run scripts, save, and optionally export listing, function
+# list and xrefs. Progress messages go to stderr, while a JSON report with
+# stage timings and statistics is written to stdout (or file given by
+# --report). Exit code is 0 on success, and 1 if any stage failed (the
+# report is written in this case too, with "error" and "stage" keys).
+#
+# Usage: python3 -m scratchabit.batch [options] <file.def|binary>
+
+import sys
+import os
+import time
+import json
+import argparse
+import contextlib
+import traceback
+import logging as log
+
+from . import engine
+from . import saveload
+from . import project
+from . import listing
+from . import profiler
+
+
+# Minimal replacement of UI application object for scripts/plugins
+class BatchApp:
+
+    is_ui = False
+
+    def __init__(self, cpu_plugin):
+        self.cpu_plugin = cpu_plugin
+        self.aspace = engine.ADDRESS_SPACE
+        self.show_bytes = project.SHOW_BYTES
+
+
+def call_script(app, script):
+    mod = __import__(script)
+    main_f = getattr(mod, "main", None)
+    if main_f:
+        main_f(app)
+
+
+def write_output(fname, writer):
+    with open(fname, "w") as f:
+        return writer(f)
+
+
+def get_stats():
+    AS = engine.ADDRESS_SPACE
+    AS.load_all_areas()
+    # Map flags of instruction start bytes to 1, everything else to 0
+    is_code = bytes(1 if fl & AS.CODE else 0 for fl in range(256))
+    code = 0
+    for area in AS.get_areas():
+        code += bytes(area.flags).translate(is_code).count(1)
+    return {
+        "areas": len(AS.get_areas()),
+        "bytes": sum(len(a.bytes) for a in AS.get_areas()),
+        "insns": code,
+        "functions": sum(1 for _ in AS.iter_funcs()),
+        "labels": len(AS.get_label_list()),
+        "issues": len(AS.issues),
+    }
+
+
+def run(args, report):
+    timings = report["timings"]
+    report["stage"] = "load"
+    t = time.time()
+    project_name = project.load_target(args.file)
+    p = project.init_processor()
+    proj_dir = args.project or project.project_dir(project_name)
+    report["project"] = proj_dir
+    engine.ADDRESS_SPACE.is_loading = True
+    loaded = False
+    if saveload.save_exists(proj_dir):
+        saveload.load_state(proj_dir, jobs=args.jobs)
+        loaded = True
+    timings["load"] = time.time() - t
+
+    if args.profile:
+        profiler.enable()
+
+    if not loaded or args.reanalyze:
+        report["stage"] = "analyze"
+        t = time.time()
+        project.analyze_entrypoints(jobs=args.jobs)
+        timings["analyze"] = time.time() - t
+
+    if args.script:
+        report["stage"] = "scripts"
+        t = time.time()
+        app = BatchApp(p)
+        for script in args.script:
+            call_script(app, script)
+        timings["scripts"] = time.time() - t
+    engine.ADDRESS_SPACE.is_loading = False
+    if args.profile:
+        report["profile"] = profiler.report()
+        profiler.disable()
+
+    if not args.no_save:
+        report["stage"] = "save"
+        t = time.time()
+        if args.convert_bin and saveload.project_format(proj_dir) == saveload.FORMAT_TEXT:
+            saveload.convert_to_bin(proj_dir)
+        if args.sqlite and not saveload.uses_db():
+            saveload.convert_to_db(proj_dir)
+        report["files_saved"] = saveload.save_state(proj_dir)
+        timings["save"] = time.time() - t
+
+    report["stage"] = "export"
+    t = time.time()
+    if args.listing:
+        report["listing_lines"] = write_output(args.listing, listing.write_listing)
+    if args.funcs:
+        write_output(args.funcs, listing.write_func_list)
+    if args.xrefs:
+        write_output(args.xrefs, listing.write_xrefs)
+    if args.export_text:
+        saveload.export_state(args.export_text, saveload.FORMAT_TEXT)
+    timings["export"] = time.time() - t
+
+    report["stage"] = "stats"
+    report["stats"] = get_stats()
+    del report["stage"]
+
+
+def main():
+    argp = argparse.ArgumentParser(prog="python3 -m scratchabit.batch",
+        description="ScratchABit headless batch analysis")
+    argp.add_argument("file", help="Input file (binary or disassembly .def)")
+    argp.add_argument("--project", help="Project directory (default: <file>.scratchabit)")
+    argp.add_argument("--script", action="append", help="Run script (module name) after analysis")
+    argp.add_argument("--reanalyze", action="store_true", help="Analyze entrypoints even if project was loaded")
+    argp.add_argument("--no-save", action="store_true", help="Don't save project")
+    argp.add_argument("--convert-bin", action="store_true", help="Convert text project to binary format")
+    argp.add_argument("--sqlite", action="store_true", help="Store project properties in SQLite database")
+    argp.add_argument("--jobs", type=int, default=1, help="Number of worker processes to use for loading project and initial analysis")
+    argp.add_argument("--listing", metavar="FILE", help="Write disassembly listing")
+    argp.add_argument("--funcs", metavar="FILE", help="Write function list")
+    argp.add_argument("--xrefs", metavar="FILE", help="Write cross-references")
+    argp.add_argument("--export-text", metavar="DIR", help="Export project in text format to a directory")
+    argp.add_argument("--report", metavar="FILE", default="-", help="Write JSON report to file (default: stdout)")
+    argp.add_argument("--profile", action="store_true", help="Include analysis profile in report")
+    argp.add_argument("--log", metavar="FILE", help="Write debug log to file")
+    argp.add_argument("-q", "--quiet", action="store_true", help="Don't print progress messages")
+    args = argp.parse_args()
+
+    project.add_plugin_dirs()
+    if args.log:
+        log.basicConfig(filename=args.log, format='%(asctime)s %(message)s', level=log.DEBUG)
+    else:
+        log.basicConfig(format='%(message)s', level=log.WARNING)
+
+    report = {"file": args.file, "timings": {}}
+    status = 0
+    t = time.time()
+    # Progress messages printed by various functions shouldn't mix with
+    # the report.
+    out = open(os.devnull, "w") if args.quiet else sys.stderr
+    with contextlib.redirect_stdout(out):
+        try:
+            run(args, report)
+        except Exception as e:
+            traceback.print_exc()
+            report["error"] = "%s: %s" % (type(e).__name__, e)
+            status = 1
+    report["timings"]["total"] = time.time() - t
+    report["status"] = "error" if status else "ok"
+
+    if args.report == "-":
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1)
+            f.write("\n")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
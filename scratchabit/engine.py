@@ -15,11 +15,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
+import os
+import mmap
 import binascii
 import json
+import re
 import bisect
+import collections
+import copy
 import logging as log
 
+from .propstore import PropStore
+from . import aprops
+from . import journal
+
 from rangeset import RangeSet
 
 import idaapi
@@ -40,10 +49,103 @@ from .defs import *
 def str_area(area):
     if not area:
         return "Area(None)"
-    return "Area(0x%x-0x%x, %s)" % (area[START], area[END], area[PROPS])
+    return "Area(0x%x-0x%x, %s)" % (area.start, area.end, area.props)
 
 def area_props(area):
-    return area[PROPS]
+    return area.props
+
+
+class Area:
+    # Memory area. Fields can be also accessed by index, e.g. area[START]
+    # is the same as area.start, as areas used to be tuples.
+
+    __slots__ = ("start", "end", "props", "bytes", "flags", "no", "prev", "next", "units", "dirty", "loader")
+
+    FIELDS = ("start", "end", "props", "bytes", "flags")
+
+    def __init__(self, start, end, props, bytes, flags):
+        self.start = start
+        # Inclusive
+        self.end = end
+        self.props = props
+        self.bytes = bytes
+        self.flags = flags
+        # Ordinal number of area in AddressSpace's area list, and links
+        # to previous/next area in it. Maintained by AddressSpace.
+        self.no = None
+        self.prev = None
+        self.next = None
+        self.units = UnitIndex()
+        # Mask of AddressSpace.DIRTY_* bits, what was changed since last save
+        self.dirty = 0
+        # If not None, a callable to load area's flags and properties on
+        # first access, see AddressSpace.set_area_loader().
+        self.loader = None
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self)[i]
+        return getattr(self, self.FIELDS[i])
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __iter__(self):
+        for f in self.FIELDS:
+            yield getattr(self, f)
+
+    def __repr__(self):
+        return str_area(self)
+
+
+class UnitIndex:
+    # Index of long units (fillers, long strings, etc.) of an area, to
+    # find unit boundaries without scanning flags. This is effectively
+    # a cache: units missing from it are found by scanning flags (and
+    # then added to it), so any change to area flags should invalidate
+    # affected range.
+
+    # Units shorter than this are not worth indexing
+    MIN_SIZE = 64
+
+    def __init__(self):
+        # Parallel sorted lists of unit start and end (exclusive) offsets
+        self.starts = []
+        self.ends = []
+
+    def clear(self):
+        self.starts = []
+        self.ends = []
+
+    # Return (start, end) of indexed unit containing offset, or None
+    def find(self, off):
+        i = bisect.bisect_right(self.starts, off) - 1
+        if i >= 0 and off < self.ends[i]:
+            return (self.starts[i], self.ends[i])
+        return None
+
+    def add(self, start, end):
+        if end - start < self.MIN_SIZE:
+            return
+        i = bisect.bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] == start:
+            self.ends[i] = end
+        else:
+            self.starts.insert(i, start)
+            self.ends.insert(i, end)
+
+    # Remove units overlapping or adjacent to [start, end) range (adjacent,
+    # because e.g. filler may be extended by a change next to it).
+    def invalidate(self, start, end):
+        if not self.starts:
+            return
+        i = bisect.bisect_left(self.starts, start)
+        if i > 0 and self.ends[i - 1] >= start:
+            i -= 1
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            del self.starts[i:j]
+            del self.ends[i:j]
 
 
 class InvalidAddrException(Exception):
@@ -58,13 +160,22 @@ class Function:
         self.ranges = RangeSet()
         self.start = start
         self.end = end
+        # FuncIndex this function is part of, notified of range changes
+        self.index = None
 
     def add_insn(self, addr, sz):
-        self.ranges.add((addr, addr + sz))
+        self.add_range(addr, addr + sz)
 
     def add_range(self, start, end):
+        if self.index is not None:
+            self.index.func_changed(self, start, end)
         self.ranges.add((start, end))
 
+    def remove_range(self, start, end):
+        self.ranges.remove((start, end))
+        if self.index is not None:
+            self.index.func_changed(self)
+
     def get_ranges(self):
         return self.ranges.to_list()
 
@@ -84,6 +195,253 @@ class Function:
             return "as set by loader (detected: %s)" % addr
         return "as detected"
 
+
+# Index of address ranges of all functions, to look up function containing
+# an address. Each function is indexed by its ranges, and if its end is
+# known (e.g. set by loader), also by (start, end). Functions add
+# themselves to "dirty" set when their ranges change, and the index is
+# updated lazily on next lookup.
+#
+# Ranges are kept in fixed-size address buckets: a range is added to each
+# bucket it overlaps, so lookup only needs to check ranges in the bucket
+# of the address, and adding/removing a range touches only the buckets
+# it spans.
+class FuncIndex:
+
+    BUCKET_SHIFT = 12
+
+    def __init__(self):
+        # Map from bucket number to list of (start, end, func) overlapping it
+        self.buckets = {}
+        # Map from function to ranges it's currently indexed by
+        self.func_ranges = {}
+        # Functions to re-index
+        self.dirty = set()
+        # Functions changed since last save
+        self.modified = set()
+        # Journal to record range additions to, see AddressSpace.set_journal()
+        self.journal = None
+
+    def add(self, func):
+        func.index = self
+        self.dirty.add(func)
+
+    # Called by Function when its ranges change. If range being added
+    # is given, called before it's added.
+    def func_changed(self, func, start=None, end=None):
+        self.dirty.add(func)
+        self.modified.add(func)
+        if self.journal is not None and start is not None:
+            added = func.ranges.uncovered((start, end))
+            if added:
+                self.journal.add((journal.RANGES, func.start, added))
+
+    def remove(self, func):
+        self.dirty.discard(func)
+        self._unindex(func)
+        func.index = None
+
+    def _unindex(self, func):
+        buckets = self.buckets
+        for start, end in self.func_ranges.pop(func, ()):
+            for b in range(start >> self.BUCKET_SHIFT, ((end - 1) >> self.BUCKET_SHIFT) + 1):
+                bucket = [ent for ent in buckets[b] if ent[2] is not func]
+                if bucket:
+                    buckets[b] = bucket
+                else:
+                    del buckets[b]
+
+    def _index(self, func):
+        ranges = func.get_ranges()
+        if func.end is not None:
+            ranges.append((func.start, func.end))
+        ranges = [r for r in ranges if r[1] > r[0]]
+        buckets = self.buckets
+        for start, end in ranges:
+            ent = (start, end, func)
+            for b in range(start >> self.BUCKET_SHIFT, ((end - 1) >> self.BUCKET_SHIFT) + 1):
+                bucket = buckets.get(b)
+                if bucket is None:
+                    buckets[b] = [ent]
+                else:
+                    bucket.append(ent)
+        self.func_ranges[func] = ranges
+
+    def update(self):
+        for func in self.dirty:
+            self._unindex(func)
+            self._index(func)
+        self.dirty.clear()
+
+    # Return function containing ea, or None. If there're several such
+    # functions, the one with the closest range start is returned.
+    def lookup(self, ea):
+        if self.dirty:
+            self.update()
+        bucket = self.buckets.get(ea >> self.BUCKET_SHIFT)
+        if not bucket:
+            return None
+        best = None
+        best_start = -1
+        for start, end, func in bucket:
+            if start <= ea < end and start >= best_start:
+                best = func
+                best_start = start
+        return best
+
+
+# LRU cache of decoded instructions (Instruction objects after ana()),
+# keyed by address. Entries are invalidated when bytes or flags they
+# cover change. Cached objects are never handed out: put() takes
+# ownership of an object, and get() returns a fresh copy of it, so
+# consumers (e.g. processor's out()) can modify it freely. Instructions
+# can be also cached as records returned by ana_range() (put_record()),
+# from which a new Instruction is created on each get().
+class DecodeCache:
+
+    # Maximum size of an instruction, to find cached instructions
+    # overlapping a changed address range.
+    MAX_INSN_SIZE = 16
+
+    def __init__(self, size=8192):
+        self.size = size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, ea):
+        ent = self.cache.get(ea)
+        if ent is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(ea)
+        if ent.__class__ is tuple:
+            return insn_from_record(ea, ent)
+        return copy_insn(ent)
+
+    def put(self, ea, insn):
+        cache = self.cache
+        cache[ea] = insn
+        cache.move_to_end(ea)
+        if len(cache) > self.size:
+            cache.popitem(last=False)
+
+    put_record = put
+
+    # Drop instructions overlapping [start, end)
+    def invalidate(self, start, end):
+        cache = self.cache
+        if not cache:
+            return
+        lookback = start - (self.MAX_INSN_SIZE - 1)
+        if end - lookback <= len(cache):
+            eas = range(lookback, end)
+        else:
+            eas = [ea for ea in cache if lookback <= ea < end]
+        for ea in eas:
+            ent = cache.get(ea)
+            if ent is not None:
+                size = ent[0] if ent.__class__ is tuple else ent.size
+                if ea + size > start:
+                    del cache[ea]
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return "decode cache: %d entries, %d/%d hits (%d%%)" % (
+            len(self.cache), self.hits, total, 100 * self.hits // total if total else 0
+        )
+
+
+# Cache of rendered text of disassembly lines (without comments, which
+# are appended on each render). Entries are tagged with generation
+# counter, which is bumped on changes which may affect rendering of any
+# line (e.g. label changes), invalidating all entries at once. Changes
+# to a particular address range (flags, bytes, arg props) invalidate
+# entries of that range directly.
+class RenderCache:
+
+    # Maximum size of a unit whose text is cached, to find entries
+    # overlapping changed address range.
+    MAX_UNIT_SIZE = 16
+    # Each map is flushed when it grows beyond this number of entries
+    MAX_ENTRIES = 0x10000
+
+    def __init__(self):
+        self.gen = 0
+        # Number of entries added in current generation
+        self.num_current = 0
+        # ea -> (gen, size, text, arg_pos) for instructions and data
+        self.units = {}
+        # ea -> (gen, text)
+        self.labels = {}
+        # (from_addr, type) -> (gen, text)
+        self.xrefs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.units) + len(self.labels) + len(self.xrefs)
+
+    # Check whether there're any entries which may be still valid
+    def __bool__(self):
+        return self.num_current != 0
+
+    def get(self, cache, key):
+        ent = cache.get(key)
+        if ent is not None and ent[0] == self.gen:
+            self.hits += 1
+            return ent
+        self.misses += 1
+        return None
+
+    def put(self, cache, key, ent):
+        if len(cache) >= self.MAX_ENTRIES:
+            cache.clear()
+        cache[key] = ent
+        self.num_current += 1
+
+    # Invalidate all entries
+    def bump(self):
+        self.gen += 1
+        self.num_current = 0
+
+    # Invalidate entries for units overlapping [start, end)
+    def invalidate(self, start, end):
+        if not self.num_current:
+            return
+        for cache, lookback in ((self.units, self.MAX_UNIT_SIZE - 1), (self.labels, 0)):
+            if not cache:
+                continue
+            lo = start - lookback
+            if end - lo <= len(cache):
+                eas = range(lo, end)
+            else:
+                eas = [ea for ea in cache if lo <= ea < end]
+            for ea in eas:
+                ent = cache.get(ea)
+                if ent is not None and (ea >= start or ea + ent[1] > start):
+                    del cache[ea]
+
+    def clear(self):
+        self.units.clear()
+        self.labels.clear()
+        self.xrefs.clear()
+        self.num_current = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return "render cache: %d entries, %d/%d hits (%d%%)" % (
+            len(self), self.hits, total, 100 * self.hits // total if total else 0
+        )
+
+
 class AddressSpace:
     UNK = 0
     CODE = 0x01
@@ -94,6 +452,14 @@ class AddressSpace:
     FILL = 0x40  # Filler/alignment bytes
     FUNC = 0x80  # Can appear with CODE, meaning this instruction belongs to a function
 
+    # Area.dirty bits
+    DIRTY_FLAGS = 0x01
+    DIRTY_PROPS = 0x02
+    DIRTY_BYTES = 0x04
+
+    # Number of recently accessed areas to cache in addr2area()
+    AREA_CACHE_SIZE = 4
+
     def __init__(self):
         self.area_list = []
         # List of subareas and bianry search index for it
@@ -112,21 +478,35 @@ class AddressSpace:
         # Cross-reference records
         # "fun_s", "fun_e"
         # Function start and beyond-end addresses, map to Function object
-        self.addr_map = {}
+        # "sym"
+        # Address referenced by instruction, for symbolic rendering
+        # Stored per property kind, see propstore.py.
+        self.props = PropStore()
         # Map from label to its address
         self.labels_rev = {}
         # Problem spots which automatic control/data flow couldn't resolve
         self.issues = {}
+        # Start addresses of areas from area_list, for binary search
+        self.area_starts = []
         # Cached last accessed area
         self.last_area = None
-        # Cached function start addresses
-        self.func_starts = None
-        # Map from func_starts's indexes to function objects
-        self.func_starts_arr = []
+        # Few most recently accessed areas, checked before doing binary
+        # search, as accesses tend to alternate between code and data areas.
+        self.area_cache = collections.deque(maxlen=self.AREA_CACHE_SIZE)
+        # Index of function ranges
+        self.func_index = FuncIndex()
+        # Cache of decoded instructions, see decode()
+        self.insn_cache = DecodeCache()
+        # Cache of rendered lines
+        self.render_cache = RenderCache()
+        # Journal of changes (for undo and crash recovery), see set_journal()
+        self.journal = None
         # True during loading stage, False during UI interaction stage
         self.is_loading = False
         # Was area flags/content changed (and thus require saving)?
         self.changed = False
+        # Number of areas which are not yet loaded, see set_area_loader()
+        self.lazy_areas = 0
 
     # Memory Area API
 
@@ -135,57 +515,120 @@ class AddressSpace:
         sz = end - start + 1
         bytes = bytearray(sz)
         flags = bytearray(sz)
-        a = (start, end, props, bytes, flags)
-        self.area_list.append(a)
-        # Area list should be sorted. Assume it's short and just resort it each time.
-        self.area_list.sort()
+        a = Area(start, end, props, bytes, flags)
+        # Area list should be sorted
+        i = bisect.bisect_right(self.area_starts, start)
+        self.area_list.insert(i, a)
+        self.area_starts.insert(i, start)
+        if i > 0:
+            a.prev = self.area_list[i - 1]
+            a.prev.next = a
+        if i < len(self.area_list) - 1:
+            a.next = self.area_list[i + 1]
+            a.next.prev = a
+        for j in range(i, len(self.area_list)):
+            self.area_list[j].no = j
         return a
 
     def get_areas(self):
         return self.area_list
 
     def area_no(self, area):
-        return self.area_list.index(area)
+        return area.no
 
     def addr2area(self, addr):
         if self.last_area:
             a = self.last_area
-            if a[0] <= addr <= a[1]:
-                return (addr - a[0], a)
-        for a in self.area_list:
-            if a[0] <= addr <= a[1]:
+            if a.start <= addr <= a.end:
+                return (addr - a.start, a)
+        for a in self.area_cache:
+            if a.start <= addr <= a.end:
                 self.last_area = a
-                return (addr - a[0], a)
+                return (addr - a.start, a)
+        i = bisect.bisect_right(self.area_starts, addr)
+        if i:
+            a = self.area_list[i - 1]
+            if addr <= a.end:
+                # Areas are cached only after being loaded
+                if a.loader is not None:
+                    self.ensure_area_loaded(a)
+                self.last_area = a
+                self.area_cache.appendleft(a)
+                return (addr - a.start, a)
         return (None, None)
 
+    # Lazy loading of areas. A project loader may defer loading of area
+    # flags and address properties until the area is accessed. Accesses
+    # by address (addr2area(), address property functions) trigger loading
+    # automatically, while code which walks area list directly should call
+    # ensure_area_loaded(). Functionality which needs to see all labels or
+    # functions calls load_all_areas().
+
+    def set_area_loader(self, area, loader):
+        if area.loader is None:
+            self.lazy_areas += 1
+        area.loader = loader
+        # Area may be already cached
+        self.last_area = None
+        self.area_cache.clear()
+
+    def ensure_area_loaded(self, area):
+        loader = area.loader
+        if loader is None:
+            return
+        area.loader = None
+        self.lazy_areas -= 1
+        # Loading isn't a change, so preserve change tracking state
+        j = self.journal
+        self.set_journal(None)
+        changed = self.changed
+        dirty = [a.dirty for a in self.area_list]
+        modified = set(self.func_index.modified)
+        try:
+            loader()
+        finally:
+            self.set_journal(j)
+            self.changed = changed
+            for a, d in zip(self.area_list, dirty):
+                a.dirty = d
+            self.func_index.modified = modified
+
+    def load_all_areas(self):
+        if self.lazy_areas:
+            for a in self.area_list:
+                self.ensure_area_loaded(a)
+
     def min_addr(self):
-        return self.area_list[0][START]
+        return self.area_list[0].start
 
     def max_addr(self):
-        return self.area_list[-1][END]
+        return self.area_list[-1].end
 
     # Return next address in the address space, or None
     def next_addr(self, addr):
         offset, area = self.addr2area(addr)
-        if addr != area[END]:
+        if addr != area.end:
             return addr + 1
-        i = self.area_no(area) + 1
-        if i == len(self.area_list):
+        if area.next is None:
             return None
-        return self.area_list[i][START]
+        return area.next.start
 
     def is_exec(self, addr):
         off, area = self.addr2area(addr)
         if not area:
             return False
-        return "X" in area[PROPS]["access"]
+        return "X" in area.props["access"]
 
     # Binary Data API
 
     def load_content(self, file, addr, sz=None):
         off, area = self.addr2area(addr)
         to = off + sz if sz else None
-        file.readinto(memoryview(area[BYTES])[off:to])
+        file.readinto(memoryview(area.bytes)[off:to])
+        area.dirty |= self.DIRTY_BYTES
+        end = area.end + 1 if to is None else addr + sz
+        self.insn_cache.invalidate(addr, end)
+        self.render_cache.invalidate(addr, end)
 
     def is_valid_addr(self, addr):
         off, area = self.addr2area(addr)
@@ -195,20 +638,23 @@ class AddressSpace:
         off, area = self.addr2area(addr)
         if area is None:
             raise InvalidAddrException(addr)
-        return area[BYTES][off]
+        return area.bytes[off]
 
     def set_byte(self, addr, val):
         self.changed = True
         off, area = self.addr2area(addr)
         if area is None:
             raise InvalidAddrException(addr)
-        area[BYTES][off] = val & 0xff
+        area.bytes[off] = val & 0xff
+        area.dirty |= self.DIRTY_BYTES
+        self.insn_cache.invalidate(addr, addr + 1)
+        self.render_cache.invalidate(addr, addr + 1)
 
     def get_bytes(self, addr, sz):
         off, area = self.addr2area(addr)
         if area is None:
             raise InvalidAddrException(addr)
-        return area[BYTES][off:off + sz]
+        return area.bytes[off:off + sz]
 
     def get_data(self, addr, sz):
         # TODO: address size
@@ -220,7 +666,7 @@ class AddressSpace:
         off, area = self.addr2area(addr)
         val = 0
         for i in range(sz):
-            val = val | (area[BYTES][off + i] << 8 * i)
+            val = val | (area.bytes[off + i] << 8 * i)
         return val
 
     def set_data(self, addr, data, sz):
@@ -228,8 +674,11 @@ class AddressSpace:
         off, area = self.addr2area(addr)
         val = 0
         for i in range(sz):
-            area[BYTES][off + i] = data & 0xff
+            area.bytes[off + i] = data & 0xff
             data >>= 8
+        area.dirty |= self.DIRTY_BYTES
+        self.insn_cache.invalidate(addr, addr + sz)
+        self.render_cache.invalidate(addr, addr + sz)
 
     # Convenience function for plugins
     def memcpy(self, dst, src, sz):
@@ -245,118 +694,328 @@ class AddressSpace:
         off, area = self.addr2area(addr)
         if area is None:
             raise InvalidAddrException(addr)
-        return area[FLAGS][off] & mask
+        return area.flags[off] & mask
+
+    # Regexes to find first byte not equal to a given flag value
+    _not_flag_re = {}
+
+    @classmethod
+    def scan_run(cls, flags, off, f):
+        # Return offset of first byte at or after off which is not equal
+        # to f (or len(flags) if there's none).
+        r = cls._not_flag_re.get(f)
+        if r is None:
+            r = re.compile(b"[^" + re.escape(bytes([f])) + b"]")
+            cls._not_flag_re[f] = r
+        m = r.search(flags, off)
+        if m is None:
+            return len(flags)
+        return m.start()
+
+    @classmethod
+    def rscan_run(cls, flags, off, values):
+        # Return offset of last byte at or before off which is not one
+        # of values (or -1 if there's none).
+        table = cls.flag_match_table(0xff, values)
+        chunk_sz = 256
+        hi = off + 1
+        while hi > 0:
+            lo = max(0, hi - chunk_sz)
+            i = flags[lo:hi].translate(table).rfind(b"\0")
+            if i != -1:
+                return lo + i
+            hi = lo
+            chunk_sz *= 2
+        return -1
 
     def get_unit_size(self, addr):
         off, area = self.addr2area(addr)
-        flags = area[FLAGS]
-        sz = 1
-        if flags[off] & 0x7f == self.CODE:
+        flags = area.flags
+        fl = flags[off]
+        if fl & 0x7f == self.CODE:
             f = self.CODE_CONT
-        elif flags[off] in (self.DATA, self.STR):
+        elif fl in (self.DATA, self.STR):
             f = self.DATA_CONT
-        elif flags[off] == self.FILL:
+        elif fl == self.FILL:
             f = self.FILL
         else:
             return 1
-        off += 1
 
-        try:
-            while flags[off] == f:
-                off += 1
-                sz += 1
-        except IndexError:
-            pass
+        unit = area.units.find(off)
+        if unit:
+            return unit[1] - off
 
-        return sz
+        end = self.scan_run(flags, off + 1, f)
+        # For filler, index only complete runs
+        if f != self.FILL or off == 0 or flags[off - 1] != self.FILL:
+            area.units.add(off, end)
+        return end - off
 
 
     # Taking an offset inside unit, return offset to the beginning of unit
     @classmethod
     def adjust_offset_reverse(cls, off, area):
-        flags = area[FLAGS]
-        if flags[off] == cls.FILL:
-            while off > 0:
-                if flags[off] != cls.FILL:
-                    off += 1
-                    break
-                off -= 1
-            return off
-
-        while off > 0:
-            if flags[off] in (cls.CODE_CONT, cls.DATA_CONT):
-                off -= 1
-            else:
-                break
+        flags = area.flags
+        fl = flags[off]
+        if fl == cls.FILL:
+            unit = area.units.find(off)
+            if unit:
+                return unit[0]
+            return cls.rscan_run(flags, off, (cls.FILL,)) + 1
+
+        if fl in (cls.CODE_CONT, cls.DATA_CONT):
+            unit = area.units.find(off)
+            if unit:
+                return unit[0]
+            off = cls.rscan_run(flags, off, (cls.CODE_CONT, cls.DATA_CONT))
+            if off < 0:
+                off = 0
         return off
 
     def adjust_addr_reverse(self, addr):
         off, area = self.addr2area(addr)
         if area is None:
             return None
-        return self.adjust_offset_reverse(off, area) + area[START]
+        return self.adjust_offset_reverse(off, area) + area.start
 
-    def set_flags(self, addr, sz, head_fl, rest_fl=0):
-        self.changed = True
+    # Bulk flags operations. Flags are changed by replacing a range
+    # of bytes at once, which must be within a single area. All flags
+    # changes go thru store_flags().
+
+    # Cache of bytes.translate() tables to OR flags with a mask
+    _or_tables = {}
+
+    @classmethod
+    def flag_or_table(cls, mask):
+        table = cls._or_tables.get(mask)
+        if table is None:
+            table = bytes(f | mask for f in range(256))
+            cls._or_tables[mask] = table
+        return table
+
+    def _flags_range(self, addr, sz):
         off, area = self.addr2area(addr)
-        flags = area[FLAGS]
-        flags[off] = head_fl
-        off += 1
-        for i in range(sz - 1):
-            flags[off + i] = rest_fl
+        if area is None:
+            raise InvalidAddrException(addr)
+        if off + sz > len(area.flags):
+            raise InvalidAddrException(area.end + 1)
+        return off, area
+
+    def get_flags_range(self, addr, sz):
+        off, area = self._flags_range(addr, sz)
+        return area.flags[off:off + sz]
+
+    # Replace flags starting at addr with given bytes
+    def store_flags(self, addr, data):
+        off, area = self._flags_range(addr, len(data))
+        self._store_flags(area, off, data)
+
+    def _store_flags(self, area, off, data):
+        self.changed = True
+        if self.journal is not None:
+            self.journal.add((journal.FLAGS, area.start + off, bytes(area.flags[off:off + len(data)]), bytes(data)))
+        area.dirty |= self.DIRTY_FLAGS
+        area.units.invalidate(off, off + len(data))
+        addr = area.start + off
+        self.insn_cache.invalidate(addr, addr + len(data))
+        if self.render_cache:
+            self._invalidate_render_flags(addr, addr + len(data))
+        area.flags[off:off + len(data)] = data
+
+    # Max size of flags change to check for labels in _invalidate_render_flags()
+    RENDER_FLAGS_CHECK_MAX = 64
+
+    def _invalidate_render_flags(self, start, end):
+        # Default labels depend on flags of their address, and may be
+        # rendered anywhere (e.g. as instruction operands).
+        if end - start > self.RENDER_FLAGS_CHECK_MAX:
+            self.render_cache.bump()
+            return
+        for addr in range(start, end):
+            if self.props.get(addr, "label") is not None:
+                self.render_cache.bump()
+                return
+        self.render_cache.invalidate(start, end)
+
+    # Set flags of all bytes in range to fl
+    def fill_flags(self, addr, sz, fl):
+        off, area = self._flags_range(addr, sz)
+        self._store_flags(area, off, bytes((fl,)) * sz)
+
+    # OR flags of all bytes in range with mask
+    def or_flags(self, addr, sz, mask):
+        off, area = self._flags_range(addr, sz)
+        self._store_flags(area, off, area.flags[off:off + sz].translate(self.flag_or_table(mask)))
+
+    # OR flags in range with a bytes pattern of the same size
+    def or_flags_pattern(self, addr, pattern):
+        sz = len(pattern)
+        off, area = self._flags_range(addr, sz)
+        old = int.from_bytes(area.flags[off:off + sz], "little")
+        new = old | int.from_bytes(pattern, "little")
+        self._store_flags(area, off, new.to_bytes(sz, "little"))
+
+    def set_flags(self, addr, sz, head_fl, rest_fl=0):
+        data = bytes((head_fl,))
+        if sz > 1:
+            data += bytes((rest_fl,)) * (sz - 1)
+        self.store_flags(addr, data)
 
     def make_undefined(self, addr, sz):
-        self.set_flags(addr, sz, self.UNK, self.UNK)
+        self.fill_flags(addr, sz, self.UNK)
+
+    # OR flags of unit of size sz, with head_fl for its first byte and
+    # rest_fl for the rest.
+    def _or_unit_flags(self, addr, sz, head_fl, rest_fl):
+        off, area = self._flags_range(addr, sz)
+        flags = area.flags
+        data = bytearray(flags[off:off + sz].translate(self.flag_or_table(rest_fl)))
+        data[0] = flags[off] | head_fl
+        self._store_flags(area, off, data)
 
     def make_code(self, addr, sz, extra_flags=0):
-        self.changed = True
-        off, area = self.addr2area(addr)
-        area_byte_flags = area[FLAGS]
-        area_byte_flags[off] |= self.CODE | extra_flags
-        for i in range(sz - 1):
-            area_byte_flags[off + 1 + i] |= self.CODE_CONT
+        self._or_unit_flags(addr, sz, self.CODE | extra_flags, self.CODE_CONT)
 
     # Mark instructions in given range as belonging to function
     def mark_func_bytes(self, addr, sz):
-        self.changed = True
-        off, area = self.addr2area(addr)
-        area_byte_flags = area[FLAGS]
-        for i in range(sz):
-            fl = area_byte_flags[off + i]
-            assert fl in (self.CODE, self.CODE_CONT)
-            if fl == self.CODE:
-                area_byte_flags[off + i] |= self.FUNC
+        off, area = self._flags_range(addr, sz)
+        data = area.flags[off:off + sz]
+        assert data.translate(self.flag_match_table(0xff, (self.CODE, self.CODE_CONT))).find(b"\0") == -1
+        self._store_flags(area, off, data.translate(self._func_table))
+
+    # Translation table to mark instruction heads as belonging to function
+    _func_table = bytearray(range(256))
+    _func_table[CODE] = CODE | FUNC
+    _func_table = bytes(_func_table)
 
     def make_data(self, addr, sz):
-        self.changed = True
-        off, area = self.addr2area(addr)
-        area_byte_flags = area[FLAGS]
-        area_byte_flags[off] |= self.DATA
-        for i in range(sz - 1):
-            area_byte_flags[off + 1 + i] |= self.DATA_CONT
+        self._or_unit_flags(addr, sz, self.DATA, self.DATA_CONT)
+
+    # Mark num_items consecutive data units of size sz
+    def make_data_units(self, addr, sz, num_items):
+        if num_items <= 0:
+            return
+        if sz == 1:
+            self.or_flags(addr, num_items, self.DATA)
+        else:
+            unit = bytes((self.DATA,)) + bytes((self.DATA_CONT,)) * (sz - 1)
+            self.or_flags_pattern(addr, unit * num_items)
 
     def make_data_array(self, addr, sz, num_items, prefix=""):
         # Make a data array. First-class arrays are not supported so far,
         # so just mark data units sequentially
         self.append_comment(addr, "%sArray, num %s: %d" % (prefix, "bytes" if sz == 1 else "items", num_items))
-        for i in range(num_items):
-            self.make_data(addr, sz)
-            addr += sz
+        self.make_data_units(addr, sz, num_items)
 
     def make_filler(self, addr, sz):
         self.set_flags(addr, sz, self.FILL, self.FILL)
 
+    # Flags search API
+
+    # Size of flags chunk to process at once when searching
+    FLAG_SEARCH_CHUNK = 0x10000
+
+    # Cache of bytes.translate() tables used for searching
+    _flag_tables = {}
+
+    @classmethod
+    def flag_match_table(cls, mask, values):
+        # Translation table mapping flag byte to 1 if (flag & mask) is
+        # one of values, and to 0 otherwise.
+        key = (mask, values)
+        table = cls._flag_tables.get(key)
+        if table is None:
+            table = bytes(1 if (f & mask) in values else 0 for f in range(256))
+            cls._flag_tables[key] = table
+        return table
+
+    def _find_flags(self, addr, mask, values, needle, end):
+        if isinstance(values, int):
+            values = (values,)
+        table = self.flag_match_table(mask, values)
+        off, area = self.addr2area(addr)
+        if area is None:
+            raise InvalidAddrException(addr)
+        chunk_sz = self.FLAG_SEARCH_CHUNK
+        while area:
+            if end is not None and area.start >= end:
+                break
+            self.ensure_area_loaded(area)
+            flags = area.flags
+            sz = len(flags)
+            if end is not None and end - area.start < sz:
+                sz = end - area.start
+            while off < sz:
+                chunk = flags[off:min(off + chunk_sz, sz)].translate(table)
+                i = chunk.find(needle)
+                if i != -1:
+                    return area.start + off + i
+                off += len(chunk)
+            area = area.next
+            off = 0
+        return None
+
+    # Find first address, starting with addr and up to end (exclusive, if
+    # given), such that (flags & mask) == value. value may be also a tuple
+    # of values to match any of. Search goes across area boundaries.
+    # Returns None if there's no such address.
+    def find_next_flag(self, addr, mask, value, end=None):
+        return self._find_flags(addr, mask, value, b"\x01", end)
+
+    # Same as above, but find address with flags not matching value(s).
+    def find_next_not(self, addr, mask, value, end=None):
+        return self._find_flags(addr, mask, value, b"\x00", end)
+
     # Address properties API
 
+    # Address properties which affect rendering of only their address.
+    # Comments are not cached in rendered text, and xrefs are rendered as
+    # separate lines.
+    LOCAL_RENDER_PROPS = frozenset(("args", "sym"))
+    NO_RENDER_PROPS = frozenset(("comm", "xrefs"))
+    # Properties which are journaled by their own API functions
+    NO_JOURNAL_PROPS = frozenset(("args", "xrefs", "fun_s", "fun_e"))
+
     def set_addr_prop(self, addr, prop, val):
+        if self.lazy_areas:
+            self.addr2area(addr)
+        if self.journal is not None and prop not in self.NO_JOURNAL_PROPS:
+            self.journal.add((journal.PROP, addr, prop, self.props.get(addr, prop), val))
+        self._set_addr_prop(addr, prop, val)
+
+    def _set_addr_prop(self, addr, prop, val):
         self.changed = True
-        self.addr_map.setdefault(addr, {})[prop] = val
+        off, area = self.addr2area(addr)
+        self.props.set(addr, prop, val)
+        if area:
+            area.dirty |= self.DIRTY_PROPS
+        if prop in self.LOCAL_RENDER_PROPS:
+            self.render_cache.invalidate(addr, addr + 1)
+        elif prop not in self.NO_RENDER_PROPS:
+            # Labels, functions, etc. may be rendered at other addresses
+            self.render_cache.bump()
+
+    # Replace property store (e.g. with SqlitePropStore). If store can
+    # look up labels itself, it provides label_index() to be used instead
+    # of in-memory labels_rev.
+    def set_prop_store(self, store):
+        self.props = store
+        if hasattr(store, "label_index"):
+            self.labels_rev = store.label_index()
+        else:
+            self.labels_rev = {label: addr for addr, label in store.iter_prop("label")}
+        self.render_cache.bump()
 
     def get_addr_prop(self, addr, prop, default=None):
-        return self.addr_map.get(addr, {}).get(prop, default)
+        if self.lazy_areas:
+            self.addr2area(addr)
+        return self.props.get(addr, prop, default)
 
+    # Returns read-only dict-like view of address properties
     def get_addr_prop_dict(self, addr):
-        return self.addr_map.get(addr, {})
+        if self.lazy_areas:
+            self.addr2area(addr)
+        return self.props.addr_props(addr)
 
     # Label API
 
@@ -422,6 +1081,7 @@ class AddressSpace:
         self.labels_rev[label] = ea
 
     def make_unique_label(self, ea, label):
+        self.load_all_areas()
         existing = self.get_label(ea)
         if existing == label:
             return label
@@ -438,9 +1098,11 @@ class AddressSpace:
             cnt += 1
 
     def get_label_list(self):
+        self.load_all_areas()
         return sorted([x if isinstance(x, str) else self.get_default_label(x) for x in self.labels_rev.keys()])
 
     def resolve_label(self, label):
+        self.load_all_areas()
         if label in self.labels_rev:
             return self.labels_rev[label]
         try:
@@ -451,6 +1113,7 @@ class AddressSpace:
             return ea
 
     def label_exists(self, label):
+        self.load_all_areas()
         return label in self.labels_rev
 
     # Comment API
@@ -475,8 +1138,10 @@ class AddressSpace:
         if arg_no not in arg_props:
             arg_props[arg_no] = {}
         props = arg_props[arg_no]
+        if self.journal is not None:
+            self.journal.add((journal.ARG, ea, (arg_no, prop), props.get(prop), prop_val))
         props[prop] = prop_val
-        self.set_addr_prop(ea, "args", arg_props)
+        self._set_addr_prop(ea, "args", arg_props)
 
     def get_arg_prop(self, ea, arg_no, prop):
         arg_props = self.get_addr_prop(ea, "args", {})
@@ -527,13 +1192,17 @@ class AddressSpace:
 
     def add_xref(self, from_ea, to_ea, type):
         xrefs = self.get_addr_prop(to_ea, "xrefs", {})
+        if self.journal is not None:
+            self.journal.add((journal.XREF, to_ea, from_ea, xrefs.get(from_ea), type))
         xrefs[from_ea] = type
-        self.set_addr_prop(to_ea, "xrefs", xrefs)
+        self._set_addr_prop(to_ea, "xrefs", xrefs)
 
     def del_xref(self, from_ea, to_ea, type):
         xrefs = self.get_addr_prop(to_ea, "xrefs", {})
+        if self.journal is not None:
+            self.journal.add((journal.XREF, to_ea, from_ea, xrefs[from_ea], None))
         del xrefs[from_ea]
-        self.set_addr_prop(to_ea, "xrefs", xrefs)
+        self._set_addr_prop(to_ea, "xrefs", xrefs)
 
     def get_xrefs(self, ea):
         xrefs = self.get_addr_prop(ea, "xrefs", None)
@@ -545,15 +1214,27 @@ class AddressSpace:
         f = self.get_addr_prop(from_ea, "fun_s")
         if f is not None:
             return f
+        if self.journal is not None:
+            self.journal.add((journal.FUNC, from_ea, to_ea_excl))
         f = Function(from_ea, to_ea_excl)
-        self.set_addr_prop(from_ea, "fun_s", f)
+        self._set_addr_prop(from_ea, "fun_s", f)
 
         if to_ea_excl is not None:
-            self.set_addr_prop(to_ea_excl, "fun_e", f)
-        # Reset cache
-        self.func_starts = None
+            self._set_addr_prop(to_ea_excl, "fun_e", f)
+        self.func_index.add(f)
         return f
 
+    def del_func(self, ea):
+        f = self.get_addr_prop(ea, "fun_s")
+        if f is None:
+            return
+        if self.journal is not None:
+            self.journal.add((journal.FUNC_DEL, ea, f.end))
+        self.func_index.remove(f)
+        self._set_addr_prop(ea, "fun_s", None)
+        if f.end is not None and self.get_addr_prop(f.end, "fun_e") is f:
+            self._set_addr_prop(f.end, "fun_e", None)
+
     def is_func(self, ea):
         return self.get_addr_prop(ea, "fun_s") is not None
 
@@ -566,34 +1247,24 @@ class AddressSpace:
         return self.get_addr_prop(ea, "fun_e")
 
     def set_func_end(self, func, ea):
-        self.set_addr_prop(ea, "fun_e", func)
+        if self.journal is not None:
+            old = self.get_addr_prop(ea, "fun_e")
+            self.journal.add((journal.FUNC_END, ea, old and old.start, func and func.start))
+        self._set_addr_prop(ea, "fun_e", func)
 
     # Look up function containing address
     def lookup_func(self, ea):
-        # TODO: cache func ranges, use binary search instead
-        if self.func_starts is None:
-            self.func_starts = []
-            self.func_starts_arr = []
-            for start, props in sorted(self.addr_map.items()):
-                func = props.get("fun_s")
-                if func:
-                    self.func_starts.append(start)
-                    self.func_starts_arr.append(func)
-
-        i = bisect.bisect_right(self.func_starts, ea)
-        if i:
-            func = self.func_starts_arr[i - 1]
-            end = func.get_end()
-            if end and func.start <= ea < end:
-                return func
-        return None
+        if self.lazy_areas:
+            self.addr2area(ea)
+        if self.func_index.dirty:
+            # Function ranges changed, which affects xref rendering
+            self.render_cache.bump()
+        return self.func_index.lookup(ea)
 
     # Get all functions
     def iter_funcs(self):
-        for addr, props in self.addr_map.items():
-            func = props.get("fun_s")
-            if func:
-                yield (addr, func)
+        self.load_all_areas()
+        return self.props.iter_prop("fun_s")
 
     def get_func_list(self):
         return sorted([self.get_label(addr) for addr, f in self.iter_funcs()])
@@ -630,11 +1301,120 @@ class AddressSpace:
             res.append((ea, self.issues[ea]))
         return res
 
+    # Journal and Undo API
+
+    def set_journal(self, j):
+        self.journal = j
+        self.func_index.journal = j
+
+    # Apply journal records (e.g. to replay, undo or redo changes). Applied
+    # records are logged to journal file, but don't form an undo group.
+    def apply_records(self, recs):
+        j = self.journal
+        self.set_journal(None)
+        try:
+            for rec in recs:
+                self.apply_record(rec)
+                if j is not None:
+                    j.log(rec)
+        finally:
+            self.set_journal(j)
+
+    def apply_record(self, rec):
+        kind, addr = rec[0], rec[1]
+        if kind == journal.FLAGS:
+            self.store_flags(addr, rec[3])
+        elif kind == journal.PROP:
+            prop, val = rec[2], rec[4]
+            if prop == "label":
+                cur = self.get_addr_prop(addr, "label")
+                if cur is not None and self.labels_rev.get(cur) == addr:
+                    del self.labels_rev[cur]
+                if val is not None:
+                    self.labels_rev[val] = addr
+            self.set_addr_prop(addr, prop, val)
+        elif kind == journal.ARG:
+            arg_no, prop = rec[2]
+            if rec[4] is not None:
+                self.set_arg_prop(addr, arg_no, prop, rec[4])
+            else:
+                # Remove property altogether, to restore exactly the
+                # previous state.
+                arg_props = self.get_addr_prop(addr, "args", {})
+                arg_props.get(arg_no, {}).pop(prop, None)
+                if not arg_props.get(arg_no, True):
+                    del arg_props[arg_no]
+                self._set_addr_prop(addr, "args", arg_props or None)
+        elif kind == journal.XREF:
+            from_ea, type = rec[2], rec[4]
+            if type is not None:
+                self.add_xref(from_ea, addr, type)
+            elif from_ea in self.get_addr_prop(addr, "xrefs", {}):
+                self.del_xref(from_ea, addr, rec[3])
+                if not self.get_addr_prop(addr, "xrefs"):
+                    self._set_addr_prop(addr, "xrefs", None)
+        elif kind == journal.FUNC_END:
+            f = None
+            if rec[3] is not None:
+                f = self.get_addr_prop(rec[3], "fun_s")
+            self.set_func_end(f, addr)
+        elif kind == journal.FUNC:
+            self.make_func(addr, rec[2])
+        elif kind == journal.FUNC_DEL:
+            self.del_func(addr)
+        elif kind == journal.RANGES:
+            f = self.get_addr_prop(addr, "fun_s")
+            for start, end in rec[2]:
+                f.add_range(start, end)
+        elif kind == journal.UNRANGES:
+            f = self.get_addr_prop(addr, "fun_s")
+            for start, end in rec[2]:
+                f.remove_range(start, end)
+        else:
+            raise ValueError("Unknown journal record: %r" % (rec,))
+
+    # Undo last group of changes. Returns False if there's nothing to undo.
+    def undo(self):
+        if self.journal is None:
+            return False
+        recs = self.journal.pop_undo()
+        if recs is None:
+            return False
+        self.apply_records(recs)
+        self.journal.end_group()
+        return True
+
+    def redo(self):
+        if self.journal is None:
+            return False
+        recs = self.journal.pop_redo()
+        if recs is None:
+            return False
+        self.apply_records(recs)
+        self.journal.end_group()
+        return True
+
     # Persistence API
 
+    # Update Area.dirty with changes tracked elsewhere
+    def update_dirty(self):
+        # Function ranges are saved as properties of function start
+        for func in self.func_index.modified:
+            off, area = self.addr2area(func.start)
+            if area:
+                area.dirty |= self.DIRTY_PROPS
+        self.func_index.modified.clear()
+
+    # Mark everything as saved
+    def mark_saved(self):
+        self.changed = False
+        for a in self.area_list:
+            a.dirty = 0
+        self.func_index.modified.clear()
+
     def save_area(self, stream, area):
-        stream.write("%08x %08x\n" % (area[START], area[END]))
-        flags = area[FLAGS]
+        stream.write("%08x %08x\n" % (area.start, area.end))
+        flags = area.flags
         i = 0
         while True:
             chunk = flags[i:i + 32]
@@ -649,80 +1429,141 @@ class AddressSpace:
         for a in self.area_list:
             self.save_area(stream, a)
 
-
-    def save_addr_props(self, prefix):
-        areas = self.area_list
-        area_i = 0
-        stream = open(prefix + ".%08x" % areas[area_i][START], "w")
-        area_end = areas[area_i][END]
+    # Binary format of area flags/bytes is just raw content, which is
+    # memory-mapped on loading, so only pages actually accessed are read.
+    # Mapping is copy-on-write, i.e. changes don't go to the file.
+
+    def save_area_bin(self, stream, area):
+        stream.write(area.flags)
+
+    def save_area_bytes(self, stream, area):
+        stream.write(area.bytes)
+
+    @staticmethod
+    def _map_area_file(f, area):
+        size = os.fstat(f.fileno()).st_size
+        assert size == area.end - area.start + 1, \
+            "%s: size 0x%x doesn't match area %s" % (f.name, size, str_area(area))
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def load_area_bin(self, f, area):
+        area.flags = self._map_area_file(f, area)
+        area.units.clear()
+        self.insn_cache.invalidate(area.start, area.end + 1)
+        self.render_cache.invalidate(area.start, area.end + 1)
+
+    def load_area_bytes(self, f, area):
+        area.bytes = self._map_area_file(f, area)
+        self.insn_cache.invalidate(area.start, area.end + 1)
+        self.render_cache.invalidate(area.start, area.end + 1)
+
+
+    # Address properties are saved and loaded as records of
+    # (addr, label, comm, args, func, xrefs), where func is (end, ranges)
+    # of a function starting at addr. Absent properties are None.
+
+    def iter_prop_records(self, start=0, end=None):
+        if self.lazy_areas:
+            for a in self.area_list:
+                if a.end >= start and (end is None or a.start < end):
+                    self.ensure_area_loaded(a)
+        for addr, props in self.props.iter_props(start, end):
+            # If entry has just fun_e data, skip it. As fun_e is set
+            # on an address past the last byte of func, this address
+            # also may not belong to any section, so skipping it
+            # to start with is helpful.
+            if len(props) == 1 and "fun_e" in props:
+                continue
+            arg_props = props.get("args")
+            if arg_props is not None:
+                arg_props = {arg_no: {k: v for k, v in data.items() if v is not None}
+                             for arg_no, data in arg_props.items()}
+                arg_props = {arg_no: data for arg_no, data in arg_props.items() if data} or None
+            func = props.get("fun_s")
+            if func is not None:
+                func = (func.end, func.get_ranges())
+            yield (addr, props.get("label"), props.get("comm"), arg_props, func, props.get("xrefs") or None)
+
+    def load_prop_record(self, rec):
+        addr, label, comm, arg_props, func, xrefs = rec
+        props = self.props
+        if label is not None:
+            props.set(addr, "label", label)
+            self.labels_rev[label] = addr
+        if comm is not None:
+            props.set(addr, "comm", comm)
+        if func is not None:
+            end, ranges = func
+            f = Function(addr, end)
+            props.set(addr, "fun_s", f)
+            self.func_index.add(f)
+            if ranges:
+                for r in ranges:
+                    f.add_range(*r)
+                # Now, call finish func to set func end address, either from
+                # fn_end or fn_ranges
+                finish_func(f)
+        if arg_props is not None:
+            props.set(addr, "args", arg_props)
+        if xrefs is not None:
+            props.set(addr, "xrefs", xrefs)
+
+    def load_prop_records(self, recs):
+        for rec in recs:
+            self.load_prop_record(rec)
+        self.render_cache.bump()
+
+    def save_area_props(self, stream, area):
         stream.write("header:\n")
         stream.write(" version: 1.0\n")
-        for addr, props in sorted(self.addr_map.items()):
-                    # If entry has just fun_e data, skip it. As fun_e is set
-                    # on an address past the last byte of func, this address
-                    # also may not belong to any section, so skipping it
-                    # to start with is helpful.
-                    if len(props) == 1 and "fun_e" in props:
-                        continue
-
-                    if addr > area_end:
-                        stream.close()
-                        area_i += 1
-                        while addr > areas[area_i][END]:
-                            area_i += 1
-                        assert addr >= areas[area_i][START]
-                        stream = open(prefix + ".%08x" % areas[area_i][START], "w")
-                        #stream.write("addr=%x area_end=%x\n" % (addr, area_end))
-                        area_end = areas[area_i][END]
-                        stream.write("header:\n")
-                        stream.write(" version: 1.0\n")
-                    stream.write("0x%08x:\n" % addr)
-                    fl = self.get_flags(addr)
-                    stream.write(" f: %s %02x\n" % (flag2char(fl), fl))
-                    label = props.get("label")
-                    arg_props = props.get("args")
-                    comm = props.get("comm")
-                    xrefs = props.get("xrefs")
-                    func = props.get("fun_s")
-                    if label is not None:
-                        if label == addr:
-                            stream.write(" l:\n")
-                        else:
-                            stream.write(" l: %s\n" % label)
-                    if arg_props is not None:
-                        arg_props_header = False
-                        for arg_no, data in sorted(arg_props.items()):
-                            data = {k: v for k, v in data.items() if v is not None}
-                            if data:
-                                if not arg_props_header:
-                                    stream.write(" args:\n")
-                                    arg_props_header = True
-                                stream.write("  %s: %r\n" % (arg_no, data))
-                            #for k, v in sorted(data.items()):
-                            #    stream.write("   %s: %s\n" % (k, v))
-                    if comm is not None:
-                        stream.write(" cmnt: %r\n" % comm)
-
-                    if func is not None:
-                        if func.end is not None:
-                            stream.write(" fn_end: 0x%08x\n" % func.end)
-                        else:
-                            stream.write(" fn_end: '?'\n")
-                        stream.write(" fn_ranges: [")
-                        first = True
-                        for r in func.get_ranges():
-                            if not first:
-                                stream.write(", ")
-                            stream.write("[0x%08x,0x%08x]" % r)
-                            first = False
-                        stream.write("]\n")
-
-                    if xrefs:
-                        stream.write(" x:\n" % xrefs)
-                        for from_addr in sorted(xrefs.keys()):
-                            stream.write(" - 0x%08x: %s\n" % (from_addr, xrefs[from_addr]))
+        for addr, label, comm, arg_props, func, xrefs in self.iter_prop_records(area.start, area.end + 1):
+            stream.write("0x%08x:\n" % addr)
+            fl = self.get_flags(addr)
+            stream.write(" f: %s %02x\n" % (flag2char(fl), fl))
+            if label is not None:
+                if label == addr:
+                    stream.write(" l:\n")
+                else:
+                    stream.write(" l: %s\n" % label)
+            if arg_props is not None:
+                stream.write(" args:\n")
+                for arg_no, data in sorted(arg_props.items()):
+                    stream.write("  %s: %r\n" % (arg_no, data))
+            if comm is not None:
+                stream.write(" cmnt: %r\n" % comm)
+
+            if func is not None:
+                end, ranges = func
+                if end is not None:
+                    stream.write(" fn_end: 0x%08x\n" % end)
+                else:
+                    stream.write(" fn_end: '?'\n")
+                stream.write(" fn_ranges: [%s]\n" % ", ".join("[0x%08x,0x%08x]" % r for r in ranges))
+
+            if xrefs:
+                stream.write(" x:\n")
+                for from_addr in sorted(xrefs.keys()):
+                    stream.write(" - 0x%08x: %s\n" % (from_addr, xrefs[from_addr]))
+
+    def save_area_props_bin(self, stream, area):
+        w = aprops.Writer(stream)
+        w.add_all(self.iter_prop_records(area.start, area.end + 1))
+        w.close()
+
+    def save_addr_props(self, prefix):
+        for area in self.area_list:
+            with open(prefix + ".%08x" % area.start, "w") as stream:
+                self.save_area_props(stream, area)
 
     def load_addr_props(self, stream):
+        self.load_prop_records(self.parse_addr_props(stream))
+
+    def load_addr_props_bin(self, stream):
+        self.load_prop_records(aprops.iter_records(stream))
+
+    # Parse text format of address properties into records
+    @staticmethod
+    def parse_addr_props(stream):
         l = stream.readline()
         assert l == "header:\n"
         l = stream.readline()
@@ -731,7 +1572,7 @@ class AddressSpace:
         while l:
             assert l.endswith(":\n")
             addr = int(l[:-2], 0)
-            props = self.addr_map.get(addr, {})
+            label = comm = arg_props = func = xrefs = None
             l = stream.readline()
             while l and l[0] == " ":
                 key, val = [x.strip() for x in l.split(":", 1)]
@@ -740,31 +1581,22 @@ class AddressSpace:
                 if key == "l":
                     if not val:
                         val = addr
-                    props["label"] = val
-                    self.labels_rev[val] = addr
+                    label = val
                 elif key == "cmnt":
-                    props["comm"] = val[1:-1].replace("\\n", "\n")
+                    comm = val[1:-1].replace("\\n", "\n")
                 elif key == "fn_end":
                     if val == "'?'":
                         end = None
                     else:
                         end = int(val, 0)
-                    f = Function(addr, end)
-                    props["fun_s"] = f
-                    # Handled by finish_func() below
-                    #if end is not None:
-                    #    self.addr_map[end] = {"fun_e": f}
+                    func = (end, [])
                 elif key == "fn_ranges":
                     if val != "[]":
                         assert val.startswith("[[") and val.endswith("]]"), val
                         val = val[2:-2]
-                        f = props["fun_s"]
                         for r in val.split("], ["):
                             r = [int(x, 0) for x in r.split(",")]
-                            f.add_range(*r)
-                        # Now, call finish func to set func end address, either from
-                        # fn_end or fn_ranges
-                        finish_func(f)
+                            func[1].append(tuple(r))
 
                 elif key == "args":
                     arg_props = {}
@@ -783,7 +1615,6 @@ class AddressSpace:
                             k, v = [x[1:-1] for x in seq]
                             vals[k] = v
                         arg_props[int(arg_no)] = vals
-                    props["args"] = arg_props
 
                 elif key == "x":
                     xrefs = {}
@@ -794,26 +1625,35 @@ class AddressSpace:
                         key, val = [x.strip() for x in l[3:].split(":", 1)]
                         xrefs[int(key, 0)] = val
                     assert xrefs
-                    props["xrefs"] = xrefs
 
                 if l is None:
                     l = stream.readline()
 
-            self.addr_map[addr] = props
+            yield (addr, label, comm, arg_props, func, xrefs)
 
-    def load_area(self, stream, area):
+    # Parse text format of area flags, for area with given start and
+    # (inclusive) end.
+    @staticmethod
+    def parse_area(stream, start, end):
         l = stream.readline()
         vals = [int(v, 16) for v in l.split()]
-        assert area[START] == vals[0] and area[END] == vals[1]
-        flags = area[FLAGS]
-        i = 0
+        assert start == vals[0] and end == vals[1]
+        chunks = []
         while True:
             l = stream.readline().rstrip()
             if not l:
                 break
-            l = binascii.unhexlify(l)
-            flags[i:i + len(l)] = l
-            i += len(l)
+            chunks.append(binascii.unhexlify(l))
+        return b"".join(chunks)
+
+    def load_area(self, stream, area):
+        self.load_area_flags(area, self.parse_area(stream, area.start, area.end))
+
+    def load_area_flags(self, area, data):
+        area.units.clear()
+        self.insn_cache.invalidate(area.start, area.end + 1)
+        self.render_cache.invalidate(area.start, area.end + 1)
+        area.flags[:len(data)] = data
 
     def load_areas(self, stream):
         for a in self.area_list:
@@ -841,12 +1681,16 @@ def set_processor(p):
     global _processor
     _processor = p
     idaapi.set_processor(p)
+    ADDRESS_SPACE.insn_cache.clear()
+    ADDRESS_SPACE.render_cache.bump()
 
 
 analisys_stack_calls = []
 analisys_stack_returns = []
 analisys_stack_branches = []
 analysis_current_func = None
+# Set by profiler.enable(), called for each analyzed instruction
+PROFILER = None
 
 def add_entrypoint(ea, as_func=True):
     if as_func:
@@ -855,11 +1699,103 @@ def add_entrypoint(ea, as_func=True):
     else:
         analisys_stack_branches.append(ea)
 
+# Drop pending analysis work (e.g. when analysis is cancelled). Function
+# being analyzed is finished with what was traced so far.
+def stop_analysis():
+    global analysis_current_func
+    finish_func(analysis_current_func)
+    analysis_current_func = None
+    del analisys_stack_calls[:]
+    del analisys_stack_branches[:]
+    del analisys_stack_returns[:]
+
 def init_cmd(ea):
     _processor.cmd.ea = ea
     _processor.cmd.size = 0
     _processor.cmd.disasm = None
 
+# Decode instruction at ea, using ADDRESS_SPACE.insn_cache. Returns
+# new Instruction object after ana() (with .size of 0 if there's no valid
+# instruction), owned by the caller. If end is given, it's a hint that
+# instructions up to it will be decoded next, so if the processor
+# supports batch decoding (ana_range()), they're decoded and cached at
+# once.
+def decode(ea, end=None):
+    cache = ADDRESS_SPACE.insn_cache
+    insn = cache.get(ea)
+    if insn is None:
+        if end is not None and getattr(_processor, "ana_range", None):
+            for rec_ea, rec in iter_records(ea, _processor.ana_range(ea, end)):
+                if insn is None:
+                    insn = insn_from_record(rec_ea, rec)
+                cache.put_record(rec_ea, rec)
+            if insn is not None:
+                return insn
+        insn = Instruction(ea)
+        _processor.cmd = insn
+        if _processor.ana():
+            cache.put(ea, copy_insn(insn))
+    return insn
+
+# Copy Instruction object, so that changes to the copy (including its
+# operands) don't affect the original.
+def copy_insn(insn):
+    new = object.__new__(insn.__class__)
+    d = new.__dict__
+    d.update(insn.__dict__)
+    ops = []
+    for op in insn._operands:
+        o = object.__new__(op.__class__)
+        o.__dict__.update(op.__dict__)
+        ops.append(o)
+    d["_operands"] = ops
+    return new
+
+# Iterate over instructions starting at start, up to end (exclusive) or
+# first invalid instruction. Instructions are decoded as by decode().
+def iter_insns(start, end):
+    ea = start
+    while ea < end:
+        insn = decode(ea, end)
+        if not insn.size:
+            break
+        yield insn
+        ea += insn.size
+
+# Iterate over (ea, record) for records returned by ana_range(start, ...)
+def iter_records(start, recs):
+    ea = start
+    for rec in recs:
+        yield ea, rec
+        ea += rec[0]
+
+# Create Instruction object from a record returned by ana_range(), as
+# if it was decoded by ana().
+def insn_from_record(ea, rec):
+    size, itype, ops, attrs = rec
+    insn = Instruction(ea)
+    insn.size = size
+    insn.itype = itype
+    operands = insn._operands
+    fields = idaapi.OP_RECORD_FIELDS
+    i = 0
+    for oprec in ops:
+        op = operands[i]
+        t = op.type = oprec[0]
+        if len(oprec) == 2:
+            setattr(op, fields[t][0], oprec[1])
+        else:
+            for f, v in zip(fields[t], oprec[1:]):
+                setattr(op, f, v)
+        i += 1
+    while i < idaapi.UA_MAXOP:
+        operands[i].type = idaapi.o_void
+        i += 1
+    if attrs:
+        for k, v in attrs.items():
+            setattr(insn, k, v)
+    return insn
+
 def finish_func(f):
     if f:
         log.info("Function %s (0x%x) ranges: %s" % (ADDRESS_SPACE.get_label(f.start), f.start, f.ranges.str(hex)))
@@ -867,11 +1803,22 @@ def finish_func(f):
         if end is not None:
             ADDRESS_SPACE.set_func_end(f, end)
 
-def analyze(callback=lambda cnt:None):
+# Max size of code to decode ahead during analysis, if processor
+# supports ana_range()
+ANA_RANGE_SIZE = 256
+
+# predecoded is an optional dict of records of instructions as returned
+# by ana_range(), by address (see parallel.py). Used records are removed
+# from it.
+def analyze(callback=lambda cnt:None, predecoded=None):
     global analysis_current_func
     cnt = 0
     limit = 1000000
     analysis_current_func = None
+    prof = PROFILER
+    ana_range = getattr(_processor, "ana_range", None)
+    # Records of instructions decoded ahead by ana_range(), by address
+    ahead = {}
     while limit:
         if analisys_stack_branches:
             ea = analisys_stack_branches.pop()
@@ -899,7 +1846,7 @@ def analyze(callback=lambda cnt:None):
             analysis_current_func = None
             ea = analisys_stack_calls.pop()
             fun = ADDRESS_SPACE.get_func_start(ea)
-            if fun.get_ranges():
+            if fun.ranges:
                 continue
             log.info("Starting analysis of function 0x%x" % ea)
             analysis_current_func = ADDRESS_SPACE.make_func(ea)
@@ -911,15 +1858,33 @@ def analyze(callback=lambda cnt:None):
         else:
             finish_func(analysis_current_func)
             break
-        init_cmd(ea)
-        try:
-            insn_sz = _processor.ana()
-        except InvalidAddrException:
-            # Ran out of memory area, just continue
-            # with the rest of paths
-            continue
+        rec = None
+        if predecoded:
+            rec = predecoded.pop(ea, None)
+        if rec is None and ana_range:
+            rec = ahead.pop(ea, None)
+            if rec is None:
+                # Decode following linear run of instructions at once
+                ahead = dict(iter_records(ea, ana_range(ea, ea + ANA_RANGE_SIZE)))
+                rec = ahead.pop(ea, None)
+        if rec is not None:
+            insn = insn_from_record(ea, rec)
+            _processor.cmd = insn
+            insn_sz = insn.size
+        else:
+            insn = Instruction(ea)
+            _processor.cmd = insn
+            try:
+                insn_sz = _processor.ana()
+            except InvalidAddrException:
+                # Ran out of memory area, just continue
+                # with the rest of paths
+                continue
 #        print("size: %d" % insn_sz, _processor.cmd)
         if insn_sz:
+            if rec is None:
+                # Cache state after ana(), as emu() and out() may modify insn
+                cached = copy_insn(insn)
             if not _processor.emu():
                 assert False
             if analysis_current_func:
@@ -927,11 +1892,19 @@ def analyze(callback=lambda cnt:None):
                 ADDRESS_SPACE.make_code(ea, insn_sz, ADDRESS_SPACE.FUNC)
             else:
                 ADDRESS_SPACE.make_code(ea, insn_sz)
+            # Cache only after make_code(), which invalidates this range
+            if rec is not None:
+                ADDRESS_SPACE.insn_cache.put_record(ea, rec)
+            else:
+                ADDRESS_SPACE.insn_cache.put(ea, cached)
+            _processor.cmd = insn
             _processor.out()
 #            print("%08x %s" % (_processor.cmd.ea, _processor.cmd.disasm))
 #            print("---------")
             limit -= 1
             cnt += 1
+            if prof:
+                prof.insn(analysis_current_func)
             if cnt % 1000 == 0:
                 callback(cnt)
 #    if not analisys_stack:
@@ -1048,9 +2021,19 @@ class Instruction(idaapi.insn_t, DisasmObj):
     virtual = False
 
     def render(self):
-        _processor.cmd = self
-        _processor.out()
-        s = self.disasm + self.comment
+        rcache = ADDRESS_SPACE.render_cache
+        ent = rcache.get(rcache.units, self.ea)
+        if ent is None:
+            _processor.cmd = self
+            # Make out() allocate new operand positions for this object
+            self.arg_pos = ()
+            _processor.out()
+            s = self.disasm
+            rcache.put(rcache.units, self.ea, (rcache.gen, self.size, s, self.arg_pos))
+        else:
+            s = ent[2]
+            self.arg_pos = ent[3]
+        s += self.comment
         self.cache = s
         return s
 
@@ -1081,14 +2064,20 @@ class Data(DisasmObj):
         self.val = val
 
     def render(self):
-        subtype = ADDRESS_SPACE.get_arg_prop(self.ea, 0, "subtype")
-        if subtype == IMM_ADDR:
-            label = self.val
-            if not isinstance(label, str):
-                label = ADDRESS_SPACE.get_label(label)
-            s = "%s%s" % (data_sz2mnem(self.size), label)
+        rcache = ADDRESS_SPACE.render_cache
+        ent = rcache.get(rcache.units, self.ea)
+        if ent is None:
+            subtype = ADDRESS_SPACE.get_arg_prop(self.ea, 0, "subtype")
+            if subtype == IMM_ADDR:
+                label = self.val
+                if not isinstance(label, str):
+                    label = ADDRESS_SPACE.get_label(label)
+                s = "%s%s" % (data_sz2mnem(self.size), label)
+            else:
+                s = "%s0x%x" % (data_sz2mnem(self.size), self.val)
+            rcache.put(rcache.units, self.ea, (rcache.gen, self.size, s, ()))
         else:
-            s = "%s0x%x" % (data_sz2mnem(self.size), self.val)
+            s = ent[2]
         s += self.comment
         self.cache = s
         return s
@@ -1157,8 +2146,14 @@ class Label(DisasmObj):
         self.ea = ea
 
     def render(self):
-        label = ADDRESS_SPACE.get_label(self.ea)
-        s = "%s:" % label
+        rcache = ADDRESS_SPACE.render_cache
+        ent = rcache.get(rcache.labels, self.ea)
+        if ent is None:
+            label = ADDRESS_SPACE.get_label(self.ea)
+            s = "%s:" % label
+            rcache.put(rcache.labels, self.ea, (rcache.gen, s))
+        else:
+            s = ent[1]
         self.cache = s
         return s
 
@@ -1173,15 +2168,28 @@ class Xref(DisasmObj):
         self.type = type
 
     def render(self):
+        rcache = ADDRESS_SPACE.render_cache
+        if ADDRESS_SPACE.func_index.dirty:
+            # Function ranges changed
+            rcache.bump()
+        key = (self.from_addr, self.type)
+        ent = rcache.get(rcache.xrefs, key)
+        if ent is not None:
+            self.cache = ent[1]
+            return ent[1]
         func = ADDRESS_SPACE.lookup_func(self.from_addr)
         extra = ""
         if func:
             extra = ADDRESS_SPACE.get_label(func.start)
             off = self.from_addr - func.start
-            if off != 0:
+            if off > 0:
                 extra += "+0x%x" % off
+            elif off < 0:
+                # Non-contiguous function chunk below its entry
+                extra += "-0x%x" % -off
             extra = " (%s)" % extra
         s = (" " * idaapi.DEFAULT_XREF_INDENT) + "; xref: %s 0x%x" % (self.type, self.from_addr) + extra
+        rcache.put(rcache.xrefs, key, (rcache.gen, s))
         self.cache = s
         return s
 
@@ -1228,14 +2236,12 @@ def render_partial_around(addr, subno, context_lines):
     back = context_lines * MAX_UNIT_SIZE
     off -= back
     if off < 0:
-        area_no = ADDRESS_SPACE.area_no(area) - 1
-        while area_no >= 0:
-            area = ADDRESS_SPACE.area_list[area_no]
-            sz = area[1] - area[0] + 1
+        while area.prev is not None:
+            area = area.prev
+            sz = area.end - area.start + 1
             off += sz
             if off >= 0:
                 break
-            area_no -= 1
         if off < 0:
             # Reached beginning of address space, just set as such
             off = 0
@@ -1244,7 +2250,7 @@ def render_partial_around(addr, subno, context_lines):
     off = ADDRESS_SPACE.adjust_offset_reverse(off, area)
     log.debug("render_partial_around adjusted: off=0x%x, %s", off, str_area(area))
     model = Model(addr, subno)
-    render_partial(model, ADDRESS_SPACE.area_list.index(area), off, context_lines, addr)
+    render_partial(model, area.no, off, context_lines, addr)
     log.debug("render_partial_around model done, lines: %d", len(model.lines()))
     assert model.target_addr_lineno_0 >= 0
     if model.target_addr_lineno == -1:
@@ -1260,8 +2266,11 @@ def render_from(model, addr, num_lines):
     off, area = ADDRESS_SPACE.addr2area(addr)
     if area is None:
         return None
-    return render_partial(model, ADDRESS_SPACE.area_list.index(area), off, num_lines)
+    return render_partial(model, area.no, off, num_lines)
+
 
+# Max size of code to decode at once during rendering
+RENDER_DECODE_AHEAD = 64
 
 def render_partial(model, area_no, offset, num_lines, target_addr=-1):
     model.AS = ADDRESS_SPACE
@@ -1269,18 +2278,19 @@ def render_partial(model, area_no, offset, num_lines, target_addr=-1):
     #for a in ADDRESS_SPACE.area_list:
     while area_no < len(ADDRESS_SPACE.area_list):
         a = ADDRESS_SPACE.area_list[area_no]
+        ADDRESS_SPACE.ensure_area_loaded(a)
         area_no += 1
         i = 0
         if start:
             i = offset
             start = False
         if i == 0:
-            model.add_line(a[START], AreaWrapper(a[START], "; Start of 0x%x area (%s)" % (a[START], a[PROPS].get("name", "noname"))))
-        bytes = a[BYTES]
-        flags = a[FLAGS]
+            model.add_line(a.start, AreaWrapper(a.start, "; Start of 0x%x area (%s)" % (a.start, a.props.get("name", "noname"))))
+        bytes = a.bytes
+        flags = a.flags
         areasize = len(bytes)
         while i < areasize:
-            addr = a[START] + i
+            addr = a.start + i
             # If we didn't yet reach target address, compensate for
             # the following decrement of num_lines. The logic is:
             # render all lines up to target_addr, and then num_lines past it.
@@ -1316,28 +2326,19 @@ def render_partial(model, area_no, offset, num_lines, target_addr=-1):
                 out = Data(addr, sz, ADDRESS_SPACE.get_data(addr, sz))
                 i += sz
             elif f == AddressSpace.STR:
-                str = chr(bytes[i])
-                sz = 1
-                j = i + 1
-                while j < areasize and flags[j] == AddressSpace.DATA_CONT:
-                    str += chr(bytes[j])
-                    sz += 1
-                    j += 1
+                sz = ADDRESS_SPACE.get_unit_size(addr)
+                str = bytes[i:i + sz].decode("latin-1")
                 out = String(addr, sz, str)
                 i += sz
             elif f == AddressSpace.FILL:
-                sz = 1
-                j = i + 1
-                while j < areasize and flags[j] == AddressSpace.FILL:
-                    sz += 1
-                    j += 1
+                sz = ADDRESS_SPACE.get_unit_size(addr)
                 out = Fill(addr, sz)
                 i += sz
             elif f == AddressSpace.CODE:
-                out = Instruction(addr)
-                _processor.cmd = out
-                sz = _processor.ana()
-                _processor.out()
+                # Let following instructions be decoded at once (those
+                # which turn out to be not code just stay unused in cache)
+                out = decode(addr, addr + RENDER_DECODE_AHEAD)
+                sz = out.size
                 i += sz
             else:
                 out = Literal(addr, "; UNEXPECTED value: %02x flags: %02x" % (bytes[i], f))
@@ -1371,7 +2372,7 @@ def render_partial(model, area_no, offset, num_lines, target_addr=-1):
             if not num_lines:
                 return next_addr
 
-        model.add_line(a[END], AreaWrapper(a[END], "; End of 0x%x area (%s)" % (a[START], a[PROPS].get("name", "noname"))))
+        model.add_line(a.end, AreaWrapper(a.end, "; End of 0x%x area (%s)" % (a.start, a.props.get("name", "noname"))))
 
 
 def flag2char(f):
@@ -1395,12 +2396,13 @@ def flag2char(f):
         return "X"
 
 def print_address_map():
+    ADDRESS_SPACE.load_all_areas()
     for a in ADDRESS_SPACE.area_list:
-        for i in range(len(a[FLAGS])):
+        for i in range(len(a.flags)):
             if i % 128 == 0:
                 sys.stdout.write("\n")
-                sys.stdout.write("%08x " % (a[START] + i))
-            sys.stdout.write(flag2char(a[FLAGS][i]))
+                sys.stdout.write("%08x " % (a.start + i))
+            sys.stdout.write(flag2char(a.flags[i]))
         sys.stdout.write("\n")
 
 
@@ -21,6 +21,10 @@ is actually "capital A", so make sure Caps Lock is right):
 g - Goto address
 Esc - Return to address from previous Enter cmd (as stack)
 Shift+s - Save database
+F9 - Menu (includes Export as text, to get text copy of the database)
+Ctrl+z - Undo
+Ctrl+y - Redo
+Ctrl+c - Cancel running analysis
 q - Quit
 
 Shift+i - Show memory map (see key below)
@@ -30,7 +34,7 @@ Ctrl+q - Show problems list
 Current address commands:
 
 u - Undefine
-c - Make code
+c - Make code (code flow is analyzed in background)
 d - Make/Cycle data
 a - Make ASCII string
 f - Make filler (ignored bytes, to avoid leaving them undefined)
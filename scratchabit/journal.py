@@ -0,0 +1,185 @@
+# Append-only journal of AddressSpace changes (project.journal).
+#
+# Each change is recorded as a tuple (kind, addr, ...), holding both old
+# and new values, so it can be both undone and redone. Applying a record
+# sets absolute values, so replaying records which are already reflected
+# in a snapshot is harmless.
+#
+# Records are grouped into undo groups (usually, a group per UI command).
+# The file starts with MAGIC, followed by batches of records, each batch
+# being a little-endian u32 length, followed by marshal'ed list of
+# records. The file is truncated when the project is saved, so it
+# contains only changes since the last save, to be replayed on top of
+# the snapshot after a crash.
+
+import os
+import marshal
+import struct
+import collections
+
+
+MAGIC = b"SABJRNL1"
+MARSHAL_VERSION = 4
+# Records accumulated before writing a batch to the file
+BATCH_SIZE = 4096
+# Max number of undo groups kept in memory
+UNDO_LEVELS = 100
+
+# fsync policies: never fsync (rely on OS), fsync at the end of each
+# undo group, or fsync after each batch written.
+FSYNC_NEVER = "never"
+FSYNC_GROUP = "group"
+FSYNC_BATCH = "batch"
+
+# Record kinds
+# (FLAGS, addr, old_bytes, new_bytes)
+FLAGS = 0
+# (PROP, addr, prop, old, new), for plain-valued properties
+PROP = 1
+# (ARG, addr, (arg_no, prop), old, new)
+ARG = 2
+# (XREF, to_addr, from_addr, old_type, new_type)
+XREF = 3
+# (FUNC_END, addr, old_func_start, new_func_start)
+FUNC_END = 4
+# (FUNC, start, end) / (FUNC_DEL, start, end)
+FUNC = 5
+FUNC_DEL = 6
+# (RANGES, func_start, ranges) / (UNRANGES, func_start, ranges)
+RANGES = 7
+UNRANGES = 8
+
+# Kinds which are inverted by swapping old and new values
+_SWAP_KINDS = (FLAGS, PROP, ARG, XREF, FUNC_END)
+_INVERSE_KIND = {FUNC: FUNC_DEL, FUNC_DEL: FUNC, RANGES: UNRANGES, UNRANGES: RANGES}
+
+_len = struct.Struct("<I")
+
+
+def invert(rec):
+    kind = rec[0]
+    if kind in _SWAP_KINDS:
+        return rec[:-2] + (rec[-1], rec[-2])
+    return (_INVERSE_KIND[kind],) + rec[1:]
+
+
+class Journal:
+
+    def __init__(self, fname=None, fsync=FSYNC_GROUP, undo_levels=UNDO_LEVELS):
+        self.fname = fname
+        self.fsync = fsync
+        # Records of the current (not yet finished) group
+        self.group = []
+        self.undo_stack = collections.deque(maxlen=undo_levels)
+        self.redo_stack = []
+        # Records not yet written to file
+        self.pending = []
+        self.file = None
+        if fname:
+            self.file = open(fname, "ab")
+            if self.file.tell() == 0:
+                self.file.write(MAGIC)
+
+    # Record a change made by user (or analysis)
+    def add(self, rec):
+        self.group.append(rec)
+        self.pending.append(rec)
+        if self.redo_stack:
+            self.redo_stack = []
+        if len(self.pending) >= BATCH_SIZE:
+            self.write()
+
+    # Record a change to file only (e.g. made by undo/redo)
+    def log(self, rec):
+        self.pending.append(rec)
+        if len(self.pending) >= BATCH_SIZE:
+            self.write()
+
+    def end_group(self):
+        if self.group:
+            self.undo_stack.append(self.group)
+            self.group = []
+        if self.pending:
+            self.write()
+            if self.fsync == FSYNC_GROUP:
+                self.sync()
+
+    # Take records of the current group out, so changes made until
+    # resume_group() form their own group(s). Used by background analysis,
+    # to not mix its changes with UI commands run meanwhile.
+    def suspend_group(self):
+        group = self.group
+        self.group = []
+        return group
+
+    def resume_group(self, group):
+        self.group = group + self.group
+
+    def can_undo(self):
+        return bool(self.group or self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    # Return records to apply to undo the last group
+    def pop_undo(self):
+        self.end_group()
+        if not self.undo_stack:
+            return None
+        group = self.undo_stack.pop()
+        self.redo_stack.append(group)
+        return [invert(rec) for rec in reversed(group)]
+
+    # Return records to apply to redo the last undone group
+    def pop_redo(self):
+        self.end_group()
+        if not self.redo_stack:
+            return None
+        group = self.redo_stack.pop()
+        self.undo_stack.append(group)
+        return group
+
+    def write(self):
+        if self.file and self.pending:
+            data = marshal.dumps(self.pending, MARSHAL_VERSION)
+            self.file.write(_len.pack(len(data)) + data)
+            self.file.flush()
+            if self.fsync == FSYNC_BATCH:
+                self.sync()
+        self.pending = []
+
+    def sync(self):
+        if self.file:
+            os.fsync(self.file.fileno())
+
+    # Called once changes are saved to the project snapshot. Undo
+    # history is kept.
+    def truncate(self):
+        self.pending = []
+        if self.file:
+            self.file.truncate(len(MAGIC))
+            self.file.seek(len(MAGIC))
+            self.sync()
+
+    def close(self):
+        self.end_group()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+# Iterate over records of a journal file. Incomplete batch at the end
+# of file (e.g. after a crash during writing) is ignored.
+def iter_records(fname):
+    with open(fname, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return
+        while True:
+            l = f.read(_len.size)
+            if len(l) != _len.size:
+                break
+            sz, = _len.unpack(l)
+            data = f.read(sz)
+            if len(data) != sz:
+                break
+            yield from marshal.loads(data)
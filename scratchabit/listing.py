@@ -0,0 +1,64 @@
+# Writing listings and other textual dumps of a project. Doesn't depend
+# on UI, so can be used in batch mode.
+
+from . import engine
+
+
+class TextSaveModel:
+    def __init__(self, f, ctrl=None, comments=True):
+        self.f = f
+        self.ctrl = ctrl
+        self.cnt = 0
+        self.comments = comments
+    def add_line(self, addr, line):
+        txt = line.render()
+        if not self.comments and ";" in txt:
+            txt = txt.rsplit(";", 1)[0].rstrip()
+            if not txt.strip():
+                return
+        line = ("%08x " % addr) + line.indent + txt + "\n"
+        self.f.write(line)
+        if self.ctrl and self.cnt % 256 == 0:
+            self.ctrl.show_status("Writing: 0x%x" % addr)
+        self.cnt += 1
+
+
+def write_func_stream(APP, func, stream, feedback_obj=None, comments=True):
+    model = TextSaveModel(stream, feedback_obj, comments=comments)
+    for start, end in func.get_ranges():
+        while start < end:
+            start = engine.render_from(model, start, 1)
+
+
+# Write complete disassembly listing. Returns number of lines written.
+def write_listing(stream, feedback_obj=None):
+    model = TextSaveModel(stream, feedback_obj)
+    engine.render_partial(model, 0, 0, 10000000)
+    return model.cnt
+
+
+# Write list of functions, one per line: start, end (or "?" if not
+# known), name and ranges. Returns number of functions.
+def write_func_list(stream):
+    AS = engine.ADDRESS_SPACE
+    cnt = 0
+    for addr, func in AS.iter_funcs():
+        end = func.get_end()
+        end = "?" if end is None else "%08x" % end
+        ranges = " ".join("%08x-%08x" % r for r in func.get_ranges())
+        stream.write("%08x %s %s %s\n" % (addr, end, AS.get_label(addr), ranges))
+        cnt += 1
+    return cnt
+
+
+# Write cross-references, one per line: target address, source address,
+# xref type (see help). Returns number of xrefs.
+def write_xrefs(stream):
+    AS = engine.ADDRESS_SPACE
+    AS.load_all_areas()
+    cnt = 0
+    for addr, xrefs in AS.props.iter_prop("xrefs"):
+        for from_addr, type in sorted(xrefs.items()):
+            stream.write("%08x %08x %s\n" % (addr, from_addr, type))
+            cnt += 1
+    return cnt
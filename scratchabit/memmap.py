@@ -34,6 +34,7 @@ def show(AS, cur_addr):
     lines = []
     addr_list = []
     def_c = C_PAIR(C_CYAN, C_BLUE)
+    AS.load_all_areas()
     for area in AS.get_areas():
         props = area[engine.PROPS]
         flags = area[engine.FLAGS]
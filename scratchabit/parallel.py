@@ -0,0 +1,154 @@
+# Parallel initial analysis.
+#
+# engine.analyze() is inherently sequential: results (function ranges,
+# which branch claims which code, etc.) depend on the order in which
+# worklists are processed. So, instead of splitting analysis itself,
+# the expensive part which doesn't depend on analysis state - decoding
+# of instructions - is done in parallel beforehand, and then analyze()
+# runs as usual, taking instructions from the pre-decoded records. This
+# way results are identical to sequential analysis.
+#
+# Pre-decoding traces control flow from function entrypoints, which are
+# partitioned among a pool of worker processes. Workers are forked, so
+# they share contents of memory areas (and the processor object) with
+# the main process. On platforms without fork, analysis is sequential. Each worker
+# decodes instructions with processor's ana_range() and calls emu() to
+# find flow and jump targets, which it follows within the function, and
+# call targets, which are returned to the main process and distributed
+# among workers in the next round. Anything emu() does besides adding
+# code references is ignored (that's done by analyze() later).
+#
+# Records are valid for any analysis state, as they depend only on
+# contents of memory and address. If some code isn't pre-decoded (e.g.
+# it's reached in a way workers couldn't follow), analyze() just decodes
+# it itself. Processors without ana_range() aren't supported and get
+# sequential analysis.
+
+import sys
+import logging as log
+import multiprocessing
+import concurrent.futures
+
+import idaapi
+from . import engine
+
+
+# Number of tasks per worker in each round, to balance the load
+TASKS_PER_JOB = 4
+# After tracing its entries, a task continues with call targets it
+# found, until it decoded this many instructions (so deep call chains
+# don't take as many rounds).
+TRACE_BUDGET = 20000
+
+
+# Worker side
+
+_flows = []
+_calls = []
+
+def _add_cref(opoff, ea, flags):
+    if flags == idaapi.fl_CN:
+        _calls.append(ea)
+    else:
+        _flows.append(ea)
+
+def _ignore(*args):
+    pass
+
+# idaapi functions which emu() may use to update address space
+EMU_API = {
+    "ua_add_cref": _add_cref,
+    "ua_add_dref": _ignore,
+    "ua_dodata2": _ignore,
+    "op_offset": _ignore,
+    "QueueMark": _ignore,
+}
+
+# Worker process initializer. Plugins usually import idaapi functions
+# into their namespace, so they're replaced there too. This happens only
+# in worker processes.
+def _init_worker():
+    plugin = sys.modules[type(engine._processor).__module__]
+    for mod in (idaapi, plugin):
+        for name, f in EMU_API.items():
+            if hasattr(mod, name):
+                setattr(mod, name, f)
+
+# Decode code reachable from entries, and from call targets found, while
+# within TRACE_BUDGET. Returns (records by address, call targets).
+def _trace(entries):
+    p = engine._processor
+    recs = {}
+    calls = set()
+    todo = list(entries)
+    i = 0
+    while i < len(todo):
+        if i >= len(entries) and len(recs) >= TRACE_BUDGET:
+            break
+        stack = [todo[i]]
+        i += 1
+        while stack:
+            ea = stack.pop()
+            if ea in recs:
+                continue
+            for rec_ea, rec in engine.iter_records(ea, p.ana_range(ea, ea + engine.ANA_RANGE_SIZE)):
+                if rec_ea in recs:
+                    break
+                recs[rec_ea] = rec
+                p.cmd = engine.insn_from_record(rec_ea, rec)
+                del _flows[:]
+                del _calls[:]
+                p.emu()
+                stack.extend(_flows)
+                for target in _calls:
+                    if target not in calls:
+                        calls.add(target)
+                        todo.append(target)
+    return recs, calls
+
+
+# Main process side
+
+def _split(addrs, n):
+    n = min(n, len(addrs))
+    return [addrs[i::n] for i in range(n)]
+
+# Decode code reachable from entries using jobs worker processes.
+# Returns records by address.
+def predecode(entries, jobs):
+    records = {}
+    seen = set()
+    todo = sorted(set(entries))
+    rounds = 0
+    ctx = multiprocessing.get_context("fork")
+    with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=ctx, initializer=_init_worker) as ex:
+        while todo:
+            rounds += 1
+            seen.update(todo)
+            new = set()
+            for recs, calls in ex.map(_trace, _split(todo, jobs * TASKS_PER_JOB)):
+                records.update(recs)
+                new.update(calls)
+            # Code which was already decoded, was traced further too
+            todo = sorted(ea for ea in new if ea not in seen and ea not in records)
+    log.info("Pre-decoded %d instructions in %d rounds", len(records), rounds)
+    return records
+
+
+# Pending entrypoints of analysis, as added by engine.add_entrypoint(),
+# loaders, etc.
+def pending_entries():
+    return (engine.analisys_stack_calls + engine.analisys_stack_branches
+            + [ea for ea, func in engine.analisys_stack_returns])
+
+
+# Same as engine.analyze(), but with instructions pre-decoded using jobs
+# worker processes, if jobs > 1.
+def analyze(callback=lambda cnt: None, jobs=1):
+    if jobs < 2 or not getattr(engine._processor, "ana_range", None):
+        return engine.analyze(callback)
+    if "fork" not in multiprocessing.get_all_start_methods():
+        log.info("Parallel analysis requires fork(), analyzing sequentially")
+        return engine.analyze(callback)
+    records = predecode(pending_entries(), jobs)
+    return engine.analyze(callback, predecoded=records)
@@ -0,0 +1,227 @@
+# Optional instrumentation of code analysis.
+#
+# When enabled, the main analysis phases (CPU plugin's ana/ana_range/emu/out,
+# flags updates, xrefs, labels, function bookkeeping, finish_func) are
+# wrapped to count calls and accumulate time spent in them, both total
+# (including nested phases) and self (excluding them). Additionally,
+# engine.analyze() reports each analyzed instruction, which is used to
+# sample sizes of the analysis worklists, and to accumulate analysis cost
+# per function. When disabled, nothing is wrapped, so there's no
+# overhead besides a check per instruction in engine.analyze().
+#
+# Usage (e.g. from a script):
+#
+#     from scratchabit import profiler
+#     profiler.enable()
+#     engine.analyze()
+#     print(profiler.format_report())
+#     profiler.disable()
+
+import time
+
+from . import engine
+
+
+# Sample worklist sizes each this many instructions (doubled each time
+# number of samples reaches MAX_SAMPLES).
+SAMPLE_INTERVAL = 1000
+MAX_SAMPLES = 1000
+
+# (phase, methods) for AddressSpace and Function
+ASPACE_PHASES = (
+    ("flags", ("_store_flags",)),
+    ("xrefs", ("add_xref", "del_xref")),
+    ("labels", ("make_label", "make_auto_label", "set_label", "make_unique_label")),
+    ("funcs", ("make_func", "set_func_end")),
+)
+FUNCTION_PHASES = (
+    ("funcs", ("add_insn",)),
+)
+# ana_range is optional
+PROCESSOR_PHASES = ("ana", "ana_range", "emu", "out")
+
+
+class Profiler:
+
+    def __init__(self):
+        self.reset()
+        # (obj, attr, original value or None if attr was set on instance)
+        self._patches = []
+
+    def reset(self):
+        self.calls = {}
+        self.total = {}
+        self.self_time = {}
+        # Stack of [phase, start time, time of nested phases]
+        self._stack = []
+        self._active = {}
+        self.insns = 0
+        # Map from function start (None for code outside functions) to
+        # [instructions, time]
+        self.funcs = {}
+        # (instructions, calls, branches, returns)
+        self.worklists = []
+        self.sample_interval = SAMPLE_INTERVAL
+        self._last = None
+
+    def enter(self, phase):
+        self._stack.append([phase, time.perf_counter(), 0.0])
+        self._active[phase] = self._active.get(phase, 0) + 1
+
+    def leave(self, phase):
+        phase, start, nested = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+        self.self_time[phase] = self.self_time.get(phase, 0.0) + elapsed - nested
+        self._active[phase] -= 1
+        # Don't count recursive calls of the same phase twice
+        if not self._active[phase]:
+            self.total[phase] = self.total.get(phase, 0.0) + elapsed
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def wrap(self, phase, f):
+        def wrapper(*args, **kwargs):
+            self.enter(phase)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.leave(phase)
+        return wrapper
+
+    # Called by engine.analyze() after each instruction. Time since the
+    # previous instruction is accounted to the current function.
+    def insn(self, func):
+        now = time.perf_counter()
+        key = func.start if func else None
+        rec = self.funcs.get(key)
+        if rec is None:
+            rec = self.funcs[key] = [0, 0.0]
+        rec[0] += 1
+        if self._last is not None:
+            rec[1] += now - self._last
+        self._last = now
+        self.insns += 1
+        if self.insns % self.sample_interval == 0:
+            self.worklists.append((self.insns, len(engine.analisys_stack_calls),
+                len(engine.analisys_stack_branches), len(engine.analisys_stack_returns)))
+            if len(self.worklists) >= MAX_SAMPLES:
+                self.worklists = self.worklists[1::2]
+                self.sample_interval *= 2
+
+    def _patch(self, obj, attr, phase):
+        orig = getattr(obj, attr)
+        if isinstance(obj, type) or obj is engine:
+            self._patches.append((obj, attr, orig))
+        else:
+            self._patches.append((obj, attr, None))
+        setattr(obj, attr, self.wrap(phase, orig))
+
+    def install(self):
+        for phase, methods in ASPACE_PHASES:
+            for m in methods:
+                self._patch(engine.AddressSpace, m, phase)
+        for phase, methods in FUNCTION_PHASES:
+            for m in methods:
+                self._patch(engine.Function, m, phase)
+        if engine._processor:
+            for m in PROCESSOR_PHASES:
+                if getattr(engine._processor, m, None):
+                    self._patch(engine._processor, m, m)
+        self._patch(engine, "finish_func", "finish_func")
+
+        orig_analyze = engine.analyze
+        wrapped = self.wrap("analyze", orig_analyze)
+        def analyze(*args, **kwargs):
+            # Don't account time between analyze() calls to a function
+            self._last = time.perf_counter()
+            return wrapped(*args, **kwargs)
+        self._patches.append((engine, "analyze", orig_analyze))
+        engine.analyze = analyze
+        engine.PROFILER = self
+
+    def uninstall(self):
+        engine.PROFILER = None
+        for obj, attr, orig in reversed(self._patches):
+            if orig is None:
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, orig)
+        self._patches = []
+
+    def report(self, top=20):
+        phases = {}
+        for phase in sorted(self.calls):
+            phases[phase] = {
+                "calls": self.calls[phase],
+                "total": self.total.get(phase, 0.0),
+                "self": self.self_time[phase],
+            }
+        funcs = sorted(((addr, rec) for addr, rec in self.funcs.items() if addr is not None),
+                       key=lambda x: x[1][1], reverse=True)
+        AS = engine.ADDRESS_SPACE
+        res = {
+            "insns": self.insns,
+            "phases": phases,
+            "worklists": {
+                "interval": self.sample_interval,
+                "samples": self.worklists,
+                "max": [max((s[i] for s in self.worklists), default=0) for i in (1, 2, 3)],
+            },
+            "functions": {
+                "count": len(funcs),
+                "top": [{"addr": addr, "label": AS.get_label(addr), "insns": insns, "time": t}
+                        for addr, (insns, t) in funcs[:top]],
+            },
+        }
+        if None in self.funcs:
+            insns, t = self.funcs[None]
+            res["functions"]["outside"] = {"insns": insns, "time": t}
+        return res
+
+
+PROFILER = None
+
+
+# Start collecting data. Should be called after the CPU plugin is set
+# (see engine.set_processor()), to instrument its methods.
+def enable():
+    global PROFILER
+    if PROFILER is None:
+        PROFILER = Profiler()
+        PROFILER.install()
+    return PROFILER
+
+
+def disable():
+    global PROFILER
+    if PROFILER is not None:
+        PROFILER.uninstall()
+        PROFILER = None
+
+
+def is_enabled():
+    return PROFILER is not None
+
+
+def report(top=20):
+    if PROFILER is None:
+        return None
+    return PROFILER.report(top)
+
+
+def format_report(top=20):
+    rep = report(top)
+    if rep is None:
+        return "Profiling not enabled"
+    out = ["Analyzed instructions: %d" % rep["insns"], ""]
+    out.append("%-12s %10s %10s %10s" % ("phase", "calls", "total, s", "self, s"))
+    for phase, r in sorted(rep["phases"].items(), key=lambda x: x[1]["self"], reverse=True):
+        out.append("%-12s %10d %10.3f %10.3f" % (phase, r["calls"], r["total"], r["self"]))
+    out.append("")
+    out.append("Max worklist sizes: calls: %d, branches: %d, returns: %d" % tuple(rep["worklists"]["max"]))
+    out.append("")
+    out.append("Most expensive functions (of %d):" % rep["functions"]["count"])
+    for f in rep["functions"]["top"]:
+        out.append("%08x %-30s %8d insns %10.3fs" % (f["addr"], f["label"], f["insns"], f["time"]))
+    return "\n".join(out)
@@ -0,0 +1,238 @@
+# ScratchABit - interactive disassembler
+#
+# Copyright (c) 2015 Paul Sokolovsky
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Setting up a project: parsing .def files, loading target files, and
+# initial analysis. Shared by interactive UI and batch mode, so this
+# module must not depend on UI.
+
+import sys
+import os
+import re
+import string
+import logging as log
+
+from . import engine
+from . import saveload
+from . import parallel
+
+
+CPU_PLUGIN = None
+ENTRYPOINTS = []
+# Number of opcode bytes to show in listing, may be set by .def file
+SHOW_BYTES = 4
+
+
+class ProjectError(Exception):
+    pass
+
+
+# Add plugin dirs to module search path. They're relative to the dir
+# where ScratchABit.py resides.
+def add_plugin_dirs(base_dir=None):
+    if base_dir is None:
+        base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for d in ("plugins", "plugins/cpu", "plugins/loader"):
+        sys.path.append(os.path.join(base_dir, d))
+
+
+def filter_config_line(l):
+    l = re.sub(r"#.*$", "", l)
+    l = l.strip()
+    return l
+
+def load_symbols(fname):
+    with open(fname) as f:
+        for l in f:
+            l = filter_config_line(l)
+            if not l:
+                continue
+            m = re.search(r"\b([A-Za-z_$.][A-Za-z0-9_$.]*)\s*=\s*((0x)?[0-9A-Fa-f]+)", l)
+            if m:
+                #print(m.groups())
+                ENTRYPOINTS.append((m.group(1), int(m.group(2), 0)))
+            else:
+                print("Warning: cannot parse entrypoint info from: %r" % l)
+
+
+# Allow undescores to separate digit groups
+def str2int(s):
+    return int(s.replace("_", ""), 0)
+
+
+def parse_range(arg):
+    # name start(len)
+    # name start-end
+    if "(" in arg:
+        m = re.match(r"(.+?)\s*\(\s*(.+?)\s*\)", arg)
+        start = str2int(m.group(1))
+        end = start + str2int(m.group(2)) - 1
+    else:
+        m = re.match(r"(.+)\s*-\s*(.+)", arg)
+        start = str2int(m.group(1))
+        end = str2int(m.group(2))
+    return start, end
+
+
+def parse_entrypoints(f):
+    for l in f:
+        l = filter_config_line(l)
+        if not l:
+            continue
+        if l[0] == "[":
+            return l
+        m = re.match(r'load "(.+?)"', l)
+        if m:
+            load_symbols(m.group(1))
+        else:
+            label, addr = [v.strip() for v in l.split("=")]
+            ENTRYPOINTS.append((label, int(addr, 0)))
+    return ""
+
+def parse_subareas(f):
+    subareas = []
+    for l in f:
+        l = filter_config_line(l)
+        if not l:
+            continue
+        if l[0] == "[":
+            return l
+
+        args = l.split()
+        assert len(args) == 2
+        start, end = parse_range(args[1])
+        engine.ADDRESS_SPACE.add_subarea(start, end, args[0])
+    engine.ADDRESS_SPACE.finish_subareas()
+    return ""
+
+
+def load_target_file(loader, fname):
+    entry = loader.load(engine.ADDRESS_SPACE, fname)
+    log.info("Loaded %s, entrypoint: %s", fname, hex(entry) if entry is not None else None)
+    if entry is not None:
+        ENTRYPOINTS.append(("_ENTRY_", entry))
+
+
+def parse_disasm_def(fname):
+    global CPU_PLUGIN, SHOW_BYTES
+    with open(fname) as f:
+        for l in f:
+            l = filter_config_line(l)
+            if not l:
+                continue
+            #print(l)
+            while True:
+                if not l:
+                    #return
+                    break
+                if l[0] == "[":
+                    section = l[1:-1]
+                    print("Processing section: %s" % section)
+                    if section == "entrypoints":
+                        l = parse_entrypoints(f)
+                    elif section == "subareas":
+                        l = parse_subareas(f)
+                    else:
+                        assert 0, "Unknown section: " + section
+                else:
+                    break
+
+            if not l:
+                break
+
+            if l.startswith("load"):
+                args = l.split()
+                if args[2][0] in string.digits:
+                    addr = int(args[2], 0)
+                    print("Loading %s @0x%x" % (args[1], addr))
+                    engine.ADDRESS_SPACE.load_content(open(args[1], "rb"), addr)
+                else:
+                    print("Loading %s (%s plugin)" % (args[1], args[2]))
+                    loader = __import__(args[2])
+                    load_target_file(loader, args[1])
+            elif l.startswith("cpu "):
+                args = l.split()
+                CPU_PLUGIN = __import__(args[1])
+                print("Loading CPU plugin %s" % (args[1]))
+            elif l.startswith("show bytes "):
+                args = l.split()
+                SHOW_BYTES = int(args[2])
+            elif l.startswith("area "):
+                args = l.split()
+                assert len(args) == 4
+                start, end = parse_range(args[2])
+                a = engine.ADDRESS_SPACE.add_area(start, end, {"name": args[1], "access": args[3].upper()})
+                print("Adding area: %s" % engine.str_area(a))
+            else:
+                assert 0, "Unknown directive: " + l
+
+
+# Load target, either described by .def file, or a binary file to be
+# auto-detected by default loaders. Returns project name.
+def load_target(fname):
+    global CPU_PLUGIN
+    if fname.endswith(".def"):
+        parse_disasm_def(fname)
+        return fname.rsplit(".", 1)[0]
+
+    import default_plugins
+    for loader_id in default_plugins.loaders:
+        loader = __import__(loader_id)
+        arch_id = loader.detect(fname)
+        if arch_id:
+            break
+    if not arch_id:
+        raise ProjectError("file '%s' not recognized by default loaders" % fname)
+    if arch_id not in default_plugins.cpus:
+        raise ProjectError("no plugin for CPU '%s' as detected for file '%s'" % (arch_id, fname))
+    load_target_file(loader, fname)
+    CPU_PLUGIN = __import__(default_plugins.cpus[arch_id])
+    return fname
+
+
+def init_processor():
+    if CPU_PLUGIN is None:
+        raise ProjectError("no CPU plugin specified")
+    p = CPU_PLUGIN.PROCESSOR_ENTRY()
+    if hasattr(p, "config"):
+        p.config()
+    engine.set_processor(p)
+    return p
+
+
+def project_dir(project_name):
+    return project_name + ".scratchabit"
+
+
+# Mark entrypoints and analyze code reachable from them. With jobs > 1,
+# instructions are decoded by that many worker processes beforehand (see
+# parallel.py).
+def analyze_entrypoints(progress=lambda cnt: None, jobs=1):
+    for label, addr in ENTRYPOINTS:
+        if engine.ADDRESS_SPACE.is_exec(addr):
+            engine.add_entrypoint(addr)
+        engine.ADDRESS_SPACE.make_unique_label(addr, label)
+    parallel.analyze(progress, jobs)
+
+
+# Load saved project state if it exists, otherwise perform initial
+# analysis. Returns True if state was loaded.
+def load_or_analyze(proj_dir, progress=lambda cnt: None, jobs=1, **load_args):
+    if saveload.save_exists(proj_dir):
+        saveload.load_state(proj_dir, jobs=jobs, **load_args)
+        return True
+    analyze_entrypoints(progress, jobs)
+    return False
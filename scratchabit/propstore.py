@@ -0,0 +1,198 @@
+# Storage of address properties (labels, comments, xrefs, etc.)
+#
+# Instead of a dict of per-address dicts, each property kind is stored in
+# its own sorted, compact column: array of addresses and a parallel list
+# of values. Storing None as a value deletes the property.
+#
+# Any property store implementation should provide the same interface as
+# PropStore: get(), set(), addr_props(), iter_prop(), iter_props().
+
+import array
+import bisect
+import heapq
+import itertools
+from collections.abc import Mapping
+from operator import itemgetter
+
+
+class PropColumn:
+
+    # Minimal number of pending updates before they're merged into
+    # the sorted arrays.
+    MIN_PENDING = 4096
+
+    def __init__(self):
+        # Sorted addresses
+        self.keys = array.array("Q")
+        # Values, parallel to keys. None means deleted entry, which will
+        # be dropped on next merge.
+        self.vals = []
+        # Number of deleted entries in vals
+        self.deleted = 0
+        # Updates for addresses not (yet) in keys
+        self.pending = {}
+
+    def __len__(self):
+        self.merge()
+        return len(self.keys)
+
+    def get(self, addr, default=None):
+        if addr in self.pending:
+            val = self.pending[addr]
+        else:
+            keys = self.keys
+            i = bisect.bisect_left(keys, addr)
+            if i == len(keys) or keys[i] != addr:
+                return default
+            val = self.vals[i]
+        if val is None:
+            return default
+        return val
+
+    def set(self, addr, val):
+        keys = self.keys
+        if addr not in self.pending:
+            i = bisect.bisect_left(keys, addr)
+            if i < len(keys) and keys[i] == addr:
+                old = self.vals[i]
+                self.vals[i] = val
+                if old is None:
+                    if val is not None:
+                        self.deleted -= 1
+                    return
+                if val is not None:
+                    return
+                self.deleted += 1
+            elif val is None:
+                return
+            else:
+                self.pending[addr] = val
+        else:
+            self.pending[addr] = val
+        # Merge when pending updates and deleted entries are a noticeable
+        # fraction of the column, so the amortized cost of an update stays
+        # constant.
+        if len(self.pending) + self.deleted > max(self.MIN_PENDING, len(keys) >> 3):
+            self.merge()
+
+    def merge(self):
+        if not self.pending:
+            if self.deleted:
+                self.compact()
+            return
+        new = sorted(self.pending.items())
+        self.pending = {}
+        if not self.keys or new[0][0] > self.keys[-1]:
+            # Common case of adding addresses in ascending order (e.g.
+            # when loading), just append.
+            new = [p for p in new if p[1] is not None]
+            self.keys.extend(map(itemgetter(0), new))
+            self.vals.extend(map(itemgetter(1), new))
+            if self.deleted:
+                self.compact()
+            return
+        self.deleted = 0
+        pairs = list(zip(self.keys, self.vals))
+        # Both runs are sorted, so this is a linear merge
+        pairs.extend(new)
+        pairs.sort(key=itemgetter(0))
+        pairs = [p for p in pairs if p[1] is not None]
+        self.keys = array.array("Q", map(itemgetter(0), pairs))
+        self.vals = list(map(itemgetter(1), pairs))
+
+    # Drop deleted entries
+    def compact(self):
+        pairs = [p for p in zip(self.keys, self.vals) if p[1] is not None]
+        self.keys = array.array("Q", map(itemgetter(0), pairs))
+        self.vals = list(map(itemgetter(1), pairs))
+        self.deleted = 0
+
+    # Iterate over (addr, val) pairs with start <= addr < end, in
+    # address order.
+    def irange(self, start=0, end=None):
+        self.merge()
+        keys = self.keys
+        i = bisect.bisect_left(keys, start)
+        if end is None:
+            j = len(keys)
+        else:
+            j = bisect.bisect_left(keys, end, i)
+        for addr, val in zip(keys[i:j], self.vals[i:j]):
+            if val is not None:
+                yield addr, val
+
+
+# Read-only dict-like view of all properties of a particular address
+class AddrProps(Mapping):
+
+    __slots__ = ("store", "addr")
+
+    def __init__(self, store, addr):
+        self.store = store
+        self.addr = addr
+
+    def __getitem__(self, prop):
+        val = self.store.get(self.addr, prop)
+        if val is None:
+            raise KeyError(prop)
+        return val
+
+    def get(self, prop, default=None):
+        return self.store.get(self.addr, prop, default)
+
+    def __iter__(self):
+        addr = self.addr
+        for prop, col in self.store.columns.items():
+            if col.get(addr) is not None:
+                yield prop
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "AddrProps(0x%x, %r)" % (self.addr, dict(self))
+
+
+class PropStore:
+
+    def __init__(self):
+        # Map from property name to PropColumn
+        self.columns = {}
+
+    def clear(self):
+        self.columns = {}
+
+    def get(self, addr, prop, default=None):
+        col = self.columns.get(prop)
+        if col is None:
+            return default
+        return col.get(addr, default)
+
+    def set(self, addr, prop, val):
+        col = self.columns.get(prop)
+        if col is None:
+            if val is None:
+                return
+            col = self.columns[prop] = PropColumn()
+        col.set(addr, val)
+
+    def addr_props(self, addr):
+        return AddrProps(self, addr)
+
+    # Iterate over (addr, val) of a particular property, in address order
+    def iter_prop(self, prop, start=0, end=None):
+        col = self.columns.get(prop)
+        if col is None:
+            return iter(())
+        return col.irange(start, end)
+
+    # Iterate over (addr, props_dict) for all addresses having any
+    # properties, in address order.
+    def iter_props(self, start=0, end=None):
+        def tagged(prop, col):
+            for addr, val in col.irange(start, end):
+                yield addr, prop, val
+        streams = [tagged(prop, col) for prop, col in self.columns.items()]
+        merged = heapq.merge(*streams, key=itemgetter(0))
+        for addr, group in itertools.groupby(merged, key=itemgetter(0)):
+            yield addr, {prop: val for _, prop, val in group}
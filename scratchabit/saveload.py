@@ -1,8 +1,72 @@
 import sys
 import os
 import glob
+import time
+import threading
+import concurrent.futures
+import logging as log
 
 from . import engine
+from . import aprops
+from . import journal
+from . import sqlitestore
+
+
+# Formats of project files. In binary format, area flags (and optionally
+# bytes) are stored raw and memory-mapped on loading, and address
+# properties are stored as marshal'ed records (see aprops.py). Text
+# format can be used for export, e.g. to diff projects.
+FORMAT_BIN = "bin"
+FORMAT_TEXT = "text"
+
+# Format used to save new projects. Existing projects are saved in the
+# format they already use (see project_format()), so e.g. a text project
+# kept in version control isn't switched to binary format behind user's
+# back. Conversion is done explicitly, with convert_to_bin().
+FORMAT = FORMAT_BIN
+
+# Address properties (but not flags) may be stored in SQLite database
+# instead (see sqlitestore.py). This is selected per project, by
+# presence of project.db.
+FORMAT_DB = "db"
+
+
+def aspace_file(project_dir, area, fmt):
+    fname = project_dir + "/project.aspace.%08x" % area.start
+    if fmt == FORMAT_BIN:
+        fname += ".bin"
+    return fname
+
+
+def aprops_file(project_dir, area, fmt):
+    fname = project_dir + "/project.aprops.%08x" % area.start
+    if fmt == FORMAT_BIN:
+        fname += ".bin"
+    return fname
+
+
+def abytes_file(project_dir, area):
+    return project_dir + "/project.abytes.%08x.bin" % area.start
+
+
+def db_file(project_dir):
+    return project_dir + "/project.db"
+
+
+def journal_file(project_dir):
+    return project_dir + "/project.journal"
+
+
+def is_newer(fname1, fname2):
+    return os.path.exists(fname1) and os.path.getmtime(fname1) > os.path.getmtime(fname2)
+
+
+# Return format to save project in
+def project_format(project_dir):
+    if glob.glob(project_dir + "/project.aspace.????????") and \
+            not glob.glob(project_dir + "/project.aspace.*.bin"):
+        return FORMAT_TEXT
+    return FORMAT
 
 
 def save_exists(project_dir):
@@ -14,27 +78,290 @@ def ensure_project_dir(project_dir):
     if not os.path.isdir(project_dir):
         os.makedirs(project_dir)
 
-def backup_by_prefix(prefix):
-    for fname in glob.glob(prefix):
-        if not fname.endswith(".bak"):
-            os.rename(fname, fname + ".bak")
+# Write file atomically via a temporary one. Previous version is kept
+# as .bak. Existing file, which may be memory-mapped, is never modified
+# in place.
+def write_file(fname, mode, writer, *args):
+    tmp = fname + ".tmp"
+    with open(tmp, mode) as f:
+        writer(f, *args)
+    if os.path.exists(fname):
+        bak = fname + ".bak"
+        if os.path.exists(bak):
+            os.unlink(bak)
+        try:
+            os.link(fname, bak)
+        except OSError:
+            # Filesystem without hard links
+            os.rename(fname, bak)
+    os.replace(tmp, fname)
+
+
+# Save files of an area. If only_dirty is True, only files which
+# changed since last save (or missing ones) are written. Returns number
+# of files written.
+def save_area(project_dir, area, fmt, with_bytes=False, only_dirty=False, with_props=True):
+    AS = engine.ADDRESS_SPACE
+    if fmt == FORMAT_BIN:
+        files = [(aspace_file(project_dir, area, fmt), AS.DIRTY_FLAGS, "wb", AS.save_area_bin)]
+        if with_props:
+            files.append((aprops_file(project_dir, area, fmt), AS.DIRTY_PROPS, "wb", AS.save_area_props_bin))
+    else:
+        files = [(aspace_file(project_dir, area, fmt), AS.DIRTY_FLAGS, "w", AS.save_area)]
+        if with_props:
+            # Text props contain flags too
+            files.append((aprops_file(project_dir, area, fmt), AS.DIRTY_PROPS | AS.DIRTY_FLAGS, "w", AS.save_area_props))
+    if with_bytes:
+        files.append((abytes_file(project_dir, area), AS.DIRTY_BYTES, "wb", AS.save_area_bytes))
+
+    cnt = 0
+    for fname, dirty_mask, mode, writer in files:
+        if only_dirty and not area.dirty & dirty_mask and os.path.exists(fname):
+            continue
+        AS.ensure_area_loaded(area)
+        write_file(fname, mode, writer, area)
+        cnt += 1
+    return cnt
+
+
+# Save project, writing only files for areas which changed since last
+# save. Memory bytes are saved if with_bytes is True, or if project
+# already contains them (e.g. to preserve patches). Returns number of
+# files written.
+def save_state(project_dir, fmt=None, with_bytes=False):
+    if fmt is None:
+        fmt = project_format(project_dir)
+    ensure_project_dir(project_dir)
+    if glob.glob(project_dir + "/project.abytes.*.bin"):
+        with_bytes = True
+
+    AS = engine.ADDRESS_SPACE
+    AS.update_dirty()
+    db = uses_db()
+    cnt = 0
+    for area in AS.get_areas():
+        cnt += save_area(project_dir, area, fmt, with_bytes, only_dirty=True, with_props=not db)
+        if db and area.dirty & AS.DIRTY_PROPS:
+            save_area_funcs(area)
+    if db and AS.changed:
+        AS.props.commit()
+        cnt += 1
+    AS.mark_saved()
+    if AS.journal is not None:
+        AS.journal.truncate()
+    return cnt
+
+
+def uses_db():
+    return isinstance(engine.ADDRESS_SPACE.props, sqlitestore.SqlitePropStore)
+
+
+# Save functions of an area to project database
+def save_area_funcs(area):
+    AS = engine.ADDRESS_SPACE
+    recs = [(addr, f.end, f.get_ranges()) for addr, f in AS.props.iter_prop("fun_s", area.start, area.end + 1)]
+    AS.props.save_funcs(area.start, area.end + 1, recs)
+
+
+# Switch project to SQLite store for address properties. Current state
+# of properties is written to the database and committed.
+def convert_to_db(project_dir):
+    ensure_project_dir(project_dir)
+    AS = engine.ADDRESS_SPACE
+    AS.load_all_areas()
+    fname = db_file(project_dir)
+    for f in (fname, fname + "-wal", fname + "-shm"):
+        if os.path.exists(f):
+            os.unlink(f)
+    store = sqlitestore.SqlitePropStore(fname)
+    for addr, props in AS.props.iter_props():
+        for prop, val in props.items():
+            store.set(addr, prop, val)
+    AS.set_prop_store(store)
+    for area in AS.get_areas():
+        save_area_funcs(area)
+    store.commit()
+
 
-def save_state(project_dir):
+# Convert project to binary format. Text files are left in place, but
+# aren't updated any more (binary files are preferred on loading, unless
+# a text file is newer). Returns number of files written.
+def convert_to_bin(project_dir):
     ensure_project_dir(project_dir)
-    files = ["project.aspace", "project.aprops"]
-    for fname in files:
-        backup_by_prefix(project_dir + "/" + fname + "*")
+    AS = engine.ADDRESS_SPACE
+    AS.load_all_areas()
+    cnt = 0
+    for area in AS.get_areas():
+        cnt += save_area(project_dir, area, FORMAT_BIN, with_props=not uses_db())
+    return cnt
 
+
+# Write complete project in given format to another directory (doesn't
+# affect tracking of changes for the current project).
+def export_state(export_dir, fmt=FORMAT_TEXT, with_bytes=False):
+    ensure_project_dir(export_dir)
     for area in engine.ADDRESS_SPACE.get_areas():
-        with open(project_dir + "/project.aspace.%08x" % area[engine.START], "w") as f:
-            engine.ADDRESS_SPACE.save_area(f, area)
+        save_area(export_dir, area, fmt, with_bytes)
+
+
+# Find files to load for an area. Binary files are preferred, unless
+# text file was updated after it. Returns (flags_fname, flags_fmt,
+# props_fname, props_fmt, bytes_fname), with None for missing files.
+def area_files(project_dir, area):
+    fname = aspace_file(project_dir, area, FORMAT_TEXT)
+    bin_fname = aspace_file(project_dir, area, FORMAT_BIN)
+    if os.path.exists(bin_fname) and not is_newer(fname, bin_fname):
+        flags_fname, flags_fmt = bin_fname, FORMAT_BIN
+    else:
+        flags_fname, flags_fmt = fname, FORMAT_TEXT
+
+    fname = aprops_file(project_dir, area, FORMAT_TEXT)
+    bin_fname = aprops_file(project_dir, area, FORMAT_BIN)
+    if os.path.exists(db_file(project_dir)):
+        # Only functions are loaded from the database
+        props_fname, props_fmt = db_file(project_dir), FORMAT_DB
+    elif os.path.exists(bin_fname) and not is_newer(fname, bin_fname):
+        props_fname, props_fmt = bin_fname, FORMAT_BIN
+    elif os.path.exists(fname):
+        props_fname, props_fmt = fname, FORMAT_TEXT
+    else:
+        print("Warning: %s doesn't exist" % fname)
+        props_fname = props_fmt = None
+
+    bytes_fname = abytes_file(project_dir, area)
+    if not os.path.exists(bytes_fname):
+        bytes_fname = None
+
+    return flags_fname, flags_fmt, props_fname, props_fmt, bytes_fname
+
+
+# Parse files of an area with given (start, end) bounds, without
+# accessing AddressSpace (so this can be done in background, or in
+# another process). Returns (flags, prop_records), where flags is None
+# for binary format (such files are memory-mapped instead).
+def parse_area_files(bounds, files):
+    flags_fname, flags_fmt, props_fname, props_fmt, bytes_fname = files
+    flags = None
+    if flags_fmt == FORMAT_TEXT:
+        with open(flags_fname) as f:
+            flags = engine.AddressSpace.parse_area(f, *bounds)
+    recs = []
+    if props_fmt == FORMAT_BIN:
+        with open(props_fname, "rb") as f:
+            recs = list(aprops.iter_records(f))
+    elif props_fmt == FORMAT_TEXT:
+        with open(props_fname) as f:
+            recs = list(engine.AddressSpace.parse_addr_props(f))
+    elif props_fmt == FORMAT_DB:
+        recs = list(sqlitestore.read_func_records(props_fname, bounds[0], bounds[1] + 1))
+    return flags, recs
+
+
+def apply_area_files(area, files, parsed):
+    AS = engine.ADDRESS_SPACE
+    flags_fname, flags_fmt, props_fname, props_fmt, bytes_fname = files
+    flags, recs = parsed
+    if flags is None:
+        with open(flags_fname, "rb") as f:
+            AS.load_area_bin(f, area)
+    else:
+        AS.load_area_flags(area, flags)
+    if bytes_fname:
+        with open(bytes_fname, "rb") as f:
+            AS.load_area_bytes(f, area)
+    AS.load_prop_records(recs)
+
+
+# Loads an area when called. Parsing of files can be done beforehand
+# (e.g. from a background thread) by calling parse().
+class AreaLoader:
+
+    def __init__(self, project_dir, area):
+        self.project_dir = project_dir
+        self.area = area
+        self.files = area_files(project_dir, area)
+        self.parsed = None
+        self.done = False
+        self.lock = threading.Lock()
+        # Time spent parsing files and applying them to AddressSpace
+        self.parse_time = 0
+        self.apply_time = 0
+
+    def parse(self):
+        with self.lock:
+            if self.parsed is None and not self.done:
+                t = time.time()
+                self.parsed = parse_area_files((self.area.start, self.area.end), self.files)
+                self.parse_time = time.time() - t
+            return self.parsed
+
+    def is_text(self):
+        return FORMAT_TEXT in (self.files[1], self.files[3])
+
+    # Set result of parsing done elsewhere (e.g. in a worker process)
+    def set_parsed(self, parsed, parse_time):
+        with self.lock:
+            self.parsed = parsed
+            self.parse_time = parse_time
 
-    engine.ADDRESS_SPACE.save_addr_props(project_dir + "/project.aprops")
+    def __call__(self):
+        parsed = self.parse()
+        with self.lock:
+            self.done = True
+            self.parsed = None
+        t = time.time()
+        apply_area_files(self.area, self.files, parsed)
+        self.apply_time = time.time() - t
+        log.info("Loaded area 0x%x: parse %.3fs, apply %.3fs", self.area.start, self.parse_time, self.apply_time)
 
 
-def load_state(project_dir):
+# Worker process function for parallel loading
+def _parse_worker(bounds, files):
+    t = time.time()
+    parsed = parse_area_files(bounds, files)
+    return parsed, time.time() - t
+
+
+# Parse area files using a pool of worker processes, and apply results
+# in order as they become ready. Only text files are parsed by workers:
+# binary ones are cheap to parse, and transferring the result from a
+# worker would cost about the same.
+def load_parallel(loaders, jobs):
+    with concurrent.futures.ProcessPoolExecutor(jobs) as ex:
+        futures = {}
+        for l in loaders:
+            if l.is_text():
+                futures[l] = ex.submit(_parse_worker, (l.area.start, l.area.end), l.files)
+        for l in loaders:
+            fut = futures.get(l)
+            if fut is not None:
+                l.set_parsed(*fut.result())
+            l()
+
+
+def print_load_timings(loaders):
+    print("%-10s %-10s %10s %10s" % ("area", "name", "parse", "apply"))
+    for l in sorted(loaders, key=lambda l: l.parse_time + l.apply_time, reverse=True):
+        print("0x%08x %-10s %9.3fs %9.3fs" % (l.area.start, l.area.props.get("name", ""), l.parse_time, l.apply_time))
+
+
+def prefetch(loaders):
+    def run():
+        for loader in loaders:
+            loader.parse()
+    t = threading.Thread(target=run, name="prefetch", daemon=True)
+    t.start()
+    return t
+
+
+# Load project. With lazy=True, areas are loaded on first access (see
+# AddressSpace.set_area_loader()), and with prefetch_areas=True, their
+# files are additionally parsed in background. Otherwise, if jobs > 1,
+# files are parsed by that many worker processes. If timings is True,
+# per-area load times are printed (they're logged in any case).
+def load_state(project_dir, lazy=False, prefetch_areas=False, jobs=1, timings=False):
     files = list(glob.glob(project_dir + "/project.aprops*"))
-    if not files:
+    if not files and not os.path.exists(db_file(project_dir)):
         print("""
 Cannot find project.aprops file. Possibly, you use old database format.
 Use version 0.9 to migrate.
@@ -42,18 +369,66 @@ Use version 0.9 to migrate.
         sys.exit(1)
 
     print("Loading state...")
+    if project_format(project_dir) == FORMAT_TEXT and FORMAT == FORMAT_BIN:
+        print("Project is in text format and will be saved as such. "
+              "Use --convert-bin to convert it to (faster) binary format.")
 
-    for area in engine.ADDRESS_SPACE.get_areas():
-        fname = project_dir + "/project.aspace.%08x" % area[engine.START]
-        with open(fname) as f:
-            engine.ADDRESS_SPACE.load_area(f, area)
-
-        fname = project_dir + "/project.aprops.%08x" % area[engine.START]
-        if os.path.exists(fname):
-            with open(fname) as f:
-                engine.ADDRESS_SPACE.load_addr_props(f)
+    AS = engine.ADDRESS_SPACE
+    if os.path.exists(db_file(project_dir)):
+        AS.set_prop_store(sqlitestore.SqlitePropStore(db_file(project_dir)))
+    loaders = [AreaLoader(project_dir, area) for area in AS.get_areas()]
+    if lazy:
+        for loader in loaders:
+            AS.set_area_loader(loader.area, loader)
+        if prefetch_areas:
+            prefetch(loaders)
+    elif jobs > 1 and sum(l.is_text() for l in loaders) > 1:
+        load_parallel(loaders, jobs)
+    else:
+        for loader in loaders:
+            loader()
+
+    if timings and not lazy:
+        print_load_timings(loaders)
+
+    AS.mark_saved()
+
+
+# Replay changes from project journal, if any (e.g. left after a crash),
+# and start journaling further changes. Call after project is loaded.
+# Returns number of replayed records.
+def open_journal(project_dir, fsync=journal.FSYNC_GROUP):
+    ensure_project_dir(project_dir)
+    AS = engine.ADDRESS_SPACE
+    fname = journal_file(project_dir)
+    recs = []
+    if os.path.exists(fname):
+        recs = list(journal.iter_records(fname))
+        if recs:
+            print("Replaying %d journal records..." % len(recs))
+            AS.apply_records(recs)
+            # Rewrite the journal, dropping possibly incomplete tail
+            tmp = fname + ".tmp"
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            j = journal.Journal(tmp, journal.FSYNC_NEVER)
+            for rec in recs:
+                j.log(rec)
+            j.write()
+            j.sync()
+            j.close()
+            os.replace(tmp, fname)
         else:
-            print("Warning: %s doesn't exist" % fname)
+            os.unlink(fname)
+    AS.set_journal(journal.Journal(fname, fsync))
+    return len(recs)
+
+
+def close_journal():
+    AS = engine.ADDRESS_SPACE
+    if AS.journal is not None:
+        AS.journal.close()
+        AS.set_journal(None)
 
 
 # Save user-specific session parameter, like current address,
@@ -0,0 +1,299 @@
+# SQLite-backed storage of address properties (project.db).
+#
+# Provides the same interface as PropStore (see propstore.py), so can be
+# used as AddressSpace.props. Properties are stored in a table indexed by
+# address (and by property kind), with labels additionally indexed by
+# name, so label lookups and range queries are index operations, and only
+# recently used values are kept in memory.
+#
+# Functions (fun_s/fun_e properties) are live objects, so they're kept in
+# memory, and persisted separately as (end, ranges) in "funcs" table by
+# save_funcs().
+#
+# All properties of recently rendered addresses are cached too, so
+# addr_props() (called for each rendered line) usually doesn't query the
+# database. Pending writes are applied on top of cached values, so they
+# don't need to be flushed for reading.
+#
+# Writes are buffered and executed in batches. They're a part of a single
+# transaction until commit(), which is done when the project is saved, so
+# the database always holds the last saved state.
+
+import sqlite3
+import marshal
+import heapq
+import itertools
+import collections
+from operator import itemgetter
+
+from .propstore import PropStore
+
+
+MARSHAL_VERSION = 4
+
+# SQLite integers are signed 64-bit, so addresses are stored biased,
+# which keeps them ordered.
+BIAS = 1 << 63
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS props (
+    addr INTEGER NOT NULL,
+    prop TEXT NOT NULL,
+    val,
+    PRIMARY KEY (addr, prop)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS props_by_prop ON props (prop, addr);
+CREATE INDEX IF NOT EXISTS label_name ON props (val) WHERE prop = 'label';
+CREATE TABLE IF NOT EXISTS funcs (
+    addr INTEGER PRIMARY KEY,
+    end INTEGER,
+    ranges BLOB
+);
+"""
+
+
+# Strings are stored as is (so labels can be indexed), other values
+# are marshal'ed.
+def _encode(val):
+    if isinstance(val, str):
+        return val
+    return marshal.dumps(val, MARSHAL_VERSION)
+
+
+def _decode(val):
+    if isinstance(val, bytes):
+        return marshal.loads(val)
+    return val
+
+
+def _addr_range(start, end):
+    if end is None:
+        return "addr >= ?", (start - BIAS,)
+    return "addr >= ? AND addr < ?", (start - BIAS, end - BIAS)
+
+
+class SqlitePropStore:
+
+    # Properties holding live objects, kept in memory
+    OBJECT_PROPS = frozenset(("fun_s", "fun_e"))
+    # Number of buffered writes before they're executed
+    MAX_PENDING = 4096
+    # Number of recently accessed values to keep in memory
+    CACHE_SIZE = 65536
+    # Number of recently accessed addresses to keep all properties of
+    ADDR_CACHE_SIZE = 4096
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.db = sqlite3.connect(fname)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.objects = PropStore()
+        # Map from addr to {prop: value} (None for deletion) of writes
+        # not yet executed, and total number of such writes.
+        self.pending = {}
+        self.npending = 0
+        # Map from (addr, prop) to value
+        self.cache = collections.OrderedDict()
+        # Map from addr to dict of all its properties stored in database
+        self.addr_cache = collections.OrderedDict()
+
+    def clear(self):
+        self.pending = {}
+        self.npending = 0
+        self.cache.clear()
+        self.addr_cache.clear()
+        self.objects.clear()
+        self.db.execute("DELETE FROM props")
+        self.db.execute("DELETE FROM funcs")
+
+    def get(self, addr, prop, default=None):
+        if prop in self.OBJECT_PROPS:
+            return self.objects.get(addr, prop, default)
+        key = (addr, prop)
+        pend = self.pending.get(addr)
+        if pend is not None and prop in pend:
+            val = pend[prop]
+        elif key in self.cache:
+            val = self.cache[key]
+            self.cache.move_to_end(key)
+        else:
+            row = self.db.execute("SELECT val FROM props WHERE addr = ? AND prop = ?", (addr - BIAS, prop)).fetchone()
+            val = None if row is None else _decode(row[0])
+            self._cache(key, val)
+        if val is None:
+            return default
+        return val
+
+    def _cache(self, key, val):
+        self.cache[key] = val
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def set(self, addr, prop, val):
+        if prop in self.OBJECT_PROPS:
+            self.objects.set(addr, prop, val)
+            return
+        key = (addr, prop)
+        pend = self.pending.get(addr)
+        if pend is None:
+            pend = self.pending[addr] = {}
+        if prop not in pend:
+            self.npending += 1
+        pend[prop] = val
+        self.cache.pop(key, None)
+        if self.npending >= self.MAX_PENDING:
+            self.flush()
+
+    # Execute buffered writes
+    def flush(self):
+        if not self.pending:
+            return
+        ins = []
+        dels = []
+        for addr, pend in self.pending.items():
+            for prop, val in pend.items():
+                if val is None:
+                    dels.append((addr - BIAS, prop))
+                else:
+                    ins.append((addr - BIAS, prop, _encode(val)))
+        self.db.executemany("INSERT OR REPLACE INTO props VALUES (?, ?, ?)", ins)
+        self.db.executemany("DELETE FROM props WHERE addr = ? AND prop = ?", dels)
+        addr_cache = self.addr_cache
+        for addr, pend in self.pending.items():
+            props = addr_cache.get(addr)
+            for prop, val in pend.items():
+                self._cache((addr, prop), val)
+                if props is not None:
+                    if val is None:
+                        props.pop(prop, None)
+                    else:
+                        props[prop] = val
+        self.pending = {}
+        self.npending = 0
+
+    def commit(self):
+        self.flush()
+        self.db.commit()
+
+    # Close database, discarding uncommitted changes
+    def close(self):
+        self.db.close()
+
+    def addr_props(self, addr):
+        props = self.addr_cache.get(addr)
+        if props is None:
+            props = {prop: _decode(val) for prop, val in
+                     self.db.execute("SELECT prop, val FROM props WHERE addr = ?", (addr - BIAS,))}
+            self.addr_cache[addr] = props
+            if len(self.addr_cache) > self.ADDR_CACHE_SIZE:
+                self.addr_cache.popitem(last=False)
+        else:
+            self.addr_cache.move_to_end(addr)
+        res = dict(props)
+        pend = self.pending.get(addr)
+        if pend:
+            for prop, val in pend.items():
+                if val is None:
+                    res.pop(prop, None)
+                else:
+                    res[prop] = val
+        res.update(self.objects.addr_props(addr))
+        return res
+
+    def iter_prop(self, prop, start=0, end=None):
+        if prop in self.OBJECT_PROPS:
+            return self.objects.iter_prop(prop, start, end)
+        self.flush()
+        cond, args = _addr_range(start, end)
+        cur = self.db.execute("SELECT addr, val FROM props WHERE prop = ? AND %s ORDER BY addr" % cond, (prop,) + args)
+        return ((addr + BIAS, _decode(val)) for addr, val in cur)
+
+    def iter_props(self, start=0, end=None):
+        self.flush()
+        cond, args = _addr_range(start, end)
+        cur = self.db.execute("SELECT addr, prop, val FROM props WHERE %s ORDER BY addr" % cond, args)
+        streams = [((addr + BIAS, prop, _decode(val)) for addr, prop, val in cur)]
+        def tagged(prop):
+            for addr, val in self.objects.iter_prop(prop, start, end):
+                yield addr, prop, val
+        streams.extend(tagged(prop) for prop in self.OBJECT_PROPS)
+        merged = heapq.merge(*streams, key=itemgetter(0))
+        for addr, group in itertools.groupby(merged, key=itemgetter(0)):
+            yield addr, {prop: val for _, prop, val in group}
+
+    # Return address of (non-automatic) label, or None
+    def find_label(self, label):
+        self.flush()
+        row = self.db.execute("SELECT addr FROM props WHERE prop = 'label' AND val = ? LIMIT 1", (label,)).fetchone()
+        if row is None:
+            return None
+        return row[0] + BIAS
+
+    def label_index(self):
+        return LabelIndex(self)
+
+    # Replace function records for start <= addr < end with recs, which
+    # are (addr, end, ranges) tuples.
+    def save_funcs(self, start, end, recs):
+        cond, args = _addr_range(start, end)
+        self.db.execute("DELETE FROM funcs WHERE %s" % cond, args)
+        self.db.executemany("INSERT INTO funcs VALUES (?, ?, ?)", [
+            (addr - BIAS, None if f_end is None else f_end - BIAS, marshal.dumps(ranges, MARSHAL_VERSION))
+            for addr, f_end, ranges in recs
+        ])
+
+
+# Iterate over saved functions with start <= addr < end, as address
+# properties records (see AddressSpace.iter_prop_records()). Uses a
+# separate read-only connection, so can be called from other threads or
+# processes.
+def read_func_records(fname, start=0, end=None):
+    db = sqlite3.connect("file:%s?mode=ro" % fname, uri=True)
+    try:
+        cond, args = _addr_range(start, end)
+        for addr, f_end, ranges in db.execute("SELECT addr, end, ranges FROM funcs WHERE %s ORDER BY addr" % cond, args):
+            if f_end is not None:
+                f_end += BIAS
+            yield (addr + BIAS, None, None, None, (f_end, marshal.loads(ranges)), None)
+    finally:
+        db.close()
+
+
+# Dict-like map from label to its address, to be used as
+# AddressSpace.labels_rev, backed by the label index of the database.
+# Automatic labels are ints equal to their address.
+class LabelIndex:
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, label, default=None):
+        if isinstance(label, int):
+            if self.store.get(label, "label") == label:
+                return label
+            return default
+        addr = self.store.find_label(label)
+        if addr is None:
+            return default
+        return addr
+
+    def __getitem__(self, label):
+        addr = self.get(label)
+        if addr is None:
+            raise KeyError(label)
+        return addr
+
+    def __contains__(self, label):
+        return self.get(label) is not None
+
+    # Labels are indexed by the database itself
+    def __setitem__(self, label, addr):
+        pass
+
+    def __delitem__(self, label):
+        pass
+
+    def keys(self):
+        return [label for addr, label in self.store.iter_prop("label")]
@@ -49,6 +49,9 @@ def handle(app):
     if hasattr(app.cpu_plugin, "mnem_type"):
         app.cpu_plugin.mnem_type = res["listing"]
         app.cpu_plugin.config()
+        # Decoding and rendering may depend on plugin config
+        app.aspace.insn_cache.clear()
+        app.aspace.render_cache.bump()
     app.set_show_bytes(res["show_bytes"])
 
     app.main_screen.e.update_model()
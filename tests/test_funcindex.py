@@ -0,0 +1,65 @@
+# Tests for function range index (FuncIndex) and xref rendering based on it.
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import idaapi
+from scratchabit import engine
+
+
+def make_aspace():
+    aspace = engine.AddressSpace()
+    aspace.add_area(0x1000, 0x9fff, {"name": "code", "access": "RX"})
+    idaapi.set_address_space(aspace)
+    engine.ADDRESS_SPACE = aspace
+    return aspace
+
+
+def xref_text(from_addr):
+    return engine.Xref(0, from_addr, "c").render().strip()
+
+
+def test_lookup_noncontiguous_and_overlapping():
+    aspace = make_aspace()
+    main = aspace.make_func(0x2000)
+    aspace.set_label(0x2000, "main")
+    main.add_range(0x2000, 0x2100)
+    # Chunk placed below the function entry
+    main.add_range(0x1500, 0x1520)
+    # Function nested inside main's range
+    inner = aspace.make_func(0x2040)
+    aspace.set_label(0x2040, "inner")
+    inner.add_range(0x2040, 0x2060)
+
+    assert aspace.lookup_func(0x2010) is main
+    assert aspace.lookup_func(0x1510) is main
+    assert aspace.lookup_func(0x1520) is None
+    assert aspace.lookup_func(0x2050) is inner
+    assert aspace.lookup_func(0x2080) is main
+
+    assert xref_text(0x2010) == "; xref: c 0x2010 (main+0x10)"
+    assert xref_text(0x1510) == "; xref: c 0x1510 (main-0xaf0)"
+    assert xref_text(0x2050) == "; xref: c 0x2050 (inner+0x10)"
+    assert xref_text(0x2000) == "; xref: c 0x2000 (main)"
+    assert xref_text(0x1600) == "; xref: c 0x1600"
+
+
+def test_remove_and_long_range():
+    aspace = make_aspace()
+    # Function with loader-set end spanning several index buckets
+    big = aspace.make_func(0x1000, 0x8000)
+    small = aspace.make_func(0x8100)
+    small.add_range(0x8100, 0x8110)
+    assert aspace.lookup_func(0x7ffc) is big
+    assert aspace.lookup_func(0x8104) is small
+
+    aspace.del_func(0x1000)
+    assert aspace.lookup_func(0x7ffc) is None
+    assert aspace.lookup_func(0x8104) is small
+    assert not any(ent[2] is big for b in aspace.func_index.buckets.values() for ent in b)
+
+    # Shrinking a function's ranges is reflected in the index
+    small.remove_range(0x8108, 0x8110)
+    assert aspace.lookup_func(0x8104) is small
+    assert aspace.lookup_func(0x810c) is None
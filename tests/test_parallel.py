@@ -0,0 +1,70 @@
+# Tests for parallel initial analysis (parallel.py): results must be the
+# same as of sequential analysis.
+import sys
+import os
+import io
+import struct
+import multiprocessing
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import idaapi
+from scratchabit import engine
+from scratchabit import project
+from scratchabit import parallel
+
+
+BASE = 0x10000
+NUM_FUNCS = 200
+
+
+# Chain of Thumb functions, each calling the next one:
+#   push {r4, lr}; movs r0, #i; movs r1, #i; bl next; pop {r4, pc}
+def gen_code():
+    code = b""
+    for i in range(NUM_FUNCS):
+        code += struct.pack("<HHH", 0xb510, 0x2000 | (i & 0xff), 0x2100 | (i & 0xff))
+        if i < NUM_FUNCS - 1:
+            code += struct.pack("<HH", 0xf000, 0xf801)
+        else:
+            code += struct.pack("<HH", 0xbf00, 0xbf00)  # nop; nop
+        code += struct.pack("<H", 0xbd10)
+    return code
+
+
+def analyze(jobs):
+    project.add_plugin_dirs(BASE_DIR)
+    code = gen_code()
+    aspace = engine.AddressSpace()
+    engine.ADDRESS_SPACE = aspace
+    idaapi.set_address_space(aspace)
+    aspace.add_area(BASE, BASE + len(code) - 1, {"name": "code", "access": "RX"})
+    aspace.load_content(io.BytesIO(code), BASE)
+    engine.set_processor(__import__("arm_thumb").PROCESSOR_ENTRY())
+    # Several entrypoints, so they're split among workers
+    for i in range(0, NUM_FUNCS, 50):
+        engine.add_entrypoint(BASE + i * 12)
+    while parallel.pending_entries():
+        parallel.analyze(jobs=jobs)
+    funcs = [(f.start, f.get_ranges()) for f in (aspace.get_func_start(BASE + i * 12) for i in range(NUM_FUNCS)) if f]
+    area = aspace.get_areas()[0]
+    return bytes(area.flags), funcs
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="requires fork")
+def test_parallel_matches_sequential():
+    seq = analyze(1)
+    assert len(seq[1]) == NUM_FUNCS
+    assert analyze(2) == seq
+
+
+def test_no_fork_fallback(monkeypatch):
+    seq = analyze(1)
+    monkeypatch.setattr(multiprocessing, "get_all_start_methods", lambda: ["spawn"])
+    def no_pool(*args):
+        raise AssertionError("worker pool used without fork")
+    monkeypatch.setattr(parallel, "predecode", no_pool)
+    assert analyze(2) == seq
@@ -13,7 +13,7 @@
 # tweaks for other archs.
 #
 import sys
-import engine
+from scratchabit import engine
 import idaapi
 
 
@@ -22,16 +22,21 @@ aspace = engine.ADDRESS_SPACE
 def inst_in_area(area):
     addr = area[engine.START]
     end = area[engine.END] + 1
-    while addr < end:
-        fl = aspace.get_flags(addr)
-        if fl == engine.ADDRESS_SPACE.CODE:
-            inst = engine.Instruction(addr)
+    while True:
+        addr = aspace.find_next_flag(addr, 0x7f, aspace.CODE, end)
+        if addr is None:
+            break
+        # Decode whole run of code at once
+        run_end = aspace.find_next_not(addr, 0x7f, (aspace.CODE, aspace.CODE_CONT), end)
+        if run_end is None:
+            run_end = end
+        for inst in engine.iter_insns(addr, run_end):
             engine._processor.cmd = inst
-            sz = engine._processor.ana()
             engine._processor.out()
             yield inst
-            addr += sz
-        else:
+            addr += inst.size
+        if addr < run_end:
+            # Code flags not matching decoded instructions
             addr += 1
 
 